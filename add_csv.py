@@ -2,57 +2,163 @@
 
 # Add a CSV file as a table into <split>.db and <split>.tables.jsonl
 # Call as:
-#   python add_csv.py <split> <filename.csv>
+#   python add_csv.py <split> <filename.csv> [<filename.csv> | <directory> ...]
 # For a CSV file called data.csv, the table will be called table_data in the .db
-# file, and will be assigned the id 'data'.
-# All columns are treated as text - no attempt is made to sniff the type of value
-# stored in the column.
+# file, and will be assigned the id 'data'. As in DBEngine, '-' becomes '_' in the table
+# name (my-data.csv: table_my_data); other characters than letters, digits and '_' are
+# rejected. All CSV files of a directory are added, in one transaction: on an error,
+# neither the .db nor the .tables.jsonl file changes.
+# A column is stored as real when all the non-empty values among its first --sniff_rows
+# rows are numbers, as DBEngine reads them (e.g. 1,000.5). Other columns are text.
 
-import argparse, csv, json, os
-from sqlalchemy import Column, create_engine, MetaData, String, Table
+import argparse, csv, itertools, json, os, re, shutil, sqlite3, tempfile
+from babel.numbers import parse_decimal, NumberFormatError
 
 def get_table_name(table_id):
-    return 'table_{}'.format(table_id)
-
-def csv_to_sqlite(table_id, csv_file_name, sqlite_file_name):
-    engine = create_engine('sqlite:///{}'.format(sqlite_file_name))
-    with open(csv_file_name) as f:
-        metadata = MetaData(bind=engine)
-        cf = csv.DictReader(f, delimiter=',')
-        simple_name = dict([(name, 'col%d' % i) for i, name in enumerate(cf.fieldnames)])
-        table = Table(get_table_name(table_id), metadata,
-                      *(Column(simple_name[name], String())
-                        for name in cf.fieldnames))
-        table.drop(checkfirst=True)
-        table.create()
-        for row in cf:
-            row = dict((simple_name[name], val) for name, val in row.items())
-            table.insert().values(**row).execute()
-    return engine
-
-def csv_to_json(table_id, csv_file_name, json_file_name):
-    with open(csv_file_name) as f:
-        cf = csv.DictReader(f, delimiter=',')
-        record = {}
-        record['header'] = [(name or 'col{}'.format(i)) for i, name in enumerate(cf.fieldnames)]
-        record['page_title'] = None
-        record['types'] = ['text'] * len(cf.fieldnames)
-        record['id'] = table_id
-        record['caption'] = None
-        record['rows'] = [list(row.values()) for row in cf]
-        record['name'] = get_table_name(table_id)
-        with open(json_file_name, 'a+') as fout:
-            json.dump(record, fout)
-            fout.write('\n')
+    """ Name of the table in the .db file, as DBEngine looks it up. """
+    name = 'table_{}'.format(table_id.replace('-', '_'))
+    if not re.fullmatch(r'\w+', name, re.ASCII):
+        raise ValueError("Invalid table id '{}': use letters, digits, '_' and '-'".format(table_id))
+    return name
+
+def to_number(val):
+    """ val as a float (int when integral), None when it is not a number. """
+    try:
+        x = float(val)
+    except ValueError:
+        try:
+            x = float(parse_decimal(val, locale='en_US'))
+        except (NumberFormatError, ValueError):
+            return None
+    if x != x or x in (float('inf'), float('-inf')):
+        return None
+    return int(x) if x.is_integer() else x
+
+def sniff_types(rows, n_cols):
+    """ 'real' for the columns whose non-empty values are all numbers, 'text' otherwise. """
+    types = []
+    for i in range(n_cols):
+        vals = [row[i] for row in rows if i < len(row) and row[i].strip()]
+        types.append('real' if vals and all(to_number(val) is not None for val in vals) else 'text')
+    return types
+
+def convert_row(row, types):
+    """ Values of the real columns as numbers. Empty values are None, unparsable ones stay text. """
+    row = list(row[:len(types)]) + [''] * (len(types) - len(row))
+    for i, type1 in enumerate(types):
+        if type1 == 'real':
+            if not row[i].strip():
+                row[i] = None
+            else:
+                x = to_number(row[i])
+                if x is not None:
+                    row[i] = x
+    return row
+
+def read_chunks(cf, chunk_size):
+    chunk = []
+    for row in cf:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_to_sqlite_json(table_id, csv_file_name, conn, fout, chunk_size=10000, sniff_rows=1000):
+    """
+    Insert the rows of the CSV into the table with executemany, chunk by chunk, and append its record to the
+    tables file. The caller manages the transaction, see add_csv_files.
+    :return: # of rows
+    """
+    name = get_table_name(table_id)
+    with open(csv_file_name, newline='') as f:
+        cf = csv.reader(f, delimiter=',')
+        fieldnames = next(cf)
+        n_cols = len(fieldnames)
+        chunks = read_chunks(cf, chunk_size)
+        head = []
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= sniff_rows:
+                break
+        types = sniff_types(head[:sniff_rows], n_cols)
+
+        # As DBEngine parses the schema: "col0 text, col1 real, ..."
+        cols = ', '.join('col{} {}'.format(i, type1) for i, type1 in enumerate(types))
+        conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+        conn.execute('CREATE TABLE "{}" ({})'.format(name, cols))
+        insert = 'INSERT INTO "{}" VALUES ({})'.format(name, ', '.join('?' * n_cols))
+
+        rows = []
+        for chunk in itertools.chain([head], chunks):
+            chunk = [convert_row(row, types) for row in chunk]
+            conn.executemany(insert, chunk)
+            rows += chunk
+
+    record = {}
+    record['header'] = [(hd or 'col{}'.format(i)) for i, hd in enumerate(fieldnames)]
+    record['page_title'] = None
+    record['types'] = types
+    record['id'] = table_id
+    record['caption'] = None
+    record['rows'] = [['' if val is None else val for val in row] for row in rows]
+    record['name'] = name
+    json.dump(record, fout)
+    fout.write('\n')
+    return len(rows)
+
+def get_csv_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, x) for x in os.listdir(path) if x.lower().endswith('.csv'))
+        else:
+            files.append(path)
+    return files
+
+def get_table_id(file):
+    return os.path.splitext(os.path.basename(file))[0]
+
+def add_csv_files(files, path_db, fout, chunk_size=10000, sniff_rows=1000):
+    """
+    Add the CSV files to the db in one transaction. Their records are appended to fout only after the COMMIT,
+    so that on an error neither the db nor the tables file changes.
+    :return: [(table_id, # of rows), ...]
+    """
+    table_ids = [get_table_id(file) for file in files]
+    for table_id in table_ids:
+        get_table_name(table_id)  # fails before any change
+    added = []
+    # isolation_level=None: no implicit transactions, so that DROP / CREATE TABLE are in ours.
+    conn = sqlite3.connect(path_db, isolation_level=None)
+    try:
+        with tempfile.TemporaryFile('w+') as f_records:
+            conn.execute('BEGIN')
+            try:
+                for table_id, file in zip(table_ids, files):
+                    added.append((table_id, csv_to_sqlite_json(table_id, file, conn, f_records, chunk_size,
+                                                               sniff_rows)))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            f_records.seek(0)
+            shutil.copyfileobj(f_records, fout)
+    finally:
+        conn.close()
+    return added
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('split')
-    parser.add_argument('file', metavar='file.csv')
+    parser.add_argument('file', metavar='file.csv', nargs='+', help='CSV files, or directories of CSV files')
+    parser.add_argument('--chunk_size', default=10000, type=int, help='rows read and inserted at a time')
+    parser.add_argument('--sniff_rows', default=1000, type=int, help='rows used to decide the column types')
     args = parser.parse_args()
-    table_id = os.path.splitext(os.path.basename(args.file))[0]
-    csv_to_sqlite(table_id, args.file, '{}.db'.format(args.split))
-    csv_to_json(table_id, args.file, '{}.tables.jsonl'.format(args.split))
-    print("Added table with id '{id}' (name '{name}') to {split}.db and {split}.tables.jsonl".format(
-        id=table_id, name=get_table_name(table_id), split=args.split))
-
+    with open('{}.tables.jsonl'.format(args.split), 'a+') as fout:
+        added = add_csv_files(get_csv_files(args.file), '{}.db'.format(args.split), fout, args.chunk_size,
+                              args.sniff_rows)
+    for table_id, n_rows in added:
+        print("Added table with id '{id}' (name '{name}', {n} rows) to {split}.db and {split}.tables.jsonl"
+              .format(id=table_id, name=get_table_name(table_id), n=n_rows, split=args.split))
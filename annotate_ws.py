@@ -2,36 +2,38 @@
 # docker run --name corenlp -d -p 9000:9000 vzhong/corenlp-server
 # Wonseok Hwang. Jan 6 2019, Comment added
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from functools import lru_cache
+from multiprocessing import Pool
 import os
+import shutil
 import records
 import ujson as json
-from stanza.nlp.corenlp import CoreNLPClient
 from tqdm import tqdm
 import copy
 from wikisql.lib.common import count_lines, detokenize
 from wikisql.lib.query import Query
+from sqlova.utils.annotator import ANNOTATORS, get_annotator, compare_annotators
 
 
-client = None
+# CoreNLP server by default. See sqlova/utils/annotator.py.
+annotator = None
+# Tables of the split being annotated, by id. Set in each worker.
+tables = None
 
 
+def set_annotator(name, **kwargs):
+    global annotator
+    annotator = get_annotator(name, **kwargs)
+    annotate.cache_clear()
+
+
+# Questions repeat across augmented data and where-values (e.g. years, team names) across examples: each distinct
+# sentence goes to the annotator once per process. The annotations are shared, do not modify them.
+@lru_cache(maxsize=2 ** 18)
 def annotate(sentence, lower=True):
-    global client
-    if client is None:
-        client = CoreNLPClient(default_annotators='ssplit,tokenize'.split(','))
-    words, gloss, after = [], [], []
-    for s in client.annotate(sentence):
-        for t in s:
-            words.append(t.word)
-            gloss.append(t.originalText)
-            after.append(t.after)
-    if lower:
-        words = [w.lower() for w in words]
-    return {
-        'gloss': gloss,
-        'words': words,
-        'after': after,
-        }
+    if annotator is None:
+        set_annotator('corenlp')
+    return annotator.annotate(sentence, lower=lower)
 
 
 def annotate_example(example, table):
@@ -151,16 +153,120 @@ def is_valid_example(e):
     return True
 
 
+def load_tables(ftable):
+    # ws: Construct table dict with table_id as a key.
+    tables = {}
+    with open(ftable) as ft:
+        for line in ft:
+            d = json.loads(line)
+            tables[d['id']] = d
+    return tables
+
+
+def init_worker(annotator_name, ftable):
+    """ Each worker process has its own annotator (and CoreNLP connection) and cache. """
+    global tables
+    set_annotator(annotator_name)
+    tables = load_tables(ftable)
+
+
+def annotate_shard(shard):
+    """
+    Annotate the examples of a shard and write them to its file. The file only appears once the shard is complete.
+    :param shard: (path of the shard file, lines of the split)
+    """
+    path_shard, lines = shard
+    with open(path_shard + '.tmp', 'wt') as fo:
+        for line in lines:
+            d = json.loads(line)
+            # a = annotate_example(d, tables[d['table_id']])
+            a = annotate_example_ws(d, tables[d['table_id']])
+            fo.write(json.dumps(a) + '\n')
+    os.replace(path_shard + '.tmp', path_shard)
+    return len(lines)
+
+
+def get_shards(fsplit, dshard, shard_size):
+    """ Shards of the split not annotated yet, in order. """
+    with open(fsplit) as fs:
+        lines = []
+        i_shard = 0
+        for line in fs:
+            lines.append(line)
+            if len(lines) == shard_size:
+                path_shard = os.path.join(dshard, '{:06d}.jsonl'.format(i_shard))
+                if not os.path.exists(path_shard):
+                    yield path_shard, lines
+                lines = []
+                i_shard += 1
+        if lines:
+            path_shard = os.path.join(dshard, '{:06d}.jsonl'.format(i_shard))
+            if not os.path.exists(path_shard):
+                yield path_shard, lines
+
+
+def annotate_split(fsplit, ftable, fout, annotator_name, num_workers, shard_size):
+    """
+    Annotate the split in shards of shard_size examples with num_workers processes. Completed shards are kept in
+    <fout>.shards, so that an interrupted run resumes from them. Once all are done, they are concatenated in order.
+    """
+    n_lines = count_lines(fsplit)
+    n_shards = (n_lines + shard_size - 1) // shard_size
+    dshard = fout + '.shards'
+    os.makedirs(dshard, exist_ok=True)
+    fmeta = os.path.join(dshard, 'meta.json')
+    meta = {'split': os.path.abspath(fsplit), 'n_lines': n_lines, 'shard_size': shard_size}
+    if os.path.exists(fmeta):
+        with open(fmeta) as f:
+            meta_prev = json.load(f)
+        if meta_prev != meta:
+            raise ValueError('{} holds shards of {}. Remove it to start over.'.format(dshard, meta_prev))
+    else:
+        with open(fmeta, 'w') as f:
+            json.dump(meta, f)
+
+    n_done = sum(os.path.exists(os.path.join(dshard, '{:06d}.jsonl'.format(i))) for i in range(n_shards))
+    if n_done:
+        print('resuming after {} of {} shards'.format(n_done, n_shards))
+    shards = get_shards(fsplit, dshard, shard_size)
+    pbar = tqdm(total=n_lines, initial=min(n_done * shard_size, n_lines))
+    if num_workers > 1:
+        with Pool(num_workers, initializer=init_worker, initargs=(annotator_name, ftable)) as pool:
+            for n in pool.imap(annotate_shard, shards):
+                pbar.update(n)
+    else:
+        init_worker(annotator_name, ftable)
+        for shard in shards:
+            pbar.update(annotate_shard(shard))
+    pbar.close()
+
+    n_written = 0
+    with open(fout, 'wt') as fo:
+        for i in range(n_shards):
+            with open(os.path.join(dshard, '{:06d}.jsonl'.format(i))) as f:
+                for line in f:
+                    fo.write(line)
+                    n_written += 1
+    shutil.rmtree(dshard)
+    return n_written
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument('--din', default='./data/WikiSQL/data', help='data directory')
     parser.add_argument('--dout', default='./data/wikisql_tok', help='output directory')
     parser.add_argument('--split', default='train,dev,test', help='comma=separated list of splits to process')
+    parser.add_argument('--annotator', default='corenlp', choices=ANNOTATORS,
+                        help='corenlp: CoreNLP server, local: in-process tokenizer')
+    parser.add_argument('--compare', default=0, type=int,
+                        help='Instead of annotating, compare the local tokenizer with CoreNLP on the questions and '
+                             'where-values of the first N examples of each split and report the mismatches.')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='annotator processes, e.g. the number of cores (or of CoreNLP server threads)')
+    parser.add_argument('--shard_size', default=10000, type=int,
+                        help='examples per shard. An interrupted run resumes from the last completed shard.')
     args = parser.parse_args()
 
-    answer_toy = not True
-    toy_size = 10
-
     if not os.path.isdir(args.dout):
         os.makedirs(args.dout)
 
@@ -170,27 +276,23 @@ if __name__ == '__main__':
         ftable = os.path.join(args.din, split) + '.tables.jsonl'
         fout = os.path.join(args.dout, split) + '_tok.jsonl'
 
-        print('annotating {}'.format(fsplit))
-        with open(fsplit) as fs, open(ftable) as ft, open(fout, 'wt') as fo:
-            print('loading tables')
-
-            # ws: Construct table dict with table_id as a key.
-            tables = {}
-            for line in tqdm(ft, total=count_lines(ftable)):
-                d = json.loads(line)
-                tables[d['id']] = d
-            print('loading examples')
-            n_written = 0
-            cnt = -1
-            for line in tqdm(fs, total=count_lines(fsplit)):
-                cnt += 1
-                d = json.loads(line)
-                # a = annotate_example(d, tables[d['table_id']])
-                a = annotate_example_ws(d, tables[d['table_id']])
-                fo.write(json.dumps(a) + '\n')
-                n_written += 1
-
-                if answer_toy:
-                    if cnt > toy_size:
+        if args.compare > 0:
+            sentences = []
+            with open(fsplit) as fs:
+                for i, line in enumerate(fs):
+                    if i >= args.compare:
                         break
-            print('wrote {} examples'.format(n_written))
+                    d = json.loads(line)
+                    sentences.append(d['question'])
+                    sentences += [str(cond[2]) for cond in d['sql']['conds']]
+            stats = compare_annotators(sentences, get_annotator('corenlp'), get_annotator('local'))
+            print('{}: {} of {} sentences differ (gloss: {}, words: {}, after: {})'.format(
+                split, stats['mismatch_any'], stats['n'], stats['mismatch']['gloss'], stats['mismatch']['words'],
+                stats['mismatch']['after']))
+            for e in stats['examples']:
+                print('  {}\n    corenlp: {}\n    local:   {}'.format(e['sentence'], e['ref'], e['test']))
+            continue
+
+        print('annotating {}'.format(fsplit))
+        n_written = annotate_split(fsplit, ftable, fout, args.annotator, args.num_workers, args.shard_size)
+        print('wrote {} examples'.format(n_written))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Peak memory vs. step time of BERT fine-tuning with activation checkpointing.
+#
+# Each setting of --segments runs in its own process (so that peak RSS is per setting) and does
+# forward + backward of BertModel on random input of shape [bS, max_seq_length].
+#   python benchmark/grad_checkpoint.py --bert_type_abb uL --bS 8 --max_seq_length 222 --segments 0,1,2,4,8
+# Peak memory is torch.cuda.max_memory_allocated on GPU and the peak RSS of the process on CPU.
+
+import argparse, json, os, resource, subprocess, sys, time
+
+path_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, path_root)
+
+# Sizes of the released BERT models.
+bert_sizes = {'S': dict(hidden_size=768, num_hidden_layers=12, num_attention_heads=12, intermediate_size=3072),
+              'L': dict(hidden_size=1024, num_hidden_layers=24, num_attention_heads=16, intermediate_size=4096)}
+
+
+def run_one(args):
+    import torch
+    from bert.modeling import BertConfig, BertModel
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    bert_config = BertConfig(vocab_size=30522, **bert_sizes[args.bert_type_abb[1]])
+    model_bert = BertModel(bert_config).to(device)
+    model_bert.set_gradient_checkpointing(args.segment)
+    model_bert.train()
+
+    input_ids = torch.randint(0, bert_config.vocab_size, (args.bS, args.max_seq_length), device=device)
+    segment_ids = torch.zeros_like(input_ids)
+    input_mask = torch.ones_like(input_ids)
+
+    def step():
+        all_encoder_layers, pooled_output = model_bert(input_ids, segment_ids, input_mask)
+        loss = sum(layer.float().mean() for layer in all_encoder_layers[-args.num_target_layers:])
+        loss.backward()
+        model_bert.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    step()  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    t_st = time.time()
+    for _ in range(args.n_steps):
+        step()
+    t_step = (time.time() - t_st) / args.n_steps
+
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated() / 1024 / 1024
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({'segment': args.segment, 'step_s': t_step, 'peak_mb': peak_mb, 'device': device.type}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bert_type_abb', default='uS', choices=['uS', 'uL', 'cS', 'cL'])
+    parser.add_argument('--bS', default=8, type=int)
+    parser.add_argument('--max_seq_length', default=222, type=int)
+    parser.add_argument('--num_target_layers', default=2, type=int)
+    parser.add_argument('--n_steps', default=3, type=int)
+    parser.add_argument('--segments', default='0,1,2,4', help='comma-separated checkpoint segment sizes, 0: off')
+    parser.add_argument('--segment', default=None, type=int, help=argparse.SUPPRESS)  # child process
+    args = parser.parse_args()
+
+    if args.segment is not None:
+        run_one(args)
+        sys.exit(0)
+
+    results = []
+    for segment in [int(x) for x in args.segments.split(',')]:
+        cmd = [sys.executable, os.path.abspath(__file__), '--segment', str(segment),
+               '--bert_type_abb', args.bert_type_abb, '--bS', str(args.bS),
+               '--max_seq_length', str(args.max_seq_length), '--num_target_layers', str(args.num_target_layers),
+               '--n_steps', str(args.n_steps)]
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        results.append(json.loads(out.strip().split('\n')[-1]))
+
+    base = results[0]
+    print(f'{args.bert_type_abb}, bS={args.bS}, max_seq_length={args.max_seq_length}, device={base["device"]}')
+    print(f'{"segment":>8} {"step [s]":>10} {"peak [MB]":>10} {"time x":>8} {"memory x":>9}')
+    for r in results:
+        print(f'{r["segment"]:>8} {r["step_s"]:10.3f} {r["peak_mb"]:10.0f} '
+              f'{r["step_s"] / base["step_s"]:8.2f} {r["peak_mb"] / base["peak_mb"]:9.2f}')
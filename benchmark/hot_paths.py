@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# Timings of the hot paths of training and inference on synthetic data (benchmark/synthetic.py), CPU only.
+#
+# Each function is timed in isolation on the same batches:
+#   load_wikisql_data, FullTokenizer.tokenize, get_bert_input, get_bert_output (randomly initialized small BERT),
+#   get_wemb_n / get_wemb_h, the six Seq2SQL_v1 heads (scp, sap, wnp, wcp, wop, wvp), beam_forward
+#   (execution-guided decoding), DBEngine.execute and get_cnt_x_list.
+#   python benchmark/hot_paths.py --out bench.json
+#   python benchmark/hot_paths.py --baseline bench.json     # compare, exit code 1 on regressions
+# Times are the best of --repeat runs, in ms per call; 'per' tells what one call processes.
+
+import argparse, json, os, platform, sys, tempfile, time
+
+path_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, path_root)
+
+from benchmark.synthetic import make_synthetic_wikisql
+
+
+def timeit(fn, repeat):
+    fn()  # warm-up
+    times = []
+    for _ in range(repeat):
+        t_st = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t_st)
+    return {'min_ms': 1000 * min(times), 'mean_ms': 1000 * sum(times) / len(times)}
+
+
+def run(args, path_data):
+    import torch
+    from bert.modeling import BertModel
+    from sqlnet.dbengine import DBEngine
+    from sqlova.utils.utils_wikisql import load_wikisql_data, get_fields, get_g, get_g_wvi_corenlp, \
+        get_bert_input, get_bert_output, get_wemb_n, get_wemb_h, get_g_wvi_bert_from_g_wvi_corenlp, get_cnt_x_list
+    from sqlova.model.nl2sql.wikisql_models import Seq2SQL_v1
+    from train import get_bert_config_tokenizer
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    bert_type = 'synthetic'
+    bert_config, tokenizer = get_bert_config_tokenizer(path_data, bert_type, do_lower_case=True)
+    model_bert = BertModel(bert_config)
+    model_bert.eval()
+    iS = bert_config.hidden_size * args.num_target_layers
+    model = Seq2SQL_v1(iS, args.hS, args.lS, 0.0, n_cond_ops=4, n_agg_ops=6)
+    model.eval()
+    engine = DBEngine(os.path.join(path_data, 'dev.db'))
+
+    data, table = load_wikisql_data(path_data, mode='dev', no_hs_tok=True)
+    batches = []
+    for i in range(0, min(len(data), args.n_batches * args.bS), args.bS):
+        t = data[i:i + args.bS]
+        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, table, no_hs_t=True, no_sql_t=True)
+        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
+        bert_input = get_bert_input(tokenizer, nlu_t, hds, args.max_seq_length)
+        with torch.no_grad():
+            all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, l_n, l_hpu, l_hs, nlu_tt, t_to_tt_idx, \
+            tt_to_t_idx = get_bert_output(model_bert, tokenizer, nlu_t, hds, args.max_seq_length, bert_input=bert_input)
+        wemb_n = get_wemb_n(i_nlu, l_n, bert_config.hidden_size, bert_config.num_hidden_layers, all_encoder_layer,
+                            args.num_target_layers)
+        wemb_h = get_wemb_h(i_hds, l_hpu, l_hs, bert_config.hidden_size, bert_config.num_hidden_layers,
+                            all_encoder_layer, args.num_target_layers)
+        batches.append(dict(t=t, nlu=nlu, nlu_t=nlu_t, sql_i=sql_i, tb=tb, hds=hds, g_sc=g_sc, g_sa=g_sa, g_wn=g_wn,
+                            g_wc=g_wc, g_wo=g_wo, g_wvi=get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx,
+                                                                                          get_g_wvi_corenlp(t)),
+                            bert_input=bert_input, all_encoder_layer=all_encoder_layer, i_nlu=i_nlu, i_hds=i_hds,
+                            l_n=l_n, l_hpu=l_hpu, l_hs=l_hs, nlu_tt=nlu_tt, tt_to_t_idx=tt_to_t_idx,
+                            wemb_n=wemb_n, wemb_h=wemb_h))
+    texts = [t1['question'] for t1 in data] + [hd for tb1 in table.values() for hd in tb1['header']]
+
+    def for_batches(fn):
+        def run_all():
+            with torch.no_grad():
+                for b in batches:
+                    fn(b)
+        return run_all
+
+    def head(name):
+        def fn(b):
+            args_h = (b['wemb_n'], b['l_n'], b['wemb_h'], b['l_hpu'], b['l_hs'])
+            if name == 'scp':
+                model.scp(*args_h)
+            elif name == 'sap':
+                model.sap(*args_h, b['g_sc'], constraint=True, tb=b['tb'])
+            elif name == 'wnp':
+                model.wnp(*args_h)
+            elif name == 'wcp':
+                model.wcp(*args_h, show_p_wc=False, penalty=True)
+            elif name == 'wop':
+                model.wop(*args_h, wn=b['g_wn'], wc=b['g_wc'], constraint=True, tb=b['tb'])
+            elif name == 'wvp':
+                model.wvp(*args_h, wn=b['g_wn'], wc=b['g_wc'], wo=b['g_wo'])
+        return fn
+
+    def execute_all():
+        for b in batches:
+            for tb1, sql_i1 in zip(b['tb'], b['sql_i']):
+                engine.execute(tb1['id'], sql_i1['sel'], sql_i1['agg'], sql_i1['conds'])
+
+    n_examples = sum(len(b['t']) for b in batches)
+    per_batches = f'{len(batches)} batches of {args.bS}'
+    benches = [
+        ('load_wikisql_data', f'{len(data)} examples', lambda: load_wikisql_data(path_data, mode='dev', no_hs_tok=True)),
+        ('FullTokenizer.tokenize', f'{len(texts)} questions and headers', lambda: [tokenizer.tokenize(x) for x in texts]),
+        ('get_bert_input', per_batches,
+         for_batches(lambda b: get_bert_input(tokenizer, b['nlu_t'], b['hds'], args.max_seq_length))),
+        ('get_bert_output', per_batches,
+         for_batches(lambda b: get_bert_output(model_bert, tokenizer, b['nlu_t'], b['hds'], args.max_seq_length,
+                                               bert_input=b['bert_input']))),
+        ('get_wemb_n', per_batches,
+         for_batches(lambda b: get_wemb_n(b['i_nlu'], b['l_n'], bert_config.hidden_size, bert_config.num_hidden_layers,
+                                          b['all_encoder_layer'], args.num_target_layers))),
+        ('get_wemb_h', per_batches,
+         for_batches(lambda b: get_wemb_h(b['i_hds'], b['l_hpu'], b['l_hs'], bert_config.hidden_size,
+                                          bert_config.num_hidden_layers, b['all_encoder_layer'],
+                                          args.num_target_layers))),
+    ]
+    benches += [(f'Seq2SQL_v1.{name}', per_batches, for_batches(head(name)))
+                for name in ['scp', 'sap', 'wnp', 'wcp', 'wop', 'wvp']]
+    benches += [
+        ('Seq2SQL_v1.beam_forward', per_batches,
+         for_batches(lambda b: model.beam_forward(b['wemb_n'], b['l_n'], b['wemb_h'], b['l_hpu'], b['l_hs'], engine,
+                                                  b['tb'], b['nlu_t'], b['nlu_tt'], b['tt_to_t_idx'], b['nlu'],
+                                                  beam_size=args.beam_size))),
+        ('DBEngine.execute', f'{n_examples} queries', execute_all),
+        ('get_cnt_x_list', per_batches,
+         for_batches(lambda b: get_cnt_x_list(engine, b['tb'], b['g_sc'], b['g_sa'], b['sql_i'],
+                                              b['g_sc'], b['g_sa'], b['sql_i']))),
+    ]
+
+    results = {}
+    for name, per, fn in benches:
+        if args.only and not any(x in name for x in args.only.split(',')):
+            continue
+        results[name] = dict(timeit(fn, args.repeat), per=per)
+        print(f'{name:>26}: {results[name]["min_ms"]:10.2f} ms  ({per})', flush=True)
+
+    meta = {'python': platform.python_version(), 'torch': torch.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'num_threads': args.num_threads, 'bS': args.bS,
+            'n_batches': len(batches), 'max_seq_length': args.max_seq_length, 'hidden_size': bert_config.hidden_size,
+            'num_hidden_layers': bert_config.num_hidden_layers, 'num_target_layers': args.num_target_layers,
+            'hS': args.hS, 'lS': args.lS, 'beam_size': args.beam_size, 'repeat': args.repeat}
+    return {'meta': meta, 'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: names of the benchmarks slower than tolerance x baseline (min_ms).
+    """
+    regressions = []
+    print(f'{"":>26}  {"baseline":>10}  {"now":>10}  {"ratio":>6}')
+    for name, r in report['results'].items():
+        r0 = baseline['results'].get(name)
+        if r0 is None:
+            continue
+        ratio = r['min_ms'] / r0['min_ms'] if r0['min_ms'] > 0 else float('inf')
+        flag = ''
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = '  <- slower'
+        print(f'{name:>26}: {r0["min_ms"]:10.2f}  {r["min_ms"]:10.2f}  {ratio:6.2f}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=None, help='synthetic data directory. Default: a temporary directory.')
+    parser.add_argument('--n_tables', default=100, type=int)
+    parser.add_argument('--n_questions', default=512, type=int)
+    parser.add_argument('--bS', default=16, type=int)
+    parser.add_argument('--n_batches', default=8, type=int)
+    parser.add_argument('--max_seq_length', default=222, type=int)
+    parser.add_argument('--num_target_layers', default=2, type=int)
+    parser.add_argument('--hS', default=100, type=int)
+    parser.add_argument('--lS', default=2, type=int)
+    parser.add_argument('--beam_size', default=4, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--num_threads', default=1, type=int, help='torch threads. Fixed, so that reports compare.')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--only', default=None, help='comma-separated substrings of the benchmark names to run')
+    parser.add_argument('--out', default=None, help='JSON report to write')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare with')
+    parser.add_argument('--tolerance', default=1.2, type=float, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path_tmp:
+        path_data = args.path or path_tmp
+        make_synthetic_wikisql(path_data, 'dev', args.n_tables, args.n_questions, seed=args.seed)
+        report = run(args, path_data)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f'Slower than {args.tolerance} x baseline: {", ".join(regressions)}')
+            sys.exit(1)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Import-time benchmark for the prediction entry point.
+#
+# predict.py runs at import, so this re-runs only its top-level imports under `python -X importtime`
+# in a fresh interpreter and reports the total time and the slowest modules.
+#   python benchmark/import_time.py [--script predict.py] [--top 15] [--repeat 3]
+
+import argparse, ast, os, subprocess, sys
+
+path_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_import_source(path_script):
+    """ Top-level import statements of a script, as source code. """
+    with open(path_script) as f:
+        source = f.read()
+    tree = ast.parse(source)
+    return '\n'.join(ast.get_source_segment(source, node) for node in tree.body
+                     if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def run_importtime(import_source):
+    """
+    :return: [(cumulative_us, self_us, module)] in import order. Nested modules are indented in the name.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', import_source],
+                          cwd=path_root, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().split('\n')[-1])
+
+    rows = []
+    for line in proc.stderr.split('\n'):
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cum_us), int(self_us), name.rstrip()))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--script', default=os.path.join(path_root, 'predict.py'), help='script whose imports are timed')
+    parser.add_argument('--top', default=15, type=int, help='number of slowest modules to show')
+    parser.add_argument('--repeat', default=3, type=int, help='number of cold runs; the fastest one is reported')
+    args = parser.parse_args()
+
+    import_source = get_import_source(args.script)
+    print(import_source)
+    print('')
+
+    runs = [run_importtime(import_source) for _ in range(args.repeat)]
+    totals = [sum(self_us for cum_us, self_us, name in rows) for rows in runs]
+    rows = runs[totals.index(min(totals))]
+
+    print(f'total: {min(totals) / 1e6:.3f} s (min of {args.repeat}), {len(rows)} modules')
+    print(f'matplotlib imported: {any(name.strip() == "matplotlib" for _, _, name in rows)}')
+    print(f'{"cumulative [s]":>15} {"self [s]":>10}  module')
+    for cum_us, self_us, name in sorted(rows, reverse=True)[:args.top]:
+        print(f'{cum_us / 1e6:15.3f} {self_us / 1e6:10.3f}  {name.strip()}')
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# BERT throughput of the three ways of batching the inputs, on synthetic data (benchmark/synthetic.py), CPU only.
+#
+#   fixed  : every example padded to --max_seq_length (get_bert_input)
+#   dynamic: padded to the longest example of the batch
+#   pack   : several examples per row of --max_seq_length (get_bert_input(..., pack=True)), block-diagonal attention
+#   python benchmark/packing.py --bS 32 --max_seq_length 222
+# Reports real tokens per second of get_bert_output and the share of padded positions, and checks that packing
+# gives the wemb_n / wemb_h of fixed padding (max abs difference, eval mode).
+
+import argparse, os, sys, tempfile, time
+
+path_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, path_root)
+
+from benchmark.synthetic import make_synthetic_wikisql
+
+
+def get_dynamic(bert_input):
+    """ Inputs of get_bert_input cut to the longest example of the batch. """
+    all_input_ids, all_input_mask, all_segment_ids = bert_input[:3]
+    l_max = int(all_input_mask.sum(1).max())
+    return (all_input_ids[:, :l_max], all_input_mask[:, :l_max], all_segment_ids[:, :l_max]) + tuple(bert_input[3:])
+
+
+def run(args, path_data):
+    import torch
+    from bert.modeling import BertModel
+    from sqlova.utils.utils_wikisql import load_wikisql_data, get_fields, get_bert_input, get_bert_output, \
+        get_wemb_n, get_wemb_h
+    from train import get_bert_config_tokenizer
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    bert_config, tokenizer = get_bert_config_tokenizer(path_data, 'synthetic', do_lower_case=True)
+    model_bert = BertModel(bert_config)
+    model_bert.eval()
+
+    data, table = load_wikisql_data(path_data, mode='dev', no_hs_tok=True)
+    batches = []
+    for i in range(0, min(len(data), args.n_batches * args.bS), args.bS):
+        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(data[i:i + args.bS], table, no_hs_t=True,
+                                                                    no_sql_t=True)
+        bert_input = get_bert_input(tokenizer, nlu_t, hds, args.max_seq_length)
+        batches.append({'fixed': bert_input,
+                        'dynamic': get_dynamic(bert_input),
+                        'pack': get_bert_input(tokenizer, nlu_t, hds, args.max_seq_length, pack=True)})
+    n_tokens = sum(int(b['fixed'][1].sum()) for b in batches)
+
+    def get_wemb(bert_input):
+        all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, l_n, l_hpu, l_hs, nlu_tt, t_to_tt_idx, \
+        tt_to_t_idx = get_bert_output(model_bert, tokenizer, None, None, args.max_seq_length, bert_input=bert_input)
+        wemb_n = get_wemb_n(i_nlu, l_n, bert_config.hidden_size, bert_config.num_hidden_layers, all_encoder_layer,
+                            args.num_target_layers)
+        wemb_h = get_wemb_h(i_hds, l_hpu, l_hs, bert_config.hidden_size, bert_config.num_hidden_layers,
+                            all_encoder_layer, args.num_target_layers)
+        return wemb_n, wemb_h
+
+    results = {}
+    with torch.no_grad():
+        for mode in ['fixed', 'dynamic', 'pack']:
+            get_wemb(batches[0][mode])  # warm-up
+            times = []
+            for _ in range(args.repeat):
+                t_st = time.perf_counter()
+                for b in batches:
+                    get_wemb(b[mode])
+                times.append(time.perf_counter() - t_st)
+            n_positions = sum(b[mode][0].numel() for b in batches)
+            results[mode] = {'time_s': min(times),
+                             'tokens_per_s': n_tokens / min(times),
+                             'rows': sum(b[mode][0].size(0) for b in batches),
+                             'padded_token_ratio': 1 - n_tokens / n_positions}
+
+        diff = 0.0
+        for b in batches:
+            for x_fixed, x_pack in zip(get_wemb(b['fixed']), get_wemb(b['pack'])):
+                diff = max(diff, float((x_fixed - x_pack).abs().max()))
+
+    print(f'{len(batches)} batches of {args.bS}, max_seq_length={args.max_seq_length}, {n_tokens} tokens')
+    print(f'{"":>8} {"tokens/s":>10} {"rows":>6} {"padded":>7} {"speed x":>8}')
+    for mode, r in results.items():
+        print(f'{mode:>8} {r["tokens_per_s"]:10.0f} {r["rows"]:6d} {100 * r["padded_token_ratio"]:6.1f}% '
+              f'{results["fixed"]["time_s"] / r["time_s"]:8.2f}')
+    print(f'max |wemb(pack) - wemb(fixed)|: {diff:.2e}')
+    return results, diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=None, help='synthetic data directory. Default: a temporary directory.')
+    parser.add_argument('--n_tables', default=100, type=int)
+    parser.add_argument('--n_questions', default=512, type=int)
+    parser.add_argument('--bS', default=32, type=int)
+    parser.add_argument('--n_batches', default=8, type=int)
+    parser.add_argument('--max_seq_length', default=222, type=int)
+    parser.add_argument('--num_target_layers', default=2, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--num_threads', default=1, type=int, help='torch threads. Fixed, so that runs compare.')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path_tmp:
+        path_data = args.path or path_tmp
+        make_synthetic_wikisql(path_data, 'dev', args.n_tables, args.n_questions, seed=args.seed)
+        run(args, path_data)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Synthetic WikiSQL-shaped data, for benchmarks that must run without WikiSQL or BERT checkpoints.
+#
+# Writes, for one split, the files train.py / predict.py read:
+#   <split>.tables.jsonl, <split>_tok.jsonl (CoreNLP-like question_tok and wvi_corenlp), <split>.db (SQLite, as DBEngine
+#   expects: table_<id> with columns col0, col1, ... of type text or real),
+# and a small WordPiece vocabulary and BertConfig (vocab_<bert_type>.txt, bert_config_<bert_type>.json) for a randomly
+# initialized BertModel.
+#   python benchmark/synthetic.py --path ./data/synthetic --n_tables 100 --n_questions 1000
+
+import argparse, json, os, random, sqlite3
+
+BERT_TYPE = 'synthetic'
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+QUESTION_WORDS = ['what', 'is', 'the', 'which', 'how', 'many', 'when', 'was', 'for', 'with', 'of', 'a', 'in', '?',
+                  'name', 'total', 'number', 'highest', 'lowest', 'average']
+# Header and cell words. Some are split into word pieces by the tokenizer (##-suffixes below).
+WORDS = ['team', 'player', 'score', 'year', 'city', 'country', 'position', 'club', 'round', 'date', 'venue',
+         'result', 'points', 'record', 'opponent', 'game', 'season', 'rank', 'title', 'district', 'party', 'votes',
+         'station', 'channel', 'network', 'series', 'episode', 'director', 'writer', 'album', 'song', 'artist',
+         'north', 'south', 'east', 'west', 'red', 'blue', 'green', 'united', 'royal', 'central', 'grand', 'river']
+PIECES = ['##s', '##er', '##ing', '##ed', '##ton', '##ville', '##land', '##ia']
+SUFFIXES = ['s', 'er', 'ing', 'ed', 'ton', 'ville', 'land', 'ia']
+
+# Sizes of a small BERT, fast enough on CPU.
+BERT_CONFIG = dict(hidden_size=128, num_hidden_layers=2, num_attention_heads=2, intermediate_size=512,
+                   hidden_act='gelu', hidden_dropout_prob=0.1, attention_probs_dropout_prob=0.1,
+                   max_position_embeddings=512, type_vocab_size=2, initializer_range=0.02)
+
+
+def get_vocab():
+    digits = [str(i) for i in range(10)] + ['##' + str(i) for i in range(10)] + ['.', '##.']
+    return SPECIAL_TOKENS + QUESTION_WORDS + WORDS + PIECES + digits
+
+
+def make_word(rng):
+    word = rng.choice(WORDS)
+    if rng.random() < 0.3:
+        word += rng.choice(SUFFIXES)
+    return word
+
+
+def make_table(rng, i, n_rows, n_cols_range):
+    n_cols = rng.randint(*n_cols_range)
+    header = [' '.join(make_word(rng) for _ in range(rng.randint(1, 3))) for _ in range(n_cols)]
+    types = ['text' if rng.random() < 0.6 else 'real' for _ in range(n_cols)]
+    rows = [[make_word(rng) if type1 == 'text' else float(rng.randint(0, 2000)) for type1 in types]
+            for _ in range(n_rows)]
+    return {'id': f'1-{i:07d}-1', 'header': header, 'types': types, 'rows': rows}
+
+
+def make_question(rng, table):
+    """ 'what is the <sel header> when <cond header> is <value> ?' with one condition. """
+    n_cols = len(table['header'])
+    sel = rng.randrange(n_cols)
+    agg = rng.choice([0, 3]) if table['types'][sel] == 'text' else rng.choice(range(6))
+    col = rng.choice([c for c in range(n_cols) if c != sel])
+    row = rng.choice(table['rows'])
+    value = row[col]
+    value_str = str(int(value)) if table['types'][col] == 'real' else value
+
+    question_tok = ['what', 'is', 'the'] + table['header'][sel].split() + ['when'] + table['header'][col].split() + ['is']
+    st = len(question_tok)
+    question_tok += value_str.split()
+    ed = len(question_tok) - 1
+    question_tok.append('?')
+    return {'question': ' '.join(question_tok),
+            'question_tok': question_tok,
+            'table_id': table['id'],
+            'sql': {'sel': sel, 'agg': agg, 'conds': [[col, 0, value_str]]},
+            'query': {'sel': sel, 'agg': agg, 'conds': [[col, 0, value_str]]},
+            'wvi_corenlp': [[st, ed]]}
+
+
+def write_db(path_db, tables):
+    if os.path.exists(path_db):
+        os.remove(path_db)
+    conn = sqlite3.connect(path_db)
+    for table in tables:
+        name = 'table_' + table['id'].replace('-', '_')
+        cols = ', '.join(f'col{i} {type1}' for i, type1 in enumerate(table['types']))
+        conn.execute(f'CREATE TABLE {name} ({cols})')
+        conn.executemany(f'INSERT INTO {name} VALUES ({", ".join("?" * len(table["types"]))})', table['rows'])
+    conn.commit()
+    conn.close()
+
+
+def make_synthetic_wikisql(path, split='dev', n_tables=100, n_questions=1000, n_rows=20, n_cols_range=(4, 8), seed=0):
+    """
+    :return: path, bert_type. Use them as the data path (and BERT path) with load_wikisql_data, DBEngine
+             and get_bert_config_tokenizer.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    tables = [make_table(rng, i, n_rows, n_cols_range) for i in range(n_tables)]
+    questions = [make_question(rng, rng.choice(tables)) for _ in range(n_questions)]
+
+    with open(os.path.join(path, f'{split}.tables.jsonl'), 'w') as f:
+        for table in tables:
+            f.write(json.dumps(table) + '\n')
+    with open(os.path.join(path, f'{split}_tok.jsonl'), 'w') as f:
+        for question in questions:
+            f.write(json.dumps(question) + '\n')
+    write_db(os.path.join(path, f'{split}.db'), tables)
+
+    vocab = get_vocab()
+    with open(os.path.join(path, f'vocab_{BERT_TYPE}.txt'), 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+    with open(os.path.join(path, f'bert_config_{BERT_TYPE}.json'), 'w') as f:
+        json.dump(dict(BERT_CONFIG, vocab_size=len(vocab)), f, indent=1)
+    return path, BERT_TYPE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='./data/synthetic')
+    parser.add_argument('--split', default='dev')
+    parser.add_argument('--n_tables', default=100, type=int)
+    parser.add_argument('--n_questions', default=1000, type=int)
+    parser.add_argument('--n_rows', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    make_synthetic_wikisql(args.path, args.split, args.n_tables, args.n_questions, args.n_rows, seed=args.seed)
+    print(f'Wrote {args.n_questions} questions over {args.n_tables} tables to {args.path}')
@@ -19,11 +19,13 @@ from __future__ import division
 from __future__ import print_function
 
 import copy
+import inspect
 import json
 import math
 import six
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import CrossEntropyLoss
 
 def gelu(x):
@@ -142,6 +144,8 @@ class BERTLayerNorm(nn.Module):
         # normalize each vector (each token).
         # regularize x.
         # If x follows Gaussian distribution, it becomes standard Normal distribution (i.e., mu=0, std=1).
+        # Statistics in fp32 under autocast: variance_epsilon underflows in fp16.
+        x = x.float()
         u = x.mean(-1, keepdim=True) # keepdim = keeprank of tensor.
         s = (x - u).pow(2).mean(-1, keepdim=True) # variance
         x = (x - u) / torch.sqrt(s + self.variance_epsilon) # standard
@@ -163,10 +167,11 @@ class BERTEmbeddings(nn.Module):
         self.LayerNorm = BERTLayerNorm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -314,19 +319,52 @@ class BERTLayer(nn.Module):
         return layer_output
 
 
+# Non-reentrant activation checkpointing where available (torch >= 1.11 has use_reentrant).
+CHECKPOINT_KWARGS = {'use_reentrant': False} \
+    if 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters else {}
+
+
 class BERTEncoder(nn.Module):
     def __init__(self, config):
         super(BERTEncoder, self).__init__()
         layer = BERTLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])    
+        # Number of consecutive layers per activation checkpoint. 0: no checkpointing.
+        self.checkpoint_segment_size = 0
 
     def forward(self, hidden_states, attention_mask):
+        if self.checkpoint_segment_size > 0 and self.training and torch.is_grad_enabled():
+            return self.forward_checkpointed(hidden_states, attention_mask)
+
         all_encoder_layers = []
         for layer_module in self.layer:
             hidden_states = layer_module(hidden_states, attention_mask)
             all_encoder_layers.append(hidden_states)
         return all_encoder_layers
 
+    def forward_checkpointed(self, hidden_states, attention_mask):
+        """The output of every layer is kept, as it is returned. The activations inside the layers
+        (attention scores and probabilities, intermediate layer, ...) are not kept: they are
+        recomputed during backward, one segment of layers at a time.
+        """
+        def run_segment(layer_modules):
+            def forward(hidden_states, attention_mask):
+                outputs = []
+                for layer_module in layer_modules:
+                    hidden_states = layer_module(hidden_states, attention_mask)
+                    outputs.append(hidden_states)
+                return tuple(outputs)
+            return forward
+
+        all_encoder_layers = []
+        n = self.checkpoint_segment_size
+        for st in range(0, len(self.layer), n):
+            segment = run_segment(self.layer[st:st + n])
+            outputs = torch.utils.checkpoint.checkpoint(segment, hidden_states, attention_mask, **CHECKPOINT_KWARGS)
+            all_encoder_layers.extend(outputs)
+            hidden_states = outputs[-1]
+        return all_encoder_layers
+
 
 class BERTPooler(nn.Module):
     def __init__(self, config):
@@ -343,6 +381,17 @@ class BERTPooler(nn.Module):
         return pooled_output
 
 
+def get_packed_position_ids(seq_ids):
+    """Position ids restarting at 0 at the first token of each sequence of a packed row.
+    seq_ids: [batch_size, seq_length], index of the sequence of each token (0 on padding).
+    """
+    pos = torch.arange(seq_ids.size(1), dtype=torch.long, device=seq_ids.device).unsqueeze(0).expand_as(seq_ids)
+    is_start = torch.ones_like(seq_ids, dtype=torch.bool)
+    is_start[:, 1:] = seq_ids[:, 1:] != seq_ids[:, :-1]
+    start = torch.where(is_start, pos, torch.zeros_like(pos)).cummax(dim=1).values
+    return pos - start
+
+
 class BertModel(nn.Module):
     """BERT model ("Bidirectional Embedding Representations from a Transformer").
 
@@ -371,18 +420,41 @@ class BertModel(nn.Module):
         self.encoder = BERTEncoder(config)
         self.pooler = BERTPooler(config)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
+    def set_gradient_checkpointing(self, segment_size):
+        """Activation checkpointing of the encoder during training, `segment_size` layers per
+        checkpoint (e.g. 1: every BERTLayer, 4: groups of four layers). 0 turns it off.
+        Saves activation memory at the cost of one extra forward pass per step.
+        """
+        if segment_size < 0:
+            raise ValueError("segment_size should be >= 0, got %d" % segment_size)
+        self.encoder.checkpoint_segment_size = segment_size
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, packed=False):
+        """packed: each row holds several sequences back to back (see get_bert_input(..., pack=True) of
+        sqlova.utils.utils_wikisql). attention_mask then holds the index (>= 1) of the sequence of each token,
+        0 on padding. Tokens only attend to the tokens of their sequence (block-diagonal mask) and the position
+        ids restart at 0 at each sequence, so each sequence is encoded as if it had its own row.
+        pooled_output is that of the first sequence of each row.
+        """
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
-        # We create a 3D attention mask from a 2D tensor mask.
-        # Sizes are [batch_size, 1, 1, to_seq_length]
-        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
-        # this attention mask is more simple than the triangular masking of causal attention
-        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        position_ids = None
+        if packed:
+            # [batch_size, 1, from_seq_length, to_seq_length]
+            seq_ids = attention_mask
+            extended_attention_mask = (seq_ids.unsqueeze(2) == seq_ids.unsqueeze(1)) & (seq_ids.unsqueeze(1) > 0)
+            extended_attention_mask = extended_attention_mask.unsqueeze(1)
+            position_ids = get_packed_position_ids(seq_ids)
+        else:
+            # We create a 3D attention mask from a 2D tensor mask.
+            # Sizes are [batch_size, 1, 1, to_seq_length]
+            # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
+            # this attention mask is more simple than the triangular masking of causal attention
+            # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -392,7 +464,7 @@ class BertModel(nn.Module):
         extended_attention_mask = extended_attention_mask.float()
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
         all_encoder_layers = self.encoder(embedding_output, extended_attention_mask)
         sequence_output = all_encoder_layers[-1]
         pooled_output = self.pooler(sequence_output)
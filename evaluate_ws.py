@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import json
 from argparse import ArgumentParser
+from functools import partial
+from hashlib import sha1
+from multiprocessing import Pool
 from tqdm import tqdm
 from wikisql.lib.dbengine import DBEngine
 from wikisql.lib.query import Query
@@ -10,6 +13,83 @@ import os
 
 # Jan1 2019. Wonseok. Path info has added to original wikisql/evaluation.py
 # Only need to add "query" (essentially "sql" in original data) and "table_id" while constructing file.
+#
+# --num_workers N: the examples are evaluated in chunks by N processes, each with its own DBEngine.
+# --gold_cache <file>: results of the gold queries, keyed by (hash of the db file, table_id, query). Evaluating
+#   other checkpoints on the same split only executes the predicted queries.
+# --mismatch_file <file>: JSON lines of the examples with a wrong execution result or logical form.
+
+# DBEngine of the process. Set by init_worker.
+engine = None
+
+
+def init_worker(db_file):
+    global engine
+    engine = DBEngine(db_file)
+
+
+def get_db_hash(db_file):
+    h = sha1()
+    with open(db_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_gold_key(eg):
+    return eg['table_id'] + ' ' + json.dumps(eg['sql'], sort_keys=True)
+
+
+def load_gold_cache(path, db_hash):
+    """ {gold key: result} of the db. The file holds the results of any number of dbs. """
+    gold_cache = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                d = json.loads(line)
+                if d['db'] == db_hash:
+                    gold_cache[d['key']] = d['result']
+    return gold_cache
+
+
+def evaluate_example(eg, lp, gold=None, ordered=False):
+    """
+    :param eg: example of the source file
+    :param lp: line of the prediction file
+    :param gold: result of the gold query, when known
+    """
+    ep = json.loads(lp)
+    qg = Query.from_dict(eg['sql'], ordered=ordered)
+    gold_cached = gold is not None
+    if not gold_cached:
+        gold = engine.execute_query(eg['table_id'], qg, lower=True)
+    pred = ep.get('error', None)
+    qp = None
+    if not ep.get('error', None):
+        try:
+            qp = Query.from_dict(ep['query'], ordered=ordered)
+            pred = engine.execute_query(eg['table_id'], qp, lower=True)
+        except Exception as e:
+            pred = repr(e)
+    return {'correct': pred == gold, 'match': qp == qg, 'gold': gold, 'pred': pred, 'gold_cached': gold_cached,
+            'key': get_gold_key(eg), 'table_id': eg['table_id'], 'question': eg.get('question', None),
+            'sql': eg['sql'], 'query': ep.get('query', None)}
+
+
+def evaluate_chunk(chunk, ordered=False):
+    return [evaluate_example(eg, lp, gold, ordered) for eg, lp, gold in chunk]
+
+
+def get_chunks(fs, fp, gold_cache, chunk_size):
+    chunk = []
+    for ls, lp in zip(fs, fp):
+        eg = json.loads(ls)
+        chunk.append((eg, lp, gold_cache.get(get_gold_key(eg))))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 if __name__ == '__main__':
 
@@ -38,34 +118,56 @@ if __name__ == '__main__':
     parser.add_argument('--db_file', help='source database for the prediction', default=path_db)
     parser.add_argument('--pred_file', help='predictions by the model', default=path_pred)
     parser.add_argument('--ordered', action='store_true', help='whether the exact match should consider the order of conditions')
+    parser.add_argument('--num_workers', default=1, type=int, help='evaluation processes, each with its own DBEngine')
+    parser.add_argument('--chunk_size', default=256, type=int, help='examples sent to a worker at a time')
+    parser.add_argument('--gold_cache', default=None, help='JSON lines file of the gold query results, e.g. gold_cache.jsonl')
+    parser.add_argument('--mismatch_file', default=None, help='JSON lines file of the wrongly predicted examples')
     args = parser.parse_args()
     args.ordered=ordered
 
-    engine = DBEngine(args.db_file)
+    if args.gold_cache:
+        db_hash = get_db_hash(args.db_file)
+        gold_cache = load_gold_cache(args.gold_cache, db_hash)
+
+    if args.num_workers > 1:
+        pool = Pool(args.num_workers, initializer=init_worker, initargs=(args.db_file,))
+        imap = pool.imap
+    else:
+        init_worker(args.db_file)
+        imap = map
+
     exact_match = []
     with open(args.source_file) as fs, open(args.pred_file) as fp:
         grades = []
-        for ls, lp in tqdm(zip(fs, fp), total=count_lines(args.source_file)):
-            eg = json.loads(ls)
-            ep = json.loads(lp)
-            qg = Query.from_dict(eg['sql'], ordered=args.ordered)
-            gold = engine.execute_query(eg['table_id'], qg, lower=True)
-            pred = ep.get('error', None)
-            qp = None
-            if not ep.get('error', None):
-                try:
-                    qp = Query.from_dict(ep['query'], ordered=args.ordered)
-                    pred = engine.execute_query(eg['table_id'], qp, lower=True)
-                except Exception as e:
-                    pred = repr(e)
-            correct = pred == gold
-            match = qp == qg
-            grades.append(correct)
-            exact_match.append(match)
+        new_gold = {}
+        fm = open(args.mismatch_file, 'w') if args.mismatch_file else None
+        chunks = get_chunks(fs, fp, gold_cache if args.gold_cache else {}, args.chunk_size)
+        pbar = tqdm(total=count_lines(args.source_file))
+        # Results in the order of the examples.
+        for results in imap(partial(evaluate_chunk, ordered=args.ordered), chunks):
+            for r in results:
+                if not r['gold_cached']:
+                    new_gold[r['key']] = r['gold']
+                if fm is not None and not (r['correct'] and r['match']):
+                    fm.write(json.dumps({'index': len(grades), 'table_id': r['table_id'], 'question': r['question'],
+                                         'sql': r['sql'], 'query': r['query'], 'ex_correct': r['correct'],
+                                         'lf_correct': r['match'], 'gold': r['gold'], 'pred': r['pred']},
+                                        default=str) + '\n')
+                grades.append(r['correct'])
+                exact_match.append(r['match'])
+            pbar.update(len(results))
+        pbar.close()
+        if fm is not None:
+            fm.close()
+        if args.num_workers > 1:
+            pool.close()
+
+        if args.gold_cache and new_gold:
+            with open(args.gold_cache, 'a') as f:
+                for key, result in new_gold.items():
+                    f.write(json.dumps({'db': db_hash, 'key': key, 'result': result}) + '\n')
 
         print(json.dumps({
             'ex_accuracy': sum(grades) / len(grades),
             'lf_accuracy': sum(exact_match) / len(exact_match),
             }, indent=2))
-
-
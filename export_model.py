@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Export a trained BERT + Seq2SQL_v1 model to TorchScript and ONNX (no execution-guided decoding).
+#
+#   python export_model.py \
+#     --bert_type_abb uL \
+#     --model_file <path to models>/model_best.pt            \
+#     --bert_model_file <path to models>/model_bert_best.pt  \
+#     --bert_path <path to bert_config/vocab>  \
+#     --data_path <path to db/jsonl/tables.jsonl>            \
+#     --split dev \
+#     --export_path ./saved/export \
+#     --check_parity
+#
+# The first batch of the split is used as the tracing example; batch size, lengths and number of
+# columns stay dynamic. With --check_parity, the exported models (TorchScript, and ONNX when onnxruntime
+# is installed) are compared with the eager model on the whole split.
+# Use the artifacts with predict.py --backend torchscript|onnx --export_path <export_path>.
+
+import argparse, os
+from sqlova.utils.utils_wikisql import *
+from sqlova.model.nl2sql.export import export_models, load_exported_models, get_seq2sql_inputs, ort
+from train import construct_hyper_param, get_models
+
+
+class InputRecorder:
+    """ Calls model_bert and keeps the input tensors built by get_bert_output. """
+    def __init__(self, model_bert):
+        self.model_bert = model_bert
+        self.inputs = None
+
+    def __call__(self, *inputs):
+        self.inputs = inputs
+        return self.model_bert(*inputs)
+
+
+def get_example_inputs(t, data_table, model_bert, bert_config, tokenizer, max_seq_length, num_target_layers):
+    nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, data_table, no_hs_t=True, no_sql_t=True)
+    recorder = InputRecorder(model_bert)
+    wemb_n, wemb_h, l_n, l_hpu, l_hs, \
+    nlu_tt, t_to_tt_idx, tt_to_t_idx \
+        = get_wemb_bert(bert_config, recorder, tokenizer, nlu_t, hds, max_seq_length,
+                        num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers)
+    return recorder.inputs, get_seq2sql_inputs(wemb_n, l_n, wemb_h, l_hpu, l_hs, tb)
+
+
+def get_max_diff(s1, s2):
+    """ Max abs difference over unmasked entries (masked ones are -1e10 or -inf in both). """
+    valid = s1 > -1e9
+    if not valid.any():
+        return 0.0
+    return (s1[valid] - s2[valid]).abs().max().item()
+
+
+def check_parity(data_loader, data_table, model, model_bert, model_ex, model_bert_ex, bert_config, tokenizer,
+                 max_seq_length, num_target_layers):
+    """
+    :return: max abs difference of the question embedding and of each score, and the fraction of
+             questions with the same predicted (sc, sa, wn, wc, wo, wvi).
+    """
+    names = ['wemb_n', 's_sc', 's_sa', 's_wn', 's_wc', 's_wo', 's_wv']
+    max_diff = dict((name, 0.0) for name in names)
+    cnt = 0
+    cnt_same = 0
+    for iB, t in enumerate(data_loader):
+        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, data_table, no_hs_t=True, no_sql_t=True)
+
+        outs = []
+        for m, m_bert in [(model, model_bert), (model_ex, model_bert_ex)]:
+            wemb_n, wemb_h, l_n, l_hpu, l_hs, \
+            nlu_tt, t_to_tt_idx, tt_to_t_idx \
+                = get_wemb_bert(bert_config, m_bert, tokenizer, nlu_t, hds, max_seq_length,
+                                num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers)
+            s = m(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=True, tb=tb)
+            outs.append((wemb_n,) + tuple(s))
+
+        for name, s1, s2 in zip(names, outs[0], outs[1]):
+            max_diff[name] = max(max_diff[name], get_max_diff(s1, s2))
+
+        pr = pred_sw_se(*outs[0][1:])
+        pr_ex = pred_sw_se(*outs[1][1:])
+        for b in range(len(nlu)):
+            cnt += 1
+            if [pr1[b] for pr1 in pr] == [pr_ex1[b] for pr_ex1 in pr_ex]:
+                cnt_same += 1
+        print('Parity check: processed %d batches' % iB, end='\r', flush=True)
+    print('')
+
+    return max_diff, cnt_same / cnt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_file", default='./saved/model_best.pt', help='model file to use (e.g. model_best.pt)')
+    parser.add_argument("--bert_model_file", default='./saved/model_bert_best.pt', help='bert model file to use (e.g. model_bert_best.pt)')
+    parser.add_argument("--bert_path", default='./data/wikisql_tok', help='path to bert files (bert_config*.json etc)')
+    parser.add_argument("--data_path", default='./data/wikisql_tok', help='path to *.jsonl and *.db files')
+    parser.add_argument("--split", default='dev', help='prefix of jsonl and db files used for tracing and the parity check')
+    parser.add_argument("--export_path", default='./saved/export', help='directory in which to place exported models')
+    parser.add_argument("--no_onnx", default=False, action='store_true', help='Export TorchScript only.')
+    parser.add_argument("--opset_version", default=14, type=int, help='ONNX opset version.')
+    parser.add_argument("--check_parity", default=False, action='store_true',
+                        help='Compare the exported models with the eager model on the split.')
+    args = construct_hyper_param(parser)
+
+    if torch.cuda.is_available():
+        raise ValueError("Export targets CPU inference. Hide the GPU with CUDA_VISIBLE_DEVICES=''.")
+
+    args.no_pretraining = True  # counterintuitive, but avoids loading unused models
+    model, model_bert, tokenizer, bert_config = get_models(args, args.bert_path, trained=True,
+                                                           path_model_bert=args.bert_model_file,
+                                                           path_model=args.model_file)
+    model.eval()
+    model_bert.eval()
+
+    data, table = load_wikisql_data(args.data_path, mode=args.split, toy_model=args.toy_model,
+                                    toy_size=args.toy_size, no_hs_tok=True)
+    data_loader = torch.utils.data.DataLoader(
+        batch_size=args.bS,
+        dataset=data,
+        shuffle=False,
+        num_workers=1,
+        collate_fn=lambda x: x  # now dictionary values are not merged!
+    )
+
+    with torch.no_grad():
+        example_bert_inputs, example_seq2sql_inputs = get_example_inputs(next(iter(data_loader)), table, model_bert,
+                                                                         bert_config, tokenizer, args.max_seq_length,
+                                                                         args.num_target_layers)
+    export_models(args.export_path, model, model_bert, bert_config, args.num_target_layers,
+                  example_bert_inputs, example_seq2sql_inputs, onnx=not args.no_onnx,
+                  opset_version=args.opset_version)
+    print(f"Exported models to {args.export_path}")
+
+    if args.check_parity:
+        backends = ['torchscript']
+        if not args.no_onnx and ort is not None:
+            backends.append('onnx')
+        for backend in backends:
+            model_ex, model_bert_ex, _ = load_exported_models(args.export_path, backend)
+            with torch.no_grad():
+                max_diff, acc_same = check_parity(data_loader, table, model, model_bert, model_ex, model_bert_ex,
+                                                  bert_config, tokenizer, args.max_seq_length, args.num_target_layers)
+            print(f'{backend} parity ------------')
+            print(' ' + ', '.join(f'{name}: {diff:.2e}' for name, diff in max_diff.items()))
+            print(f' same prediction: {acc_same:.4f}')
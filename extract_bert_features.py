@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Run BERT once over WikiSQL splits and cache the features of the question and header tokens
+# (see sqlova/utils/bert_features.py), for training without --fine_tune:
+#   python extract_bert_features.py --bert_type_abb uS --num_target_layers 2 --max_seq_length 222 \
+#     --split train,dev,test --features_path ./data/wikisql_tok/bert_features
+#   python train.py --bert_type_abb uS --num_target_layers 2 --max_seq_length 222 \
+#     --bert_features ./data/wikisql_tok/bert_features
+# The features of each split go to <features_path>/<split>. Use the same --bert_type_abb and --max_seq_length
+# for training; --num_target_layers may be smaller.
+
+import argparse, os, time
+from sqlova.utils.utils_wikisql import *
+from sqlova.utils.checkpoint import load_checkpoint, load_model_state
+from sqlova.utils.bert_features import extract_bert_features
+from train import construct_hyper_param, get_bert
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_path", default='./data/wikisql_tok', help='path to bert files (bert_config*.json etc)')
+    parser.add_argument("--data_path", default='./data/wikisql_tok', help='path to *.jsonl files')
+    parser.add_argument("--split", default='train,dev,test', help='comma-separated prefixes of the jsonl files')
+    parser.add_argument("--features_path", default='./data/wikisql_tok/bert_features',
+                        help='directory in which to place the features')
+    parser.add_argument("--bert_model_file", default=None,
+                        help='BERT checkpoint to use (e.g. model_bert_best.pt) instead of the pre-trained BERT.')
+    args = construct_hyper_param(parser)
+
+    model_bert, tokenizer, bert_config = get_bert(args.bert_path, args.bert_type, args.do_lower_case,
+                                                  args.no_pretraining or args.bert_model_file is not None,
+                                                  fast_load=args.fast_load)
+    if args.bert_model_file is not None:
+        res = load_checkpoint(args.bert_model_file, 'model_bert', use_mmap=args.fast_load)
+        load_model_state(model_bert, res, assign=args.fast_load)
+        model_bert.to(device)
+
+    for split in args.split.split(','):
+        data, table = load_wikisql_data(args.data_path, mode=split, toy_model=args.toy_model,
+                                        toy_size=args.toy_size, no_hs_tok=True)
+        data_loader = torch.utils.data.DataLoader(
+            batch_size=args.bS,
+            dataset=data,
+            shuffle=False,
+            **get_loader_options(get_collate_fn(table, tokenizer, args.max_seq_length),
+                                 args.num_workers, args.prefetch_factor)
+        )
+        t_st = time.time()
+        meta = extract_bert_features(data_loader, model_bert, bert_config, os.path.join(args.features_path, split),
+                                     args.num_target_layers, args.max_seq_length, bert_type=args.bert_type,
+                                     precision=args.precision)
+        print(f"{split}: {meta['n_examples']} examples, {meta['n_question_tokens']} question and "
+              f"{meta['n_header_tokens']} header tokens in {time.time() - t_st:.1f} s")
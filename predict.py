@@ -16,7 +16,8 @@
 #    - <split>.tables.jsonl
 #    - <split>_tok.jsonl         # derived using annotate_ws.py
 # You can play with the existing train/dev/test splits, or make your own with
-# the add_csv.py and add_question.py utilities.
+# the add_csv.py and add_question.py utilities, or all at once from a directory of
+# CSV tables and a file of questions with prepare.py.
 #
 # Once you have all that, you are ready to predict, using:
 #   python predict.py \
@@ -29,11 +30,26 @@
 #     --split <split>
 #
 # Results will be in a file called results_<split>.jsonl in the result_path.
+#
+# For faster CPU inference add --quantize int8 (dynamic int8 quantization of the nn.Linear
+# layers of BERT and the Seq2SQL heads) or --quantize bf16 (bf16 autocast, needs a CPU with
+# native bf16 support). With --quantized_model_file, the int8 model is saved on the first run
+# and loaded directly afterwards. Add --compare_fp32 to report the acc_lx/acc_x delta against
+# the fp32 model on a labelled split.
+#
+# Models exported with export_model.py run with --backend torchscript or --backend onnx
+# (onnxruntime on CPU, falls back to TorchScript when onnxruntime is not installed):
+#   python predict.py ... --backend onnx --export_path ./saved/export
 
-import argparse, os
+import argparse, os, time
 from sqlnet.dbengine import DBEngine
 from sqlova.utils.utils_wikisql import *
-from train import construct_hyper_param, get_models
+from sqlova.utils.quantize import QUANTIZE_MODES, quantize_models, inference_context, is_bf16_supported, \
+    save_quantized, load_quantized, get_size_mb
+from sqlova.model.nl2sql.export import load_exported_models
+from sqlova.utils.precision import to_float
+from sqlova.utils.profiling import StageProfiler, NULL_PROFILER
+from train import construct_hyper_param, get_models, get_bert_config_tokenizer
 
 # This is a stripped down version of the test() method in train.py - identical, except:
 #   - does not attempt to measure accuracy and indeed does not expect the data to be labelled.
@@ -42,7 +58,7 @@ from train import construct_hyper_param, get_models
 def predict(data_loader, data_table, model, model_bert, bert_config, tokenizer,
             max_seq_length,
             num_target_layers, detail=False, st_pos=0, cnt_tot=1, EG=False, beam_size=4,
-            path_db=None, dset_name='test', constraint=True):
+            path_db=None, dset_name='test', constraint=True, profiler=NULL_PROFILER):
 
     model.eval()
     model_bert.eval()
@@ -63,45 +79,56 @@ def predict(data_loader, data_table, model, model_bert, bert_config, tokenizer,
 
     engine = DBEngine(os.path.join(path_db, f"{dset_name}.db"))
     results = []
-    for iB, t in enumerate(data_loader):
+    for iB, t in enumerate(profiler.iter(data_loader)):
         cnt += len(t)
-        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, data_table, no_hs_t=True, no_sql_t=True)
-        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
-        g_wvi_corenlp = get_g_wvi_corenlp(t)
-        wemb_n, wemb_h, l_n, l_hpu, l_hs, \
-        nlu_tt, t_to_tt_idx, tt_to_t_idx \
-            = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
-                            num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers)
-        try:
-            g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
-            g_wv_str, g_wv_str_wp = convert_pr_wvi_to_string(g_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
-
-        except:
-            # Exception happens when where-condition is not found in nlu_tt.
-            # In this case, that train example is not used.
-            # During test, that example considered as wrongly answered.
-            for b in range(len(nlu)):
-                results1 = {}
-                results1["error"] = "Skip happened"
-                results1["nlu"] = nlu[b]
-                results1["table_id"] = tb[b]["id"]
-                results.append(results1)
-            continue
+        with profiler.stage('tokenize'):
+            nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, data_table, no_hs_t=True, no_sql_t=True)
+            g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
+            g_wvi_corenlp = get_g_wvi_corenlp(t)
+            bert_input = get_bert_input(tokenizer, nlu_t, hds, max_seq_length)
+        with profiler.stage('bert'):
+            wemb_n, wemb_h, l_n, l_hpu, l_hs, \
+            nlu_tt, t_to_tt_idx, tt_to_t_idx \
+                = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
+                                num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers,
+                                bert_input=bert_input)
+        profiler.add_batch(len(t), l_n, l_hpu, l_hs, max_seq_length)
+        with profiler.stage('decode'):
+            try:
+                g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
+                g_wv_str, g_wv_str_wp = convert_pr_wvi_to_string(g_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
+
+            except:
+                # Exception happens when where-condition is not found in nlu_tt.
+                # In this case, that train example is not used.
+                # During test, that example considered as wrongly answered.
+                for b in range(len(nlu)):
+                    results1 = {}
+                    results1["error"] = "Skip happened"
+                    results1["nlu"] = nlu[b]
+                    results1["table_id"] = tb[b]["id"]
+                    results.append(results1)
+                continue
 
         if not EG:
             # No Execution guided decoding
-            s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=constraint, tb=tb)
-            pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, )
-            pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
-            pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wv_str, nlu)
+            with profiler.stage('heads'):
+                s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=constraint, tb=tb)
+                # bf16 under --quantize bf16: decoded in fp32.
+                s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = to_float(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv)
+                pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, )
+            with profiler.stage('decode'):
+                pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
+                pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wv_str, nlu)
         else:
             # Execution guided decoding
-            prob_sca, prob_w, prob_wn_w, pr_sc, pr_sa, pr_wn, pr_sql_i = model.beam_forward(wemb_n, l_n, wemb_h, l_hpu,
-                                                                                            l_hs, engine, tb,
-                                                                                            nlu_t, nlu_tt,
-                                                                                            tt_to_t_idx, nlu,
-                                                                                            beam_size=beam_size,
-                                                                                            constraint=constraint)
+            with profiler.stage('heads'):
+                prob_sca, prob_w, prob_wn_w, pr_sc, pr_sa, pr_wn, pr_sql_i = model.beam_forward(wemb_n, l_n, wemb_h, l_hpu,
+                                                                                                l_hs, engine, tb,
+                                                                                                nlu_t, nlu_tt,
+                                                                                                tt_to_t_idx, nlu,
+                                                                                                beam_size=beam_size,
+                                                                                                constraint=constraint)
             # sort and generate
             pr_wc, pr_wo, pr_wv, pr_sql_i = sort_and_generate_pr_w(pr_sql_i)
             # Following variables are just for consistency with no-EG case.
@@ -109,51 +136,55 @@ def predict(data_loader, data_table, model, model_bert, bert_config, tokenizer,
             pr_wv_str=None
             pr_wv_str_wp=None
 
-        g_sql_q = generate_sql_q(sql_i, tb)
-        pr_sql_q = generate_sql_q(pr_sql_i, tb)
-
-        for b, (pr_sql_i1, pr_sql_q1) in enumerate(zip(pr_sql_i, pr_sql_q)):
-            results1 = {}
-            results1["query"] = pr_sql_i1
-            results1["table_id"] = tb[b]["id"]
-            results1["nlu"] = nlu[b]
-            results1["sql"] = pr_sql_q1
-            results.append(results1)
-
-        cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, \
-        cnt_wc1_list, cnt_wo1_list, \
-        cnt_wvi1_list, cnt_wv1_list = get_cnt_sw_list(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi,
-                                                      pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi,
-                                                      sql_i, pr_sql_i,
-                                                      mode='test')
-        cnt_lx1_list = get_cnt_lx_list(cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list,
-                                       cnt_wo1_list, cnt_wv1_list)
+        with profiler.stage('decode'):
+            g_sql_q = generate_sql_q(sql_i, tb)
+            pr_sql_q = generate_sql_q(pr_sql_i, tb)
+
+        with profiler.stage('metrics'):
+            for b, (pr_sql_i1, pr_sql_q1) in enumerate(zip(pr_sql_i, pr_sql_q)):
+                results1 = {}
+                results1["query"] = pr_sql_i1
+                results1["table_id"] = tb[b]["id"]
+                results1["nlu"] = nlu[b]
+                results1["sql"] = pr_sql_q1
+                results.append(results1)
+
+            cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, \
+            cnt_wc1_list, cnt_wo1_list, \
+            cnt_wvi1_list, cnt_wv1_list = get_cnt_sw_list(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi,
+                                                          pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi,
+                                                          sql_i, pr_sql_i,
+                                                          mode='test')
+            cnt_lx1_list = get_cnt_lx_list(cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list,
+                                           cnt_wo1_list, cnt_wv1_list)
 
         # Execution accura y test
         cnt_x1_list = []
         # lx stands for logical form accuracy
 
         # Execution accuracy test.
-        cnt_x1_list, g_ans, pr_ans = get_cnt_x_list(engine, tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i)
+        with profiler.stage('execute'):
+            cnt_x1_list, g_ans, pr_ans = get_cnt_x_list(engine, tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i)
 
         # stat
         # ave_loss += loss.item()
 
         # count
-        cnt_sc += sum(cnt_sc1_list)
-        cnt_sa += sum(cnt_sa1_list)
-        cnt_wn += sum(cnt_wn1_list)
-        cnt_wc += sum(cnt_wc1_list)
-        cnt_wo += sum(cnt_wo1_list)
-        cnt_wv += sum(cnt_wv1_list)
-        cnt_wvi += sum(cnt_wvi1_list)
-        cnt_lx += sum(cnt_lx1_list)
-        cnt_x += sum(cnt_x1_list)
-
-        current_cnt = [cnt_tot, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wv, cnt_wvi, cnt_lx, cnt_x]
-        cnt_list1 = [cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list, cnt_wo1_list, cnt_wv1_list, cnt_lx1_list,
-                     cnt_x1_list]
-        cnt_list.append(cnt_list1)
+        with profiler.stage('metrics'):
+            cnt_sc += sum(cnt_sc1_list)
+            cnt_sa += sum(cnt_sa1_list)
+            cnt_wn += sum(cnt_wn1_list)
+            cnt_wc += sum(cnt_wc1_list)
+            cnt_wo += sum(cnt_wo1_list)
+            cnt_wv += sum(cnt_wv1_list)
+            cnt_wvi += sum(cnt_wvi1_list)
+            cnt_lx += sum(cnt_lx1_list)
+            cnt_x += sum(cnt_x1_list)
+
+            current_cnt = [cnt_tot, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wv, cnt_wvi, cnt_lx, cnt_x]
+            cnt_list1 = [cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list, cnt_wo1_list, cnt_wv1_list, cnt_lx1_list,
+                         cnt_x1_list]
+            cnt_list.append(cnt_list1)
         # report
         # if detail:
         #     report_detail(hds, nlu,
@@ -186,6 +217,15 @@ parser.add_argument("--bert_path", default='./data/wikisql_tok', help='path to b
 parser.add_argument("--data_path", default='./data/wikisql_tok', help='path to *.jsonl and *.db files')
 parser.add_argument("--split", default='test', help='prefix of jsonl and db files (e.g. dev)')
 parser.add_argument("--result_path", default='./saved', help='directory in which to place results')
+parser.add_argument("--quantize", default='none', choices=QUANTIZE_MODES,
+                    help='int8: dynamic int8 quantization of nn.Linear layers, bf16: bf16 autocast. CPU only.')
+parser.add_argument("--quantized_model_file", default=None,
+                    help='pre-quantized int8 model. Written if missing, loaded (without re-quantizing) if present.')
+parser.add_argument("--compare_fp32", default=False, action='store_true',
+                    help='Also run the fp32 model and report the acc_lx / acc_x delta. Needs a labelled split.')
+parser.add_argument("--backend", default='eager', choices=['eager', 'torchscript', 'onnx'],
+                    help='eager: PyTorch modules, torchscript / onnx: models exported with export_model.py. CPU only.')
+parser.add_argument("--export_path", default='./saved/export', help='directory of the exported models')
 # parser.set_defaults(constraint=True)
 # parser.add_argument('--no-constr',
 #                         dest='constraint',
@@ -199,11 +239,52 @@ args = construct_hyper_param(parser)
 BERT_PT_PATH = args.bert_path
 path_save_for_evaluation = args.result_path
 
+if args.quantize != 'none' and torch.cuda.is_available():
+    raise ValueError("--quantize targets CPU inference. Hide the GPU with CUDA_VISIBLE_DEVICES=''.")
+if args.quantize == 'bf16' and not is_bf16_supported():
+    print("Warning: no native bf16 support on this CPU. bf16 autocast is emulated and may be slower than fp32.")
+if args.backend != 'eager':
+    if args.quantize != 'none':
+        raise ValueError("--quantize applies to the eager backend only.")
+    if args.EG:
+        raise ValueError("Execution-guided decoding needs --backend eager.")
+    if not args.constraint:
+        raise ValueError("--no-constr needs --backend eager: the exported models are built with the constraints.")
+    if torch.cuda.is_available():
+        raise ValueError("--backend targets CPU inference. Hide the GPU with CUDA_VISIBLE_DEVICES=''.")
+
 # Load pre-trained models
 path_model_bert = args.bert_model_file
 path_model = args.model_file
 args.no_pretraining = True  # counterintuitive, but avoids loading unused models
-model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH, trained=True, path_model_bert=path_model_bert, path_model=path_model)
+models_fp32 = None
+if args.backend != 'eager':
+    bert_config, tokenizer = get_bert_config_tokenizer(BERT_PT_PATH, args.bert_type, args.do_lower_case)
+    model, model_bert, args.backend = load_exported_models(args.export_path, args.backend)
+    print(f"Loaded {args.backend} models from {args.export_path}")
+    if args.compare_fp32:
+        model_fp32, model_bert_fp32, _, _ = get_models(args, BERT_PT_PATH, trained=True, path_model_bert=path_model_bert, path_model=path_model)
+        models_fp32 = (model_fp32, model_bert_fp32)
+elif args.quantize == 'int8' and args.quantized_model_file and os.path.exists(args.quantized_model_file):
+    # Pre-quantized artifact: skip building, loading and quantizing the fp32 models.
+    bert_config, tokenizer = get_bert_config_tokenizer(BERT_PT_PATH, args.bert_type, args.do_lower_case)
+    model, model_bert = load_quantized(args.quantized_model_file, args.quantize)
+    print(f"Loaded pre-quantized models from {args.quantized_model_file}")
+    if args.compare_fp32:
+        model_fp32, model_bert_fp32, _, _ = get_models(args, BERT_PT_PATH, trained=True, path_model_bert=path_model_bert, path_model=path_model)
+        models_fp32 = (model_fp32, model_bert_fp32)
+else:
+    model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH, trained=True, path_model_bert=path_model_bert, path_model=path_model)
+    if args.compare_fp32:
+        models_fp32 = (model, model_bert)  # quantization below does not modify these.
+    if args.quantize == 'int8':
+        size_fp32 = get_size_mb(model) + get_size_mb(model_bert)
+        model, model_bert = quantize_models(model, model_bert, args.quantize)
+        size_int8 = get_size_mb(model) + get_size_mb(model_bert)
+        print(f"int8 dynamic quantization: {size_fp32:.1f} MB -> {size_int8:.1f} MB")
+        if args.quantized_model_file:
+            save_quantized(args.quantized_model_file, model, model_bert, args.quantize)
+            print(f"Saved pre-quantized models to {args.quantized_model_file}")
 
 # Load data
 dev_data, dev_table = load_wikisql_data(args.data_path, mode=args.split, toy_model=args.toy_model, toy_size=args.toy_size, no_hs_tok=True)
@@ -215,21 +296,30 @@ dev_loader = torch.utils.data.DataLoader(
     collate_fn=lambda x: x  # now dictionary values are not merged!
 )
 
-# Run prediction
-with torch.no_grad():
-    acc_test, results, cnt_list = predict(dev_loader,
-                      dev_table,
-                      model,
-                      model_bert,
-                      bert_config,
-                      tokenizer,
-                      args.max_seq_length,
-                      args.num_target_layers,
-                      detail=False,
-                      path_db=args.data_path,
-                      st_pos=0,
-                      dset_name=args.split, EG=args.EG,
-                      constraint=args.constraint)
+profiler = StageProfiler(args.profile, path=args.result_path, torch_steps=args.profile_torch_steps)
+
+def run_prediction(model, model_bert, quantize, name):
+    t_st = time.time()
+    with torch.no_grad(), inference_context(quantize):
+        acc, results, cnt_list = predict(dev_loader,
+                          dev_table,
+                          model,
+                          model_bert,
+                          bert_config,
+                          tokenizer,
+                          args.max_seq_length,
+                          args.num_target_layers,
+                          detail=False,
+                          path_db=args.data_path,
+                          st_pos=0,
+                          dset_name=args.split, EG=args.EG,
+                          constraint=args.constraint,
+                          profiler=profiler)
+    t_ed = time.time()
+    print(f"{name}: {t_ed - t_st:.1f} s, {1000 * (t_ed - t_st) / len(dev_data):.1f} ms/question")
+    if args.profile:
+        print(profiler.report(name, args.split))
+    return acc, results
 
 def print_result(acc, dname):
     ave_loss, acc_sc, acc_sa, acc_wn, acc_wc, acc_wo, acc_wvi, acc_wv, acc_lx, acc_x = acc
@@ -240,6 +330,16 @@ def print_result(acc, dname):
         acc_wc: {acc_wc:.3f}, acc_wo: {acc_wo:.3f}, acc_wvi: {acc_wvi:.3f}, acc_wv: {acc_wv:.3f}, acc_lx: {acc_lx:.4f}, acc_x: {acc_x:.3f}"
     )
 
+# Run prediction
+run_name = args.backend if args.backend != 'eager' else args.quantize
+acc_test, results = run_prediction(model, model_bert, args.quantize, run_name)
 print_result(acc_test, 'test')
+
+if models_fp32 is not None:
+    acc_fp32, _ = run_prediction(models_fp32[0], models_fp32[1], 'none', 'fp32')
+    print_result(acc_fp32, 'fp32')
+    print(f"{run_name} - fp32: acc_lx delta = {acc_test[-2] - acc_fp32[-2]:+.4f}, "
+          f"acc_x delta = {acc_test[-1] - acc_fp32[-1]:+.4f}")
+
 # Save results
 save_for_evaluation(path_save_for_evaluation, results, args.split)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Prepare a split for predict.py from a directory of CSV tables and a file of questions, in one go:
+#   python prepare.py <split> --csv_dir <directory of CSVs> --questions <questions.csv or questions.jsonl>
+# writes, in --data_path,
+#   - <split>.db, <split>.tables.jsonl   (as add_csv.py, one table per CSV file, with sniffed real/text columns)
+#   - <split>.jsonl                      (as add_question.py, with a dummy label unless the question has 'sql')
+#   - <split>_tok.jsonl                  (as annotate_ws.py)
+# The questions file is a CSV with table_id and question columns, or JSON lines with those keys.
+#
+# Rerunning it only processes what changed: CSV files that are new or modified since the last run (size and
+# modification time, kept in <split>.prepare.json), questions not yet in <split>.jsonl and examples not yet in
+# <split>_tok.jsonl. Tables of other sources in <split>.db and <split>.tables.jsonl are kept.
+
+import argparse, csv, json, os, shutil
+
+from add_csv import add_csv_files, get_csv_files, get_table_id, get_table_name
+from annotate_ws import annotate_split
+from sqlova.utils.annotator import ANNOTATORS
+
+
+def get_stat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def read_ids(path, key):
+    """ key(d) of the JSON lines of path. """
+    ids = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                ids.append(key(json.loads(line)))
+    return ids
+
+
+def get_question_key(d):
+    return d['table_id'], d['question']
+
+
+def prepare_tables(csv_files, path_db, path_tables, path_manifest, chunk_size, sniff_rows):
+    """
+    Add the new and modified CSV files to the db and tables file.
+    :return: ids of the tables (re-)added
+    """
+    manifest = {}
+    if os.path.exists(path_manifest):
+        with open(path_manifest) as f:
+            manifest = json.load(f)
+    todo = [file for file in csv_files if manifest.get(os.path.abspath(file)) != get_stat(file)]
+    if not todo:
+        return []
+    table_ids = [get_table_id(file) for file in todo]
+    replaced = set(table_ids) & set(read_ids(path_tables, lambda d: d['id']))
+
+    if replaced:
+        # Modified tables: rewrite the tables file without their previous records.
+        with open(path_tables) as f, open(path_tables + '.tmp', 'w') as fout:
+            for line in f:
+                if json.loads(line)['id'] not in replaced:
+                    fout.write(line)
+        path_out, mode = path_tables + '.tmp', 'a'
+    else:
+        path_out, mode = path_tables, 'a+'
+    try:
+        # One transaction: on an error, neither the db nor the tables file changes.
+        with open(path_out, mode) as fout:
+            added = add_csv_files(todo, path_db, fout, chunk_size, sniff_rows)
+    except BaseException:
+        if replaced:
+            os.remove(path_tables + '.tmp')
+        raise
+    if replaced:
+        os.replace(path_tables + '.tmp', path_tables)
+    for table_id, n_rows in added:
+        print("Added table with id '{}' (name '{}', {} rows)".format(table_id, get_table_name(table_id), n_rows))
+
+    for file in todo:
+        manifest[os.path.abspath(file)] = get_stat(file)
+    with open(path_manifest, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return table_ids
+
+
+def read_questions(path_questions):
+    """ Questions as in <split>.jsonl: a dummy label (as add_question.py) unless they come with sql. """
+    if path_questions.lower().endswith('.csv'):
+        with open(path_questions, newline='') as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(path_questions) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    questions = []
+    for i, row in enumerate(rows):
+        questions.append({
+            'phase': int(row.get('phase') or 1),
+            'table_id': row['table_id'],
+            'question': row['question'],
+            'sql': read_sql(row.get('sql'), '{}, question {}'.format(path_questions, i + 1))
+        })
+    return questions
+
+
+def read_sql(sql, where):
+    """ sql of a question: a dict, or its JSON text (CSV column), e.g. {"sel": 0, "agg": 0, "conds": [[1, 0, "x"]]} """
+    if not sql:
+        return {'sel': 0, 'conds': [], 'agg': 0}
+    if isinstance(sql, str):
+        try:
+            sql = json.loads(sql)
+        except ValueError:
+            raise ValueError('{}: sql is not JSON: {!r}'.format(where, sql))
+    if not isinstance(sql, dict) or not {'sel', 'agg', 'conds'} <= set(sql):
+        raise ValueError('{}: sql needs the keys sel, agg and conds: {!r}'.format(where, sql))
+    return sql
+
+
+def prepare_questions(questions, path_split, table_ids):
+    """ Append the questions not in <split>.jsonl yet. :return: # of questions added """
+    done = set(read_ids(path_split, get_question_key))
+    table_ids = set(table_ids)
+    n_added = 0
+    unknown = set()
+    with open(path_split, 'a+') as fout:
+        for d in questions:
+            if d['table_id'] not in table_ids:
+                unknown.add(d['table_id'])
+                continue
+            key = get_question_key(d)
+            if key in done:
+                continue
+            done.add(key)
+            fout.write(json.dumps(d) + '\n')
+            n_added += 1
+    if unknown:
+        print('Skipped the questions on unknown tables: {}'.format(', '.join(sorted(unknown))))
+    return n_added
+
+
+def prepare_annotations(path_split, path_tables, path_tok, annotator_name, num_workers, shard_size):
+    """ Annotate the examples of <split>.jsonl not in <split>_tok.jsonl yet. :return: # of examples annotated """
+    done = set(read_ids(path_tok, get_question_key))
+    path_pending = path_split + '.pending'
+    n_pending = 0
+    with open(path_split) as f, open(path_pending, 'w') as fout:
+        for line in f:
+            key = get_question_key(json.loads(line))
+            if key not in done:
+                done.add(key)
+                fout.write(line)
+                n_pending += 1
+    if n_pending:
+        # Resumable: the completed shards of an interrupted run are in <path_tok>.pending.shards.
+        annotate_split(path_pending, path_tables, path_tok + '.pending', annotator_name, num_workers, shard_size)
+        # <split>_tok.jsonl with the new examples is written next to it and renamed: an interrupted run leaves it
+        # with none or all of them, and the next run annotates exactly the missing ones.
+        with open(path_tok + '.tmp', 'w') as fout:
+            for path in [path_tok, path_tok + '.pending']:
+                if os.path.exists(path):
+                    with open(path) as f:
+                        shutil.copyfileobj(f, fout)
+        os.replace(path_tok + '.tmp', path_tok)
+    if os.path.exists(path_tok + '.pending'):
+        os.remove(path_tok + '.pending')
+    os.remove(path_pending)
+    return n_pending
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('split')
+    parser.add_argument('--csv_dir', nargs='+', default=[], help='CSV files, or directories of CSV files')
+    parser.add_argument('--questions', default=None, help='questions.csv or questions.jsonl')
+    parser.add_argument('--data_path', default='.', help='where the split files are written')
+    parser.add_argument('--chunk_size', default=10000, type=int, help='rows read and inserted at a time')
+    parser.add_argument('--sniff_rows', default=1000, type=int, help='rows used to decide the column types')
+    parser.add_argument('--annotator', default='corenlp', choices=ANNOTATORS,
+                        help='corenlp: CoreNLP server, local: in-process tokenizer')
+    parser.add_argument('--num_workers', default=1, type=int, help='annotator processes')
+    parser.add_argument('--shard_size', default=10000, type=int, help='examples per annotation shard')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_path, exist_ok=True)
+    path = os.path.join(args.data_path, args.split)
+    path_tables = path + '.tables.jsonl'
+
+    table_ids = prepare_tables(get_csv_files(args.csv_dir), path + '.db', path_tables,
+                               path + '.prepare.json', args.chunk_size, args.sniff_rows)
+    print('{} tables added or updated'.format(len(table_ids)))
+
+    if args.questions:
+        n_added = prepare_questions(read_questions(args.questions), path + '.jsonl',
+                                    read_ids(path_tables, lambda d: d['id']))
+        print('{} questions added'.format(n_added))
+
+    if os.path.exists(path + '.jsonl'):
+        n_annotated = prepare_annotations(path + '.jsonl', path_tables, path + '_tok.jsonl', args.annotator,
+                                          args.num_workers, args.shard_size)
+        print('{} examples annotated'.format(n_annotated))
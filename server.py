@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# Long-running HTTP/JSON inference server.
+#
+# Models, tokenizer and tables are loaded once, and the DBEngine is opened once by the thread running the
+# batches. Concurrent requests are collected into micro-batches: a batch is run as soon as --max_batch_size
+# questions are waiting, or when the oldest waiting question has waited --max_latency_ms.
+#
+# Tables come from <split>.tables.jsonl and <split>.db in --data_path, e.g. tables added with add_csv.py:
+#   python add_csv.py playground abbrev.csv
+#   python server.py \
+#     --bert_type_abb uL \
+#     --model_file <path to models>/model_best.pt            \
+#     --bert_model_file <path to models>/model_bert_best.pt  \
+#     --bert_path <path to bert_config/vocab>  \
+#     --data_path $PWD --split playground --port 8080
+#
+#   curl -s localhost:8080/predict -d '{"table_id": "abbrev", "question": "what state has ansi digits of 11"}'
+#   -> {"table_id": "abbrev", "nlu": "...", "query": {"sel": ..., "agg": ..., "conds": [...]}, "sql": "...", "answer": [...],
+#       "error": null}
+# "error" is the message of the SQL execution error when the predicted query fails, with "answer": null.
+#
+# Questions are tokenized with CoreNLP as in annotate_ws.py, on the thread running the batches, unless the request
+# already has "question_tok".
+# Exported models (export_model.py) can be served with --backend torchscript|onnx.
+
+import argparse, json, os, queue, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlnet.dbengine import DBEngine
+from sqlova.utils.utils_wikisql import *
+from sqlova.model.nl2sql.export import load_exported_models
+from train import construct_hyper_param, get_models, get_bert_config_tokenizer
+
+
+class Request1:
+    """ One question waiting in the queue. """
+    def __init__(self, t1):
+        self.t1 = t1
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collects requests from the HTTP threads and runs them in batches on a single worker thread,
+    so the models are only ever called from one thread.
+    """
+    def __init__(self, predict_batch, max_batch_size, max_latency):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, t1, timeout=None):
+        req = Request1(t1)
+        self.queue.put(req)
+        if not req.done.wait(timeout):
+            raise TimeoutError("Prediction timed out.")
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batch(self, batch):
+        try:
+            results = self.predict_batch([req.t1 for req in batch])
+            for req, result in zip(batch, results):
+                req.result = result
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                # Do not fail the whole batch for one bad question.
+                for req in batch:
+                    self.run_batch([req])
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            self.run_batch(batch)
+            for req in batch:
+                req.done.set()
+
+
+def predict_batch(t, table, model, model_bert, bert_config, tokenizer, engine, max_seq_length, num_target_layers,
+                  EG=False, beam_size=4, constraint=True):
+    """
+    Same steps as predict() in predict.py, for unlabelled questions.
+    :param t: [{'question': ..., 'question_tok': ..., 'table_id': ...}, ...]
+    """
+    nlu = [t1['question'] for t1 in t]
+    nlu_t = [t1['question_tok'] for t1 in t]
+    tb = [table[t1['table_id']] for t1 in t]
+    hds = [tb1['header'] for tb1 in tb]
+
+    with torch.no_grad():
+        wemb_n, wemb_h, l_n, l_hpu, l_hs, \
+        nlu_tt, t_to_tt_idx, tt_to_t_idx \
+            = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
+                            num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers)
+        if not EG:
+            s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=constraint, tb=tb)
+            pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv)
+            pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
+            pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wv_str, nlu)
+        else:
+            prob_sca, prob_w, prob_wn_w, pr_sc, pr_sa, pr_wn, pr_sql_i = model.beam_forward(wemb_n, l_n, wemb_h, l_hpu,
+                                                                                            l_hs, engine, tb,
+                                                                                            nlu_t, nlu_tt,
+                                                                                            tt_to_t_idx, nlu,
+                                                                                            beam_size=beam_size,
+                                                                                            constraint=constraint)
+            pr_wc, pr_wo, pr_wv, pr_sql_i = sort_and_generate_pr_w(pr_sql_i)
+
+    pr_sql_q = generate_sql_q(pr_sql_i, tb)
+
+    results = []
+    for b, (pr_sql_i1, pr_sql_q1) in enumerate(zip(pr_sql_i, pr_sql_q)):
+        error = None
+        try:
+            answer = engine.execute(tb[b]['id'], pr_sql_i1['sel'], pr_sql_i1['agg'], pr_sql_i1['conds'])
+        except Exception as e:
+            answer = None
+            error = f'{type(e).__name__}: {e}'
+        results1 = {}
+        results1["table_id"] = tb[b]["id"]
+        results1["nlu"] = nlu[b]
+        results1["query"] = pr_sql_i1
+        results1["sql"] = pr_sql_q1
+        results1["answer"] = answer
+        results1["error"] = error
+        results.append(results1)
+    return results
+
+
+def make_handler(batcher, table, timeout):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            body = json.dumps(obj, default=str).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok', 'n_tables': len(table)})
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                table_id = req['table_id']
+                question = req['question']
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {'error': 'Expected a JSON body with "table_id" and "question".'})
+                return
+            if table_id not in table:
+                self.send_json(404, {'error': f'Unknown table_id {table_id}'})
+                return
+
+            try:
+                # Tokenized on the MicroBatcher thread when "question_tok" is not given.
+                t1 = {'question': question, 'question_tok': req.get('question_tok'), 'table_id': table_id}
+                self.send_json(200, batcher.submit(t1, timeout))
+            except TimeoutError as e:
+                self.send_json(503, {'error': str(e)})
+            except Exception as e:
+                self.send_json(500, {'error': repr(e)})
+
+    return Handler
+
+
+def load_tables(path_table):
+    table = {}
+    with open(path_table) as f:
+        for line in f:
+            t1 = json.loads(line.strip())
+            table[t1['id']] = t1
+    return table
+
+
+def tokenize_corenlp(question):
+    """ Not thread-safe: annotate_ws keeps a single annotator (CoreNLP client). Call from the MicroBatcher thread. """
+    from annotate_ws import annotate
+    return annotate(question)['gloss']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_file", default='./saved/model_best.pt', help='model file to use (e.g. model_best.pt)')
+    parser.add_argument("--bert_model_file", default='./saved/model_bert_best.pt', help='bert model file to use (e.g. model_bert_best.pt)')
+    parser.add_argument("--bert_path", default='./data/wikisql_tok', help='path to bert files (bert_config*.json etc)')
+    parser.add_argument("--data_path", default='./data/wikisql_tok', help='path to *.tables.jsonl and *.db files')
+    parser.add_argument("--split", default='test', help='prefix of tables.jsonl and db files (e.g. dev)')
+    parser.add_argument("--host", default='127.0.0.1', help='address to listen on')
+    parser.add_argument("--port", default=8080, type=int, help='port to listen on')
+    parser.add_argument("--max_batch_size", default=16, type=int, help='maximum number of questions per micro-batch')
+    parser.add_argument("--max_latency_ms", default=10, type=float,
+                        help='maximum time a question waits for other questions before its batch is run')
+    parser.add_argument("--request_timeout", default=60, type=float, help='seconds before a request gives up')
+    parser.add_argument("--backend", default='eager', choices=['eager', 'torchscript', 'onnx'],
+                        help='eager: PyTorch modules, torchscript / onnx: models exported with export_model.py.')
+    parser.add_argument("--export_path", default='./saved/export', help='directory of the exported models')
+    args = construct_hyper_param(parser)
+
+    # Load models once.
+    args.no_pretraining = True  # counterintuitive, but avoids loading unused models
+    if args.backend != 'eager':
+        if args.EG:
+            raise ValueError("Execution-guided decoding needs --backend eager.")
+        if not args.constraint:
+            raise ValueError("--no-constr needs --backend eager: the exported models are built with the constraints.")
+        bert_config, tokenizer = get_bert_config_tokenizer(args.bert_path, args.bert_type, args.do_lower_case)
+        model, model_bert, args.backend = load_exported_models(args.export_path, args.backend)
+    else:
+        model, model_bert, tokenizer, bert_config = get_models(args, args.bert_path, trained=True,
+                                                               path_model_bert=args.bert_model_file,
+                                                               path_model=args.model_file)
+    model.eval()
+    model_bert.eval()
+
+    table = load_tables(os.path.join(args.data_path, f'{args.split}.tables.jsonl'))
+    path_db = os.path.join(args.data_path, f'{args.split}.db')
+    local = threading.local()
+
+    def predict_batch1(t):
+        # Runs on the MicroBatcher thread, which owns the DBEngine (SQLite connection), as in ExecAccWorker, and is
+        # the only caller of the annotator.
+        if not hasattr(local, 'engine'):
+            local.engine = DBEngine(path_db)
+        for t1 in t:
+            if not t1['question_tok']:
+                t1['question_tok'] = tokenize_corenlp(t1['question'])
+        return predict_batch(t, table, model, model_bert, bert_config, tokenizer, local.engine,
+                             args.max_seq_length, args.num_target_layers,
+                             EG=args.EG, beam_size=args.beam_size, constraint=args.constraint)
+
+    batcher = MicroBatcher(predict_batch1, args.max_batch_size, args.max_latency_ms / 1000)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, table, args.request_timeout))
+    print(f"Serving {len(table)} tables from {args.split} on http://{args.host}:{args.port}/predict")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
@@ -0,0 +1,465 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# TorchScript / ONNX export of the BERT + Seq2SQL_v1 inference graph (no execution-guided decoding).
+#
+# Seq2SQL_v1.forward works on python lists (l_n, l_hpu, l_hs), packed sequences and per-example
+# loops, which cannot be traced into a shape-independent graph. Seq2SQL_v1_Export re-implements the
+# same computation with tensors only, sharing the parameters of a trained Seq2SQL_v1:
+#   - packed bidirectional LSTMs -> per-direction LSTMs over padded input, where the backward
+#     direction reverses each sequence inside its own length.
+#   - `x[b, l:] = -1e10` loops -> masked_fill with length masks.
+#   - pred_sc / pred_wn / pred_wc / pred_wo -> argmax / topk / sort on tensors.
+#   - get_masks_for_SAP / get_masks_for_WOP -> masks computed from a column-type tensor.
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+def get_len_mask(l, mL):
+    """ [B] lengths -> [B, mL] bool mask, True for real tokens. """
+    return torch.arange(mL, device=l.device).unsqueeze(0) < l.unsqueeze(1)
+
+
+def reverse_padded(x, l):
+    """ Reverse each sequence of x = [B, T, dim] inside its length l[b]. Padding stays in place. """
+    T = x.size(1)
+    t = torch.arange(T, device=x.device).unsqueeze(0)
+    l1 = l.unsqueeze(1)
+    idx = torch.where(t < l1, l1 - 1 - t, t)
+    return x.gather(1, idx.unsqueeze(2).expand_as(x))
+
+
+class LSTM_Export(nn.Module):
+    """ Bidirectional batch_first nn.LSTM without packed sequences. Same outputs as `encode`. """
+    def __init__(self, lstm):
+        super(LSTM_Export, self).__init__()
+        assert lstm.bidirectional and lstm.batch_first
+        self.num_layers = lstm.num_layers
+        self.hidden_size = lstm.hidden_size
+
+        self.lstm_fw = nn.ModuleList()
+        self.lstm_bw = nn.ModuleList()
+        for i in range(lstm.num_layers):
+            iS = lstm.input_size if i == 0 else 2 * lstm.hidden_size
+            for suffix, lstm_list in (('', self.lstm_fw), ('_reverse', self.lstm_bw)):
+                lstm1 = nn.LSTM(input_size=iS, hidden_size=lstm.hidden_size, num_layers=1, batch_first=True)
+                for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+                    getattr(lstm1, f'{name}_l0').data.copy_(getattr(lstm, f'{name}_l{i}{suffix}').data)
+                lstm_list.append(lstm1)
+
+    def forward(self, wemb_l, l, hc0=None):
+        mask = get_len_mask(l, wemb_l.size(1)).unsqueeze(2).float()
+        x = wemb_l.float()
+        for i in range(self.num_layers):
+            if hc0 is None:
+                hc0_fw = None
+                hc0_bw = None
+            else:
+                # [num_layers * 2, B, hS] ordered as (layer0-fw, layer0-bw, layer1-fw, ...)
+                hc0_fw = (hc0[0][2 * i:2 * i + 1].contiguous(), hc0[1][2 * i:2 * i + 1].contiguous())
+                hc0_bw = (hc0[0][2 * i + 1:2 * i + 2].contiguous(), hc0[1][2 * i + 1:2 * i + 2].contiguous())
+            out_fw, _ = self.lstm_fw[i](x, hc0_fw)
+            out_bw, _ = self.lstm_bw[i](reverse_padded(x, l), hc0_bw)
+            x = torch.cat([out_fw, reverse_padded(out_bw, l)], dim=2)
+
+        # pad_packed_sequence returns zeros on padded positions.
+        return x * mask
+
+
+def encode_export(lstm, wemb_l, l, hc0=None):
+    return lstm(wemb_l, l, hc0)
+
+
+def encode_hpu_export(lstm, wemb_hpu, l_hpu, l_hs):
+    """ Tensor version of encode_hpu: [sum(l_hs), mL_hpu, dim] -> [B, max(l_hs), hS] """
+    wenc_hpu = lstm(wemb_hpu, l_hpu)
+    hS = wenc_hpu.size(2)
+    # last_only=True
+    wenc_hpu = wenc_hpu.gather(1, (l_hpu - 1).view(-1, 1, 1).expand(-1, 1, hS)).squeeze(1)
+
+    # Re-pack according to batch.
+    mL_hs = l_hs.max()
+    st = torch.cumsum(l_hs, dim=0) - l_hs
+    j = torch.arange(mL_hs, device=l_hs.device).unsqueeze(0)
+    mask_hs = j < l_hs.unsqueeze(1)
+    idx = torch.where(mask_hs, st.unsqueeze(1) + j, torch.zeros_like(j))
+    wenc_hs = wenc_hpu[idx.view(-1)].view(l_hs.size(0), -1, hS)
+
+    return wenc_hs * mask_hs.unsqueeze(2).float()
+
+
+class Seq2SQL_v1_Export(nn.Module):
+    """
+    Tensor-only Seq2SQL_v1.forward for inference (g_* = None, constraint=True, no mask dropout).
+    Returns the same s_sc, s_sa, s_wn, s_wc, s_wo, s_wv as Seq2SQL_v1.forward.
+    """
+    def __init__(self, model):
+        super(Seq2SQL_v1_Export, self).__init__()
+        self.max_wn = model.max_wn
+        self.n_cond_ops = model.n_cond_ops
+        self.n_agg_ops = model.n_agg_ops
+        self.hS = model.hS
+        self.lS = model.ls
+
+        self.scp = model.scp
+        self.sap = model.sap
+        self.wnp = model.wnp
+        self.wcp = model.wcp
+        self.wop = model.wop
+        self.wvp = model.wvp
+        for name in ['scp', 'sap', 'wnp', 'wcp', 'wop', 'wvp']:
+            sub = getattr(model, name)
+            setattr(self, f'{name}_enc_n', LSTM_Export(sub.enc_n))
+            setattr(self, f'{name}_enc_h', LSTM_Export(sub.enc_h))
+
+    def forward(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, hd_types):
+        """
+        :param wemb_n: [B, max(l_n), iS]
+        :param l_n: [B]
+        :param wemb_hpu: [sum(l_hs), max(l_hpu), iS]
+        :param l_hpu: [sum(l_hs)]
+        :param l_hs: [B]
+        :param hd_types: [B, max(l_hs)], 1 for 'real' columns and 0 for 'text' columns.
+        """
+        bS = l_n.size(0)
+        mask_n = get_len_mask(l_n, wemb_n.size(1))  # [B, mL_n]
+        mask_hs = get_len_mask(l_hs, hd_types.size(1))  # [B, mL_hs]
+        b_idx = torch.arange(bS, device=l_n.device)
+
+        # sc
+        s_sc = self.forward_sc(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, mask_hs)
+        pr_sc = s_sc.argmax(dim=1)
+
+        # sa
+        s_sa = self.forward_sa(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, pr_sc, hd_types, b_idx)
+
+        # wn
+        s_wn = self.forward_wn(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, mask_hs)
+        pr_wn = s_wn.argmax(dim=1)
+
+        # wc
+        s_wc = self.forward_wc(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, mask_hs)
+        pr_wc, mask_w = self.pred_wc(pr_wn, s_wc)
+
+        # wo
+        s_wo = self.forward_wo(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, pr_wc, mask_w, hd_types)
+        pr_wo = torch.where(mask_w, s_wo.argmax(dim=2), torch.zeros_like(pr_wc))
+
+        # wv
+        s_wv = self.forward_wv(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, pr_wc, pr_wo)
+
+        return s_sc, s_sa, s_wn, s_wc, s_wo, s_wv
+
+    def pred_wc(self, pr_wn, s_wc):
+        """
+        Top-wn columns in increasing column order, padded with column 0 (as the padding in WOP, WVP_se).
+        """
+        # At least max_wn candidates even for narrow tables.
+        s_wc_pad = torch.cat([s_wc, s_wc.new_full((s_wc.size(0), self.max_wn), -1e10)], dim=1)
+        _, idx = s_wc_pad.topk(self.max_wn, dim=1)  # [B, max_wn], sorted by score
+        mask_w = torch.arange(self.max_wn, device=s_wc.device).unsqueeze(0) < pr_wn.unsqueeze(1)
+        big = s_wc_pad.size(1)
+        idx, _ = torch.where(mask_w, idx, idx + big).sort(dim=1)
+        pr_wc = torch.where(mask_w, idx, torch.zeros_like(idx))
+        return pr_wc, mask_w
+
+    def forward_sc(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, mask_hs):
+        scp = self.scp
+        wenc_n = encode_export(self.scp_enc_n, wemb_n, l_n)
+        wenc_hs = encode_hpu_export(self.scp_enc_h, wemb_hpu, l_hpu, l_hs)
+
+        att_h = torch.bmm(wenc_hs, scp.W_att(wenc_n).transpose(1, 2))
+        att_h = att_h.masked_fill(~mask_n.unsqueeze(1), -10000000000)
+        p_n = scp.softmax_dim2(att_h)
+
+        c_n = torch.mul(p_n.unsqueeze(3), wenc_n.unsqueeze(1)).sum(dim=2)
+        vec = torch.cat([scp.W_c(c_n), scp.W_hs(wenc_hs)], dim=2)
+        s_sc = scp.sc_out(vec).squeeze(2)
+
+        return s_sc.masked_fill(~mask_hs, -10000000000)
+
+    def forward_sa(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, pr_sc, hd_types, b_idx):
+        sap = self.sap
+        wenc_n = encode_export(self.sap_enc_n, wemb_n, l_n)
+        wenc_hs = encode_hpu_export(self.sap_enc_h, wemb_hpu, l_hpu, l_hs)
+
+        wenc_hs_ob = wenc_hs[b_idx, pr_sc]
+        att = torch.bmm(sap.W_att(wenc_n), wenc_hs_ob.unsqueeze(2)).squeeze(2)
+        att = att.masked_fill(~mask_n, -10000000000)
+        p = sap.softmax_dim1(att)
+
+        c_n = torch.mul(wenc_n, p.unsqueeze(2).expand_as(wenc_n)).sum(dim=1)
+        s_sa = sap.sa_out(c_n)
+
+        # get_masks_for_SAP: text column -> '' or COUNT only.
+        is_real = hd_types[b_idx, pr_sc].unsqueeze(1) > 0
+        i_agg = torch.arange(self.n_agg_ops, device=s_sa.device).unsqueeze(0)
+        allowed = is_real | (i_agg == 0) | (i_agg == 3)
+        return s_sa.masked_fill(~allowed, float('-inf'))
+
+    def forward_wn(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, mask_hs):
+        wnp = self.wnp
+        wenc_hs = encode_hpu_export(self.wnp_enc_h, wemb_hpu, l_hpu, l_hs)
+
+        att_h = wnp.W_att_h(wenc_hs).squeeze(2)
+        att_h = att_h.masked_fill(~mask_hs, -10000000000)
+        p_h = wnp.softmax_dim1(att_h)
+        c_hs = torch.mul(wenc_hs, p_h.unsqueeze(2)).sum(1)
+
+        hidden = wnp.W_hidden(c_hs).view(-1, self.lS * 2, int(self.hS / 2))
+        hidden = hidden.transpose(0, 1).contiguous()
+        cell = wnp.W_cell(c_hs).view(-1, self.lS * 2, int(self.hS / 2))
+        cell = cell.transpose(0, 1).contiguous()
+
+        wenc_n = encode_export(self.wnp_enc_n, wemb_n, l_n, hc0=(hidden, cell))
+
+        att_n = wnp.W_att_n(wenc_n).squeeze(2)
+        att_n = att_n.masked_fill(~mask_n, -10000000000)
+        p_n = wnp.softmax_dim1(att_n)
+
+        c_n = torch.mul(wenc_n, p_n.unsqueeze(2).expand_as(wenc_n)).sum(dim=1)
+        return wnp.wn_out(c_n)
+
+    def forward_wc(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, mask_hs):
+        wcp = self.wcp
+        wenc_n = encode_export(self.wcp_enc_n, wemb_n, l_n)
+        wenc_hs = encode_hpu_export(self.wcp_enc_h, wemb_hpu, l_hpu, l_hs)
+
+        att = torch.bmm(wenc_hs, wcp.W_att(wenc_n).transpose(1, 2))
+        att = att.masked_fill(~mask_n.unsqueeze(1), -10000000000)
+        p = wcp.softmax_dim2(att)
+
+        c_n = torch.mul(wenc_n.unsqueeze(1), p.unsqueeze(3)).sum(2)
+        y = torch.cat([wcp.W_c(c_n), wcp.W_hs(wenc_hs)], dim=2)
+        score = wcp.W_out(y).squeeze(2)
+
+        return score.masked_fill(~mask_hs, -1e+10)
+
+    def get_wenc_hs_ob(self, wenc_hs, pr_wc):
+        return wenc_hs.gather(1, pr_wc.unsqueeze(2).expand(-1, -1, wenc_hs.size(2)))
+
+    def forward_wo(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, pr_wc, mask_w, hd_types):
+        wop = self.wop
+        wenc_n = encode_export(self.wop_enc_n, wemb_n, l_n)
+        wenc_hs = encode_hpu_export(self.wop_enc_h, wemb_hpu, l_hpu, l_hs)
+        wenc_hs_ob = self.get_wenc_hs_ob(wenc_hs, pr_wc)
+
+        att = torch.matmul(wop.W_att(wenc_n).unsqueeze(1), wenc_hs_ob.unsqueeze(3)).squeeze(3)
+        att = att.masked_fill(~mask_n.unsqueeze(1), -10000000000)
+        p = wop.softmax_dim2(att)
+
+        c_n = torch.mul(wenc_n.unsqueeze(1), p.unsqueeze(3)).sum(dim=2)
+        vec = torch.cat([wop.W_c(c_n), wop.W_hs(wenc_hs_ob)], dim=2)
+        s_wo = wop.wo_out(vec)
+
+        # get_masks_for_WOP: text column -> '=' only, real column -> '=', '>', '<'. 'OP' and unused slots masked.
+        is_real = hd_types.gather(1, pr_wc).unsqueeze(2) > 0
+        i_op = torch.arange(self.n_cond_ops, device=s_wo.device).view(1, 1, -1)
+        allowed = ((is_real & (i_op < 3)) | (i_op == 0)) & mask_w.unsqueeze(2)
+        return s_wo.masked_fill(~allowed, float('-inf'))
+
+    def forward_wv(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, mask_n, pr_wc, pr_wo):
+        wvp = self.wvp
+        wenc_n = encode_export(self.wvp_enc_n, wemb_n, l_n)
+        wenc_hs = encode_hpu_export(self.wvp_enc_h, wemb_hpu, l_hpu, l_hs)
+        wenc_hs_ob = self.get_wenc_hs_ob(wenc_hs, pr_wc)
+
+        att = torch.matmul(wvp.W_att(wenc_n).unsqueeze(1), wenc_hs_ob.unsqueeze(3)).squeeze(3)
+        att = att.masked_fill(~mask_n.unsqueeze(1), -10000000000)
+        p = wvp.softmax_dim2(att)
+
+        c_n = torch.mul(wenc_n.unsqueeze(1), p.unsqueeze(3)).sum(dim=2)
+
+        # one-hot operator. Unused slots are 0, as in WVP_se.
+        i_op = torch.arange(self.n_cond_ops, device=pr_wo.device).view(1, 1, -1)
+        wenc_op = (pr_wo.unsqueeze(2) == i_op).float()
+
+        vec = torch.cat([wvp.W_c(c_n), wvp.W_hs(wenc_hs_ob), wvp.W_op(wenc_op)], dim=2)
+
+        mL_n = wenc_n.size(1)
+        vec1e = vec.unsqueeze(2).expand(-1, -1, mL_n, -1)
+        wenc_ne = wenc_n.unsqueeze(1).expand(-1, self.max_wn, -1, -1)
+        vec2 = torch.cat([vec1e, wenc_ne], dim=3)
+
+        s_wv = wvp.wv_out(vec2)
+        return s_wv.masked_fill(~mask_n.view(mask_n.size(0), 1, -1, 1), -10000000000)
+
+
+class BertModel_Export(nn.Module):
+    """ BertModel returning only the last num_out_layers encoder layers (+ pooled output) as a tuple. """
+    def __init__(self, model_bert, num_out_layers):
+        super(BertModel_Export, self).__init__()
+        self.model_bert = model_bert
+        self.num_out_layers = num_out_layers
+
+    def forward(self, input_ids, token_type_ids, attention_mask):
+        all_encoder_layers, pooled_output = self.model_bert(input_ids, token_type_ids, attention_mask)
+        return tuple(all_encoder_layers[-self.num_out_layers:]) + (pooled_output,)
+
+
+def get_hd_types(tb, l_hs):
+    hd_types = torch.zeros(len(l_hs), max(l_hs), dtype=torch.long)
+    for b, tb1 in enumerate(tb):
+        for i_hd, type1 in enumerate(tb1['types']):
+            hd_types[b, i_hd] = 1 if type1 == 'real' else 0
+    return hd_types
+
+
+def get_seq2sql_inputs(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, tb):
+    dev = wemb_n.device
+    return (wemb_n.float(),
+            torch.tensor(l_n, dtype=torch.long, device=dev),
+            wemb_hpu.float(),
+            torch.tensor(l_hpu, dtype=torch.long, device=dev),
+            torch.tensor(l_hs, dtype=torch.long, device=dev),
+            get_hd_types(tb, l_hs).to(dev))
+
+
+# Runners --------------------------------------------------------------------------------------------------------------
+# Drop-in replacements of model_bert and model for get_wemb_bert and predict().
+
+class ExportedBert:
+    def __init__(self, run, num_hidden_layers, num_out_layers):
+        self.run = run
+        self.num_hidden_layers = num_hidden_layers
+        self.num_out_layers = num_out_layers
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, token_type_ids, attention_mask):
+        outs = self.run(input_ids, token_type_ids, attention_mask)
+        # get_wemb_n / get_wemb_h index all_encoder_layer from the end only.
+        all_encoder_layer = [None] * (self.num_hidden_layers - self.num_out_layers) + list(outs[:-1])
+        return all_encoder_layer, outs[-1]
+
+
+class ExportedSeq2SQL:
+    def __init__(self, run):
+        self.run = run
+
+    def eval(self):
+        return self
+
+    def __call__(self, wemb_n, l_n, wemb_hpu, l_hpu, l_hs, constraint=True, tb=None):
+        if not constraint:
+            raise ValueError("--no-constr needs --backend eager: the exported models are built with the constraints.")
+        assert tb is not None
+        return tuple(self.run(*get_seq2sql_inputs(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, tb)))
+
+    def beam_forward(self, *args, **kwargs):
+        raise ValueError("Execution-guided decoding needs --backend eager.")
+
+
+def get_torchscript_run(path):
+    module = torch.jit.load(path, map_location='cpu')
+    module.eval()
+
+    def run(*inputs):
+        return module(*inputs)
+    return run
+
+
+def get_onnx_run(path):
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess = ort.InferenceSession(path, sess_options, providers=['CPUExecutionProvider'])
+    input_names = [i.name for i in sess.get_inputs()]
+
+    def run(*inputs):
+        feed = dict((name, t.detach().cpu().numpy()) for name, t in zip(input_names, inputs))
+        return [torch.from_numpy(o) for o in sess.run(None, feed)]
+    return run
+
+
+BERT_INPUT_NAMES = ['input_ids', 'token_type_ids', 'attention_mask']
+SEQ2SQL_INPUT_NAMES = ['wemb_n', 'l_n', 'wemb_hpu', 'l_hpu', 'l_hs', 'hd_types']
+SEQ2SQL_OUTPUT_NAMES = ['s_sc', 's_sa', 's_wn', 's_wc', 's_wo', 's_wv']
+
+
+def export_models(path_export, model, model_bert, bert_config, num_target_layers, example_bert_inputs,
+                  example_seq2sql_inputs, onnx=True, opset_version=14):
+    """
+    Trace BertModel and Seq2SQL_v1 into TorchScript (bert.pt, seq2sql.pt) and ONNX (bert.onnx, seq2sql.onnx).
+    Example inputs only fix the graph, not the shapes: batch size, lengths and number of columns stay dynamic.
+    """
+    if not os.path.exists(path_export):
+        os.makedirs(path_export)
+    model.eval()
+    model_bert.eval()
+    bert_export = BertModel_Export(model_bert, num_target_layers).eval()
+    seq2sql_export = Seq2SQL_v1_Export(model).eval()
+
+    with torch.no_grad():
+        traced_bert = torch.jit.trace(bert_export, example_bert_inputs, check_trace=False)
+        traced_bert.save(os.path.join(path_export, 'bert.pt'))
+        traced_seq2sql = torch.jit.trace(seq2sql_export, example_seq2sql_inputs, check_trace=False)
+        traced_seq2sql.save(os.path.join(path_export, 'seq2sql.pt'))
+
+        if onnx:
+            bert_output_names = [f'layer_{i}' for i in range(num_target_layers)] + ['pooled_output']
+            torch.onnx.export(bert_export, example_bert_inputs, os.path.join(path_export, 'bert.onnx'),
+                              input_names=BERT_INPUT_NAMES, output_names=bert_output_names,
+                              dynamic_axes=dict([(name, {0: 'batch', 1: 'seq'}) for name in BERT_INPUT_NAMES]
+                                                + [(name, {0: 'batch', 1: 'seq'}) for name in bert_output_names[:-1]]
+                                                + [('pooled_output', {0: 'batch'})]),
+                              opset_version=opset_version)
+            torch.onnx.export(seq2sql_export, example_seq2sql_inputs, os.path.join(path_export, 'seq2sql.onnx'),
+                              input_names=SEQ2SQL_INPUT_NAMES, output_names=SEQ2SQL_OUTPUT_NAMES,
+                              dynamic_axes={'wemb_n': {0: 'batch', 1: 'mL_n'},
+                                            'l_n': {0: 'batch'},
+                                            'wemb_hpu': {0: 'n_hds', 1: 'mL_hpu'},
+                                            'l_hpu': {0: 'n_hds'},
+                                            'l_hs': {0: 'batch'},
+                                            'hd_types': {0: 'batch', 1: 'mL_hs'},
+                                            's_sc': {0: 'batch', 1: 'mL_hs'},
+                                            's_sa': {0: 'batch'},
+                                            's_wn': {0: 'batch'},
+                                            's_wc': {0: 'batch', 1: 'mL_hs'},
+                                            's_wo': {0: 'batch'},
+                                            's_wv': {0: 'batch', 2: 'mL_n'}},
+                              opset_version=opset_version)
+
+    export_config = {'num_hidden_layers': bert_config.num_hidden_layers,
+                     'num_target_layers': num_target_layers,
+                     'onnx': onnx}
+    with open(os.path.join(path_export, 'export_config.json'), 'w') as f:
+        json.dump(export_config, f)
+
+
+def load_exported_models(path_export, backend):
+    """
+    :param backend: 'torchscript' or 'onnx'. 'onnx' falls back to TorchScript when onnxruntime is not installed. Raises
+                    ValueError when the export has no ONNX models (--no_onnx).
+    :return: model, model_bert usable in place of the eager models in predict().
+    """
+    with open(os.path.join(path_export, 'export_config.json')) as f:
+        export_config = json.load(f)
+
+    if backend == 'onnx' and ort is None:
+        print("onnxruntime is not installed. Falling back to the TorchScript artifacts.")
+        backend = 'torchscript'
+
+    if backend == 'onnx':
+        if not all(os.path.exists(os.path.join(path_export, name)) for name in ['bert.onnx', 'seq2sql.onnx']):
+            raise ValueError(f"{path_export} has no ONNX models (exported with --no_onnx?). "
+                             f"Use --backend torchscript, or export again without --no_onnx.")
+        run_bert = get_onnx_run(os.path.join(path_export, 'bert.onnx'))
+        run_seq2sql = get_onnx_run(os.path.join(path_export, 'seq2sql.onnx'))
+    elif backend == 'torchscript':
+        run_bert = get_torchscript_run(os.path.join(path_export, 'bert.pt'))
+        run_seq2sql = get_torchscript_run(os.path.join(path_export, 'seq2sql.pt'))
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    model_bert = ExportedBert(run_bert, export_config['num_hidden_layers'], export_config['num_target_layers'])
+    model = ExportedSeq2SQL(run_seq2sql)
+    return model, model_bert, backend
@@ -5,7 +5,9 @@
 
 import os, json
 from copy import deepcopy
-from matplotlib.pylab import *
+
+import numpy as np
+from numpy import argmax, array, zeros
 
 import torch
 import torch.nn as nn
@@ -17,6 +19,12 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 from sqlova.utils.utils import topk_multi_dim
 from sqlova.utils.utils_wikisql import *
 
+
+def get_mask_value(x, value=-10000000000):
+    """ Score of masked positions. -1e10 overflows fp16, so clip to the most negative finite value of x.dtype. """
+    return max(value, torch.finfo(x.dtype).min)
+
+
 class Seq2SQL_v1(nn.Module):
     def __init__(self, iS, hS, lS, dr, n_cond_ops, n_agg_ops, old=False):
         '''
@@ -204,12 +212,12 @@ class Seq2SQL_v1(nn.Module):
 
         # Now, Where-clause beam search.
         s_wn = self.wnp(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, show_p_wn=show_p_wn)
-        prob_wn = F.softmax(s_wn, dim=-1).detach().to('cpu').numpy()
+        prob_wn = F.softmax(s_wn, dim=-1).detach().float().to('cpu').numpy()
 
         # Found "executable" most likely 4(=max_num_of_conditions) where-clauses.
         # wc
         s_wc = self.wcp(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, show_p_wc=show_p_wc, penalty=True)  # [batch, max_header_number]
-        prob_wc = F.sigmoid(s_wc).detach().to('cpu').numpy()
+        prob_wc = F.sigmoid(s_wc).detach().float().to('cpu').numpy()
         # pr_wc_sorted_by_prob = pred_wc_sorted_by_prob(s_wc)
 
         # get max_wn # of most probable columns & their prob.
@@ -225,7 +233,7 @@ class Seq2SQL_v1(nn.Module):
         # wo
         s_wo_max = self.wop(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, wn=pr_wn_max, wc=pr_wc_max, show_p_wo=show_p_wo,
                             constraint=constraint, tb=tb)
-        prob_wo_max = F.softmax(s_wo_max, dim=-1).detach().to('cpu').numpy()
+        prob_wo_max = F.softmax(s_wo_max, dim=-1).detach().float().to('cpu').numpy()
         # [B, max_wn, n_cond_op]
 
         pr_wvi_beam_op_list = []
@@ -235,7 +243,7 @@ class Seq2SQL_v1(nn.Module):
             pr_wo_temp = [ [i_op]*self.max_wn ]*bS
             # wv
             s_wv = self.wvp(wemb_n, l_n, wemb_hpu, l_hpu, l_hs, wn=pr_wn_max, wc=pr_wc_max, wo=pr_wo_temp, show_p_wv=show_p_wv)
-            prob_wv = F.softmax(s_wv, dim=-2).detach().to('cpu').numpy()    # [bS, max_wn=4, max_q_length, 2]
+            prob_wv = F.softmax(s_wv, dim=-2).detach().float().to('cpu').numpy()    # [bS, max_wn=4, max_q_length, 2]
 
             # prob_wv
             pr_wvi_beam, prob_wvi_beam = pred_wvi_se_beam(self.max_wn, s_wv, beam_size)
@@ -364,10 +372,11 @@ class SCP(nn.Module):
         #   Penalty on blank parts
         for b, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                att_h[b, :, l_n1:] = -10000000000
+                att_h[b, :, l_n1:] = get_mask_value(att_h)
 
         p_n = self.softmax_dim2(att_h)
         if show_p_sc:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot2grid, title
             # p = [b, hs, n]
             if p_n.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
@@ -400,7 +409,7 @@ class SCP(nn.Module):
         mL_hs = max(l_hs)
         for b, l_hs1 in enumerate(l_hs):
             if l_hs1 < mL_hs:
-                s_sc[b, l_hs1:] = -10000000000
+                s_sc[b, l_hs1:] = get_mask_value(s_sc)
 
         return s_sc
 
@@ -460,11 +469,12 @@ class SAP(nn.Module):
         #   Penalty on blank parts
         for b, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                att[b, l_n1:] = -10000000000
+                att[b, l_n1:] = get_mask_value(att)
         # [bS, mL_n]
         p = self.softmax_dim1(att)
 
         if show_p_sa:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot, title
             if p.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
             fig=figure(2001);
@@ -540,10 +550,11 @@ class WNP(nn.Module):
         #   Penalty
         for b, l_hs1 in enumerate(l_hs):
             if l_hs1 < mL_hs:
-                att_h[b, l_hs1:] = -10000000000
+                att_h[b, l_hs1:] = get_mask_value(att_h)
         p_h = self.softmax_dim1(att_h)
 
         if show_p_wn:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot, title
             if p_h.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
             fig=figure(2001);
@@ -579,10 +590,11 @@ class WNP(nn.Module):
         #    Penalty
         for b, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                att_n[b, l_n1:] = -10000000000
+                att_n[b, l_n1:] = get_mask_value(att_n)
         p_n = self.softmax_dim1(att_n)
 
         if show_p_wn:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot, title
             if p_n.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
             fig=figure(2001);
@@ -662,12 +674,13 @@ class WCP(nn.Module):
         mL_n = max(l_n)  # 31
         for b_n, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                att[b_n, :, l_n1:] = -10000000000
+                att[b_n, :, l_n1:] = get_mask_value(att)
 
         # make p(j_n | i_h)
         p = self.softmax_dim2(att)  # [32,17,31]
 
         if show_p_wc:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot2grid, title
             # p = [b, hs, n]
             if p.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
@@ -697,7 +710,7 @@ class WCP(nn.Module):
 
         if penalty:
             for b, l_hs1 in enumerate(l_hs):
-                score[b, l_hs1:] = -1e+10
+                score[b, l_hs1:] = get_mask_value(score)
 
         return score
 
@@ -775,10 +788,11 @@ class WOP(nn.Module):
         mL_n = max(l_n)
         for b, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                att[b, :, l_n1:] = -10000000000
+                att[b, :, l_n1:] = get_mask_value(att)
 
         p = self.softmax_dim2(att)  # p( n| selected_col )
         if show_p_wo:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot2grid, title
             # p = [b, hs, n]
             if p.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
@@ -907,11 +921,12 @@ class WVP_se(nn.Module):
         mL_n = max(l_n)
         for b, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                att[b, :, l_n1:] = -10000000000
+                att[b, :, l_n1:] = get_mask_value(att)
 
         p = self.softmax_dim2(att)  # p( n| selected_col )
 
         if show_p_wv:
+            from matplotlib.pylab import cla, figure, grid, plot, show, subplot2grid, title
             # p = [b, hs, n]
             if p.shape[0] != 1:
                 raise Exception("Batch size should be 1.")
@@ -980,7 +995,7 @@ class WVP_se(nn.Module):
         # penalty for spurious tokens
         for b, l_n1 in enumerate(l_n):
             if l_n1 < mL_n:
-                s_wv[b, :, l_n1:, :] = -10000000000
+                s_wv[b, :, l_n1:, :] = get_mask_value(s_wv)
         return s_wv
 
 def Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi):
@@ -991,13 +1006,16 @@ def Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo,
     :param g_wvi: [B, conds, pnt], e.g. [[[0, 6, 7, 8, 15], [0, 1, 2, 3, 4, 15]], [[0, 1, 2, 3, 16], [0, 7, 8, 9, 16]]]
     :return:
     """
-    loss = 0
-    loss += Loss_sc(s_sc, g_sc)
-    loss += Loss_sa(s_sa, g_sa)
-    loss += Loss_wn(s_wn, g_wn)
-    loss += Loss_wc(s_wc, g_wc)
-    loss += Loss_wo(s_wo, g_wn, g_wo)
-    loss += Loss_wv_se(s_wv, g_wn, g_wvi)
+    # Scores may be bf16 / fp16 under autocast. Compute the loss in fp32.
+    with torch.autocast(device_type=s_sc.device.type, enabled=False):
+        s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = [s.float() for s in [s_sc, s_sa, s_wn, s_wc, s_wo, s_wv]]
+        loss = 0
+        loss += Loss_sc(s_sc, g_sc)
+        loss += Loss_sa(s_sa, g_sa)
+        loss += Loss_wn(s_wn, g_wn)
+        loss += Loss_wc(s_wc, g_wc)
+        loss += Loss_wo(s_wo, g_wn, g_wo)
+        loss += Loss_wv_se(s_wv, g_wn, g_wvi)
 
     return loss
 
@@ -1716,7 +1734,7 @@ class FT_Scalar_1(nn.Module):
         idx_ed = 1 + self.n_agg_ops
 
         s_wn = self.wnp(cls_vec)
-        prob_wn = F.softmax(s_wn, dim=-1).detach().to('cpu').numpy()
+        prob_wn = F.softmax(s_wn, dim=-1).detach().float().to('cpu').numpy()
 
         # Found "executable" most likely 4(=max_num_of_conditions) where-clauses.
         # wc
@@ -1724,7 +1742,7 @@ class FT_Scalar_1(nn.Module):
         idx_ed = idx_st + 1
 
         s_wc = self.wcp(wemb_h, l_hs, idx_st, idx_ed)
-        prob_wc = torch.sigmoid(s_wc).detach().to('cpu').numpy()
+        prob_wc = torch.sigmoid(s_wc).detach().float().to('cpu').numpy()
         # pr_wc_sorted_by_prob = pred_wc_sorted_by_prob(s_wc)
 
         # get max_wn # of most probable columns & their prob.
@@ -1739,7 +1757,7 @@ class FT_Scalar_1(nn.Module):
         idx_st = idx_ed + 1
         idx_ed = idx_st + self.n_cond_ops
         s_wo_max = self.wop(wemb_h, pr_wc_max, idx_st, idx_ed)
-        prob_wo_max = F.softmax(s_wo_max, dim=-1).detach().to('cpu').numpy()
+        prob_wo_max = F.softmax(s_wo_max, dim=-1).detach().float().to('cpu').numpy()
         # [B, n_where_num, n_cond_op]
 
         pr_wvi_beam_op_list = []
@@ -1752,7 +1770,7 @@ class FT_Scalar_1(nn.Module):
             pr_wo_temp = [[i_op] * self.n_where_num] * bS
             # wv
             s_wv = self.wvp(wemb_n, l_n, pr_wc_max)
-            prob_wv = F.softmax(s_wv, dim=-2).detach().to('cpu').numpy()
+            prob_wv = F.softmax(s_wv, dim=-2).detach().float().to('cpu').numpy()
 
             # prob_wv
             pr_wvi_beam, prob_wvi_beam, prob_wvi_beam_st, prob_wvi_beam_ed = pred_wvi_se_beam(self.n_where_num, s_wv, beam_size)
@@ -0,0 +1,141 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Tokenizers for annotate_ws.py. An annotator turns a sentence into the CoreNLP token fields WikiSQL uses:
+#   gloss: original text of the tokens, words: normalized (and lower-cased) tokens, after: whitespace following them.
+#
+#   corenlp: CoreNLP server over HTTP (stanza CoreNLPClient), e.g. docker run -p 9000:9000 vzhong/corenlp-server
+#   local  : in-process re-implementation of the PTB tokenization rules CoreNLP applies to WikiSQL questions, headers
+#            and where-values. No Java server, no HTTP round trip per call.
+# compare_annotators reports where two annotators differ, e.g. local against corenlp on a sample of a split.
+import re
+
+ANNOTATORS = ['corenlp', 'local']
+
+# Abbreviations keeping their period.
+ABBREVIATIONS = {'mr', 'mrs', 'ms', 'dr', 'prof', 'st', 'jr', 'sr', 'vs', 'no', 'inc', 'co', 'corp', 'ltd', 'mt',
+                 'ft', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec', 'gen',
+                 'gov', 'sen', 'rep', 'rev', 'lt', 'col', 'sgt', 'capt', 'bros', 'est', 'ave', 'blvd', 'etc'}
+
+TOKEN_RE = re.compile(r"""
+    (?:[A-Za-z]\.){2,}                              # U.S., a.m.
+  | \b(?:""" + '|'.join(sorted(ABBREVIATIONS, key=len, reverse=True)) + r""")\.(?=\s|$)   # St., Jr.
+  | ['’]\d0s\b                                 # '90s
+  | \w+(?=n['’]t\b)                            # do|n't, ca|n't
+  | n['’]t\b
+  | ['’](?:s|re|ve|ll|d|m)\b                   # 's, 're, ...
+  | \w+(?:(?:[-/&.,:+]|['’](?!(?:s|re|ve|ll|d|m)\b))\w+)*   # words, numbers (1,000.5 10:30 1/2), hyphenated, O'Neil
+  | \.{2,}|-{2,}                                    # ..., --
+  | \S                                              # any other symbol on its own: ( ) , ? " $ % ...
+""", re.VERBOSE | re.IGNORECASE)
+
+# Numbers keep their commas, other words are split at them: 1,000 but a , b.
+COMMA_SPLIT_RE = re.compile(r'(?<=\D),|,(?=\D)')
+
+PTB_ESCAPES = {'(': '-LRB-', ')': '-RRB-', '[': '-LSB-', ']': '-RSB-', '{': '-LCB-', '}': '-RCB-'}
+
+
+def split_commas(text, st):
+    """ (start, end) of the parts of a word split at the commas outside of numbers. """
+    spans = []
+    ed_prev = 0
+    for m in COMMA_SPLIT_RE.finditer(text):
+        spans.append((st + ed_prev, st + m.start()))
+        spans.append((st + m.start(), st + m.end()))
+        ed_prev = m.end()
+    spans.append((st + ed_prev, st + len(text)))
+    return [span for span in spans if span[1] > span[0]]
+
+
+def normalize(token, opening):
+    """ words field of a token. opening: the token starts a word, i.e. a quote there is an opening quote. """
+    if token in PTB_ESCAPES:
+        return PTB_ESCAPES[token]
+    if token in ('"', '“', '”'):
+        return '``' if opening else "''"
+    if token in ("'", '‘', '’'):
+        return '`' if opening else "'"
+    return token.replace('’', "'")
+
+
+class LocalAnnotator:
+    def annotate(self, sentence, lower=True):
+        spans = []
+        for m in TOKEN_RE.finditer(sentence):
+            st, ed = m.span()
+            if ',' in m.group() and len(m.group()) > 1:
+                spans += split_commas(m.group(), st)
+            else:
+                spans.append((st, ed))
+
+        words, gloss, after = [], [], []
+        for i, (st, ed) in enumerate(spans):
+            opening = st == 0 or sentence[st - 1].isspace() or sentence[st - 1] in '([{'
+            gloss.append(sentence[st:ed])
+            words.append(normalize(sentence[st:ed], opening))
+            after.append(sentence[ed:spans[i + 1][0]] if i + 1 < len(spans) else sentence[ed:])
+        if lower:
+            words = [w.lower() for w in words]
+        return {
+            'gloss': gloss,
+            'words': words,
+            'after': after,
+            }
+
+
+class CoreNLPAnnotator:
+    def __init__(self, **kwargs):
+        """ :param kwargs: of CoreNLPClient, e.g. server='http://localhost:9000' """
+        self.kwargs = kwargs
+        self.client = None
+
+    def annotate(self, sentence, lower=True):
+        if self.client is None:
+            # Connects lazily, e.g. once per worker process.
+            from stanza.nlp.corenlp import CoreNLPClient
+            self.client = CoreNLPClient(default_annotators='ssplit,tokenize'.split(','), **self.kwargs)
+        words, gloss, after = [], [], []
+        for s in self.client.annotate(sentence):
+            for t in s:
+                words.append(t.word)
+                gloss.append(t.originalText)
+                after.append(t.after)
+        if lower:
+            words = [w.lower() for w in words]
+        return {
+            'gloss': gloss,
+            'words': words,
+            'after': after,
+            }
+
+
+def get_annotator(name, **kwargs):
+    if name == 'corenlp':
+        return CoreNLPAnnotator(**kwargs)
+    elif name == 'local':
+        return LocalAnnotator()
+    else:
+        raise ValueError(f"Unknown annotator {name}. Choose from {ANNOTATORS}")
+
+
+def compare_annotators(sentences, ann_ref, ann_test, n_examples=10):
+    """
+    :param sentences: e.g. questions and where-values of a split.
+    :return: {'n': # of sentences, 'mismatch': {field: # of sentences that differ}, 'mismatch_any': ..,
+              'examples': the first n_examples mismatches}
+    """
+    fields = ['gloss', 'words', 'after']
+    stats = {'n': 0, 'mismatch': {field: 0 for field in fields}, 'mismatch_any': 0, 'examples': []}
+    for sentence in sentences:
+        a_ref = ann_ref.annotate(sentence)
+        a_test = ann_test.annotate(sentence)
+        stats['n'] += 1
+        diff = [field for field in fields if a_ref[field] != a_test[field]]
+        for field in diff:
+            stats['mismatch'][field] += 1
+        if diff:
+            stats['mismatch_any'] += 1
+            if len(stats['examples']) < n_examples:
+                stats['examples'].append({'sentence': sentence, 'ref': a_ref['gloss'], 'test': a_test['gloss'],
+                                          'fields': diff})
+    return stats
@@ -0,0 +1,156 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Cached BERT features, for training the sequence-to-SQL module without fine-tuning BERT.
+#
+# BERT is run once over a split (extract_bert_features.py) and the last num_target_layers layers of the
+# question and header tokens are stored as fp16 arrays, which are memory-mapped at training time:
+#   <path>/meta.json       bert_type, max_seq_length, num_target_layers, hidden size, # of examples / tokens
+#   <path>/question.f16    [# of question tokens of the split, hS * num_target_layers]
+#   <path>/header.f16      [# of header tokens of the split, hS * num_target_layers]
+#   <path>/index.npz       l_n, l_hpu, l_hs, t_to_tt_idx (flattened) and the offsets into the arrays above
+#   <path>/keys.json       (table_id, question) of each example
+# Layers are concatenated as in get_wemb_n / get_wemb_h (last layer first), so that fewer layers can be read
+# from the same features.
+import json
+import os
+
+import numpy as np
+import torch
+
+from .utils_wikisql import get_bert_output
+from .precision import autocast
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_key(t1):
+    return t1['table_id'], t1['question']
+
+
+def extract_bert_features(data_loader, model_bert, bert_config, path, num_target_layers, max_seq_length,
+                          bert_type='', precision='fp32'):
+    """
+    :param data_loader: batches of collate_wikisql.
+    :param precision: autocast of BERT (see sqlova.utils.precision). The features are stored in fp16 anyway.
+    """
+    os.makedirs(path, exist_ok=True)
+    hS = bert_config.hidden_size
+    n_layers = bert_config.num_hidden_layers
+    keys = []
+    l_n, l_hpu, l_hs, t_to_tt_idx = [], [], [], []
+
+    model_bert.eval()
+    with open(os.path.join(path, 'question.f16'), 'wb') as f_n, \
+            open(os.path.join(path, 'header.f16'), 'wb') as f_h, torch.no_grad():
+        for batch in data_loader:
+            with autocast(precision, device):
+                bert_output = get_bert_output(model_bert, None, batch['nlu_t'], batch['hds'], max_seq_length,
+                                              bert_input=batch['bert_input'])
+            all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, \
+            l_n1, l_hpu1, l_hs1, nlu_tt, t_to_tt_idx1, tt_to_t_idx = bert_output
+
+            # [B, max_seq_length, hS * num_target_layers], last layer first.
+            layers = torch.cat([all_encoder_layer[n_layers - 1 - i] for i in range(num_target_layers)], dim=-1)
+            layers = layers.half().cpu().numpy()
+            for b in range(len(i_nlu)):
+                st, ed = i_nlu[b]
+                f_n.write(layers[b, st:ed].tobytes())
+                for st, ed in i_hds[b]:
+                    f_h.write(layers[b, st:ed].tobytes())
+
+            keys += [get_key(t1) for t1 in batch['t']]
+            l_n += l_n1
+            l_hpu += l_hpu1
+            l_hs += l_hs1
+            t_to_tt_idx += t_to_tt_idx1
+
+    np.savez(os.path.join(path, 'index.npz'),
+             l_n=np.array(l_n, dtype=np.int64),
+             l_hpu=np.array(l_hpu, dtype=np.int64),
+             l_hs=np.array(l_hs, dtype=np.int64),
+             t_to_tt_idx=np.array([i for idx1 in t_to_tt_idx for i in idx1], dtype=np.int64),
+             l_t=np.array([len(idx1) for idx1 in t_to_tt_idx], dtype=np.int64))
+    with open(os.path.join(path, 'keys.json'), 'w') as f:
+        json.dump(keys, f)
+    meta = {'bert_type': bert_type,
+            'max_seq_length': max_seq_length,
+            'num_target_layers': num_target_layers,
+            'hidden_size': hS,
+            'n_examples': len(keys),
+            'n_question_tokens': sum(l_n),
+            'n_header_tokens': sum(l_hpu)}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def get_offsets(lengths):
+    return np.concatenate([[0], np.cumsum(lengths)])
+
+
+class BertFeatures:
+    """ Features of a split written by extract_bert_features. Looked up by (table_id, question) of the examples. """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['hidden_size'] * self.meta['num_target_layers']
+
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.l_n = index['l_n']
+        self.l_hpu = index['l_hpu']
+        self.l_hs = index['l_hs']
+        self.t_to_tt_idx = index['t_to_tt_idx']
+        self.off_n = get_offsets(self.l_n)
+        self.off_h = get_offsets(self.l_hpu)  # per header
+        self.off_hs = get_offsets(self.l_hs)  # per example, into the headers
+        self.off_t = get_offsets(index['l_t'])
+
+        # Read lazily by the OS, shared between processes.
+        self.question = np.memmap(os.path.join(path, 'question.f16'), dtype=np.float16, mode='r',
+                                  shape=(self.meta['n_question_tokens'], self.dim))
+        self.header = np.memmap(os.path.join(path, 'header.f16'), dtype=np.float16, mode='r',
+                                shape=(self.meta['n_header_tokens'], self.dim))
+
+        with open(os.path.join(path, 'keys.json')) as f:
+            self.key_to_idx = {tuple(key): i for i, key in enumerate(json.load(f))}
+
+    def check(self, bert_type, max_seq_length, num_target_layers):
+        meta = self.meta
+        if meta['bert_type'] != bert_type or meta['max_seq_length'] != max_seq_length:
+            raise ValueError(f"Features were extracted with {meta['bert_type']}, max_seq_length "
+                             f"{meta['max_seq_length']}, not {bert_type}, {max_seq_length}")
+        if meta['num_target_layers'] < num_target_layers:
+            raise ValueError(f"Features hold {meta['num_target_layers']} layers, {num_target_layers} requested")
+
+    def get_idx(self, t):
+        try:
+            return [self.key_to_idx[get_key(t1)] for t1 in t]
+        except KeyError as e:
+            raise KeyError(f"No features for example {e}. Extract the features of this split again.") from None
+
+    def get_wemb(self, t, num_out_layers_n=1, num_out_layers_h=1):
+        """
+        Same as get_wemb_bert, from the features.
+        :return: wemb_n, wemb_h, l_n, l_hpu, l_hs, t_to_tt_idx
+        """
+        hS = self.meta['hidden_size']
+        idx = self.get_idx(t)
+
+        l_n = [int(self.l_n[i]) for i in idx]
+        wemb_n = np.zeros([len(idx), max(l_n), hS * num_out_layers_n], dtype=np.float32)
+        for b, i in enumerate(idx):
+            wemb_n[b, :l_n[b]] = self.question[self.off_n[i]:self.off_n[i + 1], :hS * num_out_layers_n]
+
+        l_hs = [int(self.l_hs[i]) for i in idx]
+        i_hd = [j for i in idx for j in range(self.off_hs[i], self.off_hs[i + 1])]
+        l_hpu = [int(self.l_hpu[j]) for j in i_hd]
+        wemb_h = np.zeros([len(i_hd), max(l_hpu), hS * num_out_layers_h], dtype=np.float32)
+        for b_pu, j in enumerate(i_hd):
+            wemb_h[b_pu, :l_hpu[b_pu]] = self.header[self.off_h[j]:self.off_h[j + 1], :hS * num_out_layers_h]
+
+        t_to_tt_idx = [self.t_to_tt_idx[self.off_t[i]:self.off_t[i + 1]].tolist() for i in idx]
+
+        wemb_n = torch.from_numpy(wemb_n).to(device, non_blocking=True)
+        wemb_h = torch.from_numpy(wemb_h).to(device, non_blocking=True)
+        return wemb_n, wemb_h, l_n, l_hpu, l_hs, t_to_tt_idx
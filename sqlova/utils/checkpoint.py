@@ -0,0 +1,297 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Checkpoint loading and saving.
+#
+# Fast load: modules are built on the meta device (no allocation, no random init) and the loaded
+# tensors are assigned to them directly. torch.save files are memory-mapped, so the weights are paged
+# in from the file instead of being read into RAM and then copied into freshly initialized modules.
+#
+# Flat archive (*.safetensors): an 8-byte little-endian header length, a JSON header
+# {name: {dtype, shape, data_offsets}} and the raw tensor bytes back to back. It is the safetensors
+# layout, so the files can also be read with the safetensors package, but no extra dependency is needed here.
+# Convert an existing checkpoint with:
+#   python -m sqlova.utils.checkpoint ./saved/model_bert_best.pt ./saved/model_bert_best.safetensors
+#
+# CheckpointWriter: copies state dicts to CPU memory on the training thread and writes them in a background
+# thread, so that training goes on during the write.
+import argparse
+import atexit
+import inspect
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+
+FLAT_EXT = '.safetensors'
+SAVE_FORMATS = ['torch', 'flat']
+
+DTYPE_TO_STR = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+STR_TO_DTYPE = dict((v, k) for k, v in DTYPE_TO_STR.items())
+
+
+def is_fast_load_supported():
+    """ Needs `with torch.device('meta')`, load_state_dict(assign=True) and torch.load(mmap=True) (torch >= 2.1). """
+    return hasattr(torch.device, '__enter__') \
+           and 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters \
+           and 'mmap' in inspect.signature(torch.load).parameters
+
+
+@contextmanager
+def init_empty(enabled=True):
+    """ Modules built inside are on the meta device: no memory is allocated and no init is run. """
+    if enabled:
+        with torch.device('meta'):
+            yield
+    else:
+        yield
+
+
+def is_flat_archive(path):
+    return path.endswith(FLAT_EXT)
+
+
+def load_checkpoint(path, key=None, use_mmap=True):
+    """
+    Load a state_dict on the CPU from a torch.save file or a flat archive.
+    :param key: for torch.save files holding {key: state_dict}, e.g. 'model' or 'model_bert'.
+    :param use_mmap: memory-map the file instead of reading it into RAM.
+    """
+    if is_flat_archive(path):
+        return load_flat(path, use_mmap=use_mmap)
+
+    res = None
+    if use_mmap and 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            res = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            # Legacy (non-zip) torch.save format cannot be memory-mapped.
+            pass
+    if res is None:
+        res = torch.load(path, map_location='cpu')
+
+    if key is not None and key in res:
+        res = res[key]
+    return res
+
+
+def load_model_state(module, state_dict, assign=False):
+    """
+    :param assign: use the loaded tensors as the parameters (for modules built with init_empty)
+                   instead of copying them into the existing ones.
+    """
+    if assign:
+        module.load_state_dict(state_dict, assign=True)
+        meta = [name for name, t in list(module.named_parameters()) + list(module.named_buffers()) if t.is_meta]
+        if meta:
+            raise RuntimeError(f"Not found in the checkpoint: {', '.join(meta)}")
+    else:
+        module.load_state_dict(state_dict)
+    return module
+
+
+def get_checkpoint_path(path, save_format='torch'):
+    """ The flat archive replaces the extension of path with .safetensors. """
+    if save_format == 'flat':
+        return os.path.splitext(path)[0] + FLAT_EXT
+    elif save_format == 'torch':
+        return path
+    raise ValueError(f"Unknown save format: {save_format}")
+
+
+def save_checkpoint(path, key, state_dict, save_format='torch', replace=True):
+    """
+    The file is written to <path>.tmp, then renamed.
+    :param path: path of the torch.save file. The flat archive replaces its extension with .safetensors.
+    :param key: the file holds {key: state_dict}. None: torch.save(state_dict) as is (e.g. a training state).
+    :param replace: False: leave the complete file at <path>.tmp, for the caller to rename (see CheckpointWriter).
+    :return: path actually written.
+    """
+    path = get_checkpoint_path(path, save_format)
+    path_tmp = path + '.tmp'
+    if save_format == 'flat':
+        write_flat(path_tmp, state_dict)
+    else:
+        torch.save({key: state_dict} if key is not None else state_dict, path_tmp)
+    if not replace:
+        return path_tmp
+    os.replace(path_tmp, path)
+    return path
+
+
+def save_flat(path, state_dict):
+    path_tmp = path + '.tmp'
+    write_flat(path_tmp, state_dict)
+    os.replace(path_tmp, path)
+
+
+def write_flat(path, state_dict):
+    # Larger dtypes first, so every tensor stays aligned to its element size without padding.
+    items = sorted(state_dict.items(), key=lambda x: (-x[1].element_size(), x[0]))
+
+    header = OrderedDict()
+    offset = 0
+    for name, t in items:
+        nbytes = t.numel() * t.element_size()
+        header[name] = {'dtype': DTYPE_TO_STR[t.dtype], 'shape': list(t.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, t in items:
+            if t.numel() > 0:
+                f.write(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().data)
+
+
+def load_flat(path, use_mmap=True):
+    with open(path, 'rb') as f:
+        n_header = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n_header))
+        if use_mmap:
+            # Copy-on-write mapping: tensors are writable, pages are read lazily and the file is never modified.
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            f.seek(0)
+            buf = bytearray(f.read())
+    st = 8 + n_header
+
+    state_dict = OrderedDict()
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = STR_TO_DTYPE[info['dtype']]
+        b, e = info['data_offsets']
+        if e > b:
+            t = torch.frombuffer(buf, dtype=dtype, count=(e - b) // torch.empty(0, dtype=dtype).element_size(),
+                                 offset=st + b)
+        else:
+            t = torch.empty(0, dtype=dtype)
+        state_dict[name] = t.reshape(info['shape'])
+    return state_dict
+
+
+def to_cpu_copy(obj):
+    """ Copy of the tensors in (nested dicts / lists of) obj on CPU, e.g. a state_dict or an optimizer state. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return obj.__class__((k, to_cpu_copy(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu_copy(v) for v in obj)
+    return obj
+
+
+def rotate(path, keep_last):
+    """ path -> root.1.ext -> root.2.ext ... keeping keep_last versions in total (path included). """
+    root, ext = os.path.splitext(path)
+    versions = [path] + [f'{root}.{i}{ext}' for i in range(1, keep_last)]
+    for i in reversed(range(1, len(versions))):
+        if os.path.exists(versions[i - 1]):
+            os.replace(versions[i - 1], versions[i])
+
+
+class CheckpointWriter:
+    """
+    save() snapshots the state to CPU memory and returns; a background thread writes it (atomic rename).
+    Write errors are raised by the next save() / wait().
+
+    :param keep_last: the previous versions of a file are kept as root.1.ext, root.2.ext, ... (N in total).
+    :param max_pending: save() blocks while this many snapshots wait to be written. Bounds the CPU memory held.
+    """
+    def __init__(self, save_format='torch', keep_last=1, max_pending=1):
+        self.save_format = save_format
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.metrics = []  # {'path', 'snapshot_s', 'write_s', 'mb'} of each finished write
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            path, key, state, save_format, t_snapshot = item
+            try:
+                t_st = time.time()
+                path_out = get_checkpoint_path(path, save_format)
+                # The new file is complete before the current one is rotated away: path_out always holds a
+                # whole checkpoint, even if the write fails or the process dies.
+                path_tmp = save_checkpoint(path, key, state, save_format, replace=False)
+                if self.keep_last > 1:
+                    rotate(path_out, self.keep_last)
+                os.replace(path_tmp, path_out)
+                self.metrics.append({'path': path_out, 'snapshot_s': t_snapshot, 'write_s': time.time() - t_st,
+                                     'mb': os.path.getsize(path_out) / 1024 / 1024})
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Checkpoint write failed") from error
+
+    def save(self, path, key, state_dict, save_format=None):
+        """ Same arguments as save_checkpoint. Blocks only for the copy to CPU memory. """
+        self.check_error()
+        t_st = time.time()
+        state = to_cpu_copy(state_dict)
+        self.queue.put((path, key, state, save_format or self.save_format, time.time() - t_st))
+
+    def wait(self):
+        """ Block until every snapshot so far is written. """
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check_error()
+
+    def summary(self):
+        if not self.metrics:
+            return "Checkpoint writes: none finished"
+        m = self.metrics[-1]
+        return f"Checkpoint writes: {len(self.metrics)} finished, last {m['path']} ({m['mb']:.0f} MB): " \
+               f"training blocked {m['snapshot_s']:.2f} s, background write {m['write_s']:.2f} s"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a torch.save checkpoint to a flat archive.')
+    parser.add_argument('fin', help='torch.save checkpoint, e.g. model_bert_best.pt')
+    parser.add_argument('fout', help='flat archive, e.g. model_bert_best.safetensors')
+    args = parser.parse_args()
+
+    res = load_checkpoint(args.fin)
+    if 'model' in res or 'model_bert' in res:
+        res = res.get('model', res.get('model_bert'))
+    save_flat(args.fout, res)
+    print(f"Wrote {len(res)} tensors to {args.fout}")
@@ -0,0 +1,135 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Multi-process data-parallel training (DistributedDataParallel on the gloo backend).
+#
+# Launch one process per rank with torchrun, e.g. 4 processes on one machine:
+#   torchrun --nproc_per_node=4 train.py --bS 8 ...
+# or over 2 machines:
+#   torchrun --nnodes=2 --node_rank=0 --nproc_per_node=4 --master_addr=HOST --master_port=29500 train.py ...
+# Without torchrun (WORLD_SIZE unset or 1), everything below is a no-op and training runs in a single process.
+import os
+from contextlib import ExitStack
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(timeout_min=120):
+    """
+    Join the process group described by the torchrun environment variables (RANK, WORLD_SIZE, LOCAL_RANK, ...).
+    :param timeout_min: timeout of collective calls. Ranks may wait on each other during the dev evaluation.
+    :return: True when running distributed.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        # torch.device("cuda") used across sqlova then refers to the GPU of this rank.
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    elif 'OMP_NUM_THREADS' not in os.environ:
+        # Share the cores of the machine between its ranks instead of oversubscribing them.
+        n_local = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_local))
+
+    dist.init_process_group(backend='gloo', timeout=timedelta(minutes=timeout_min))
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_ddp(module, find_unused_parameters=False):
+    """
+    Gradients are all-reduced (averaged) across ranks during backward.
+    A module without trainable parameters (e.g. the shallow layer, a frozen BERT) is returned as is.
+    :param find_unused_parameters: some parameters may get no gradient in a batch, e.g. the BERT pooler when only the
+                                   encoder layers are read. Costs a traversal of the autograd graph per backward.
+    """
+    if not is_distributed() or not any(p.requires_grad for p in module.parameters()):
+        return module
+    return DistributedDataParallel(module, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap(module):
+    """ The underlying module, e.g. for state_dict() (without the 'module.' prefix) and evaluation. """
+    return module.module if isinstance(module, DistributedDataParallel) else module
+
+
+def no_sync(*modules):
+    """
+    Context without the gradient all-reduce of the DDP modules among them: the gradients accumulate locally and
+    are all-reduced by the backward of the next batch run outside of it. Forward and backward go inside.
+    """
+    stack = ExitStack()
+    for module in modules:
+        if isinstance(module, DistributedDataParallel):
+            stack.enter_context(module.no_sync())
+    return stack
+
+
+def get_eval_sampler(data):
+    """
+    Strided shard (rank, rank + world_size, ...) without the padding of the train sampler, so that every example
+    is evaluated exactly once. See gather_results for the inverse.
+    """
+    if not is_distributed():
+        return None
+    return list(range(get_rank(), len(data), get_world_size()))
+
+
+def set_epoch(data_loader, epoch):
+    sampler = getattr(data_loader, 'sampler', None)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
+
+
+def all_reduce_sum(values):
+    """
+    Sum a list of numbers (counters, losses) over ranks.
+    :return: list of sums. ints stay ints.
+    """
+    if not is_distributed():
+        return values
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return [int(round(s)) if isinstance(v, int) else s for v, s in zip(values, t.tolist())]
+
+
+def all_gather_object(obj):
+    """ [obj of rank 0, obj of rank 1, ...] on every rank. """
+    if not is_distributed():
+        return [obj]
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def gather_results(results):
+    """ Results of a strided shard (get_eval_sampler, one entry per example) from all ranks, in the original order. """
+    if not is_distributed():
+        return results
+    results_all = all_gather_object(results)
+    n = sum(len(results1) for results1 in results_all)
+    return [results_all[i % len(results_all)][i // len(results_all)] for i in range(n)]
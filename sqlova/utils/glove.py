@@ -0,0 +1,146 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# GloVe subset (w2i.json, wemb.npy) of the words of WikiSQL, as in SQLNet.
+#
+# The GloVe text file is converted once into a .npy matrix and a vocabulary file (one word per line, the row of
+# the vector), which WordVectors memory-maps: no 2M-entry dict of vectors is built in memory.
+#   python -m sqlova.utils.glove convert ./data/glove.840B.300d.txt ./data/glove
+#   python -m sqlova.utils.glove build ./data/glove --path_wikisql ./data/wikisql_tok
+# The subset is built from the unique words of the questions and headers of all splits (count_words),
+# looked up in one go (build_w2i_wemb). w2i keeps the order of the first occurrences, as update_w2i_wemb does.
+import argparse
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+
+W2I_SPECIAL = {'<UNK>': 0, '<BEG>': 1, '<END>': 2}
+
+
+class WordVectors:
+    """
+    Memory-mapped word vectors: <path>.npy [n_words, dim] and <path>.vocab.txt. Behaves as the dict of
+    vectors for `word in wv` and `wv[word]`.
+    """
+    def __init__(self, path):
+        self.vectors = np.load(path + '.npy', mmap_mode='r')
+        with open(path + '.vocab.txt', encoding='utf-8', newline='\n') as f:
+            self.vocab = {line.rstrip('\n'): i for i, line in enumerate(f)}
+        self.dim = self.vectors.shape[1]
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __getitem__(self, word):
+        return np.array(self.vectors[self.vocab[word]])
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def lookup(self, words):
+        """ [len(words), dim] vectors, read in file order. """
+        rows = np.fromiter((self.vocab[word] for word in words), dtype=np.int64, count=len(words))
+        order = np.argsort(rows)
+        out = np.empty((len(words), self.dim), dtype=np.float32)
+        out[order] = self.vectors[rows[order]]
+        return out
+
+
+def convert_glove(path_txt, path, dim=300):
+    """ GloVe text file -> <path>.npy, <path>.vocab.txt. The first occurrence of a word is kept. """
+    with open(path_txt, encoding='utf-8', newline='\n') as f:
+        n_lines = sum(1 for _ in f)
+    vectors = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.float32, shape=(n_lines, dim))
+    seen = set()
+    n = 0
+    with open(path_txt, encoding='utf-8', newline='\n') as f, \
+            open(path + '.vocab.txt', 'w', encoding='utf-8', newline='\n') as f_vocab:
+        for line in f:
+            # Some words of glove.840B contain spaces: the vector is the last dim fields.
+            fields = line.rstrip().rsplit(' ', dim)
+            word = fields[0]
+            if word in seen or '\n' in word or len(fields) != dim + 1:
+                continue
+            seen.add(word)
+            vectors[n] = np.asarray(fields[1:], dtype=np.float32)
+            f_vocab.write(word + '\n')
+            n += 1
+    vectors.flush()
+    del vectors
+    if n < n_lines:
+        # Drop the rows of the skipped lines.
+        vectors = np.load(path + '.npy', mmap_mode='r')[:n]
+        np.save(path + '.tmp.npy', vectors)
+        del vectors
+        os.replace(path + '.tmp.npy', path + '.npy')
+    return n
+
+
+def count_words(splits):
+    """
+    :param splits: [(data, tables), ...], e.g. of train, dev and test.
+    :return: Counter of the question tokens and header tokens, in the order of their first occurrence.
+    """
+    counts = Counter()
+    for data, tables in splits:
+        for t1 in data:
+            counts.update(t1['question_tok'])
+        for table_id, table_contents in tables.items():
+            for header_tokens in table_contents['header_tok']:
+                counts.update(header_tokens)
+    return counts
+
+
+def build_w2i_wemb(counts, wv, dim=300, min_count=1):
+    """
+    :param wv: WordVectors, or a dict of vectors.
+    :return: w2i, wemb [len(w2i), dim]. <UNK>, <BEG> and <END> are zero vectors.
+    """
+    words = [word for word, cnt in counts.items() if cnt >= min_count and word in wv and word not in W2I_SPECIAL]
+    w2i = dict(W2I_SPECIAL)
+    for word in words:
+        w2i[word] = len(w2i)
+    wemb = np.zeros((len(w2i), dim), dtype=np.float32)
+    if words:
+        if hasattr(wv, 'lookup'):
+            wemb[len(W2I_SPECIAL):] = wv.lookup(words)
+        else:
+            wemb[len(W2I_SPECIAL):] = np.stack([wv[word] for word in words])
+    return w2i, wemb
+
+
+def save_w2i_wemb(path_save_w2i_wemb, w2i, wemb):
+    with open(os.path.join(path_save_w2i_wemb, 'w2i.json'), 'w') as f_w2i:
+        json.dump(w2i, f_w2i)
+    np.save(os.path.join(path_save_w2i_wemb, 'wemb.npy'), wemb)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GloVe subset of WikiSQL.')
+    subparsers = parser.add_subparsers(dest='cmd')
+    p_convert = subparsers.add_parser('convert', help='GloVe text file -> memory-mappable .npy and vocabulary')
+    p_convert.add_argument('fin', help='e.g. glove.840B.300d.txt')
+    p_convert.add_argument('path', help='prefix of the outputs, e.g. ./data/glove')
+    p_convert.add_argument('--dim', default=300, type=int)
+    p_build = subparsers.add_parser('build', help='w2i.json and wemb.npy of the words of the splits')
+    p_build.add_argument('path', help='prefix of the converted GloVe files, e.g. ./data/glove')
+    p_build.add_argument('--path_wikisql', default='./data/wikisql_tok')
+    p_build.add_argument('--splits', default='train,dev,test')
+    p_build.add_argument('--min_count', default=1, type=int)
+    args = parser.parse_args()
+
+    if args.cmd == 'convert':
+        n = convert_glove(args.fin, args.path, args.dim)
+        print(f'Wrote {n} vectors to {args.path}.npy and {args.path}.vocab.txt')
+    elif args.cmd == 'build':
+        from .utils_wikisql import load_wikisql_data
+        wv = WordVectors(args.path)
+        splits = [load_wikisql_data(args.path_wikisql, mode=split) for split in args.splits.split(',')]
+        w2i, wemb = build_w2i_wemb(count_words(splits), wv, wv.dim, args.min_count)
+        save_w2i_wemb(args.path_wikisql, w2i, wemb)
+        print(f'Wrote {len(w2i)} words to {args.path_wikisql}/w2i.json and wemb.npy')
+    else:
+        parser.print_help()
@@ -0,0 +1,89 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Accuracies of the SQL parts over the whole batch at once.
+# The where-clause parts of a batch are padded into [B, W] (wc, wo) and [B, W, 2] (wvi) arrays, so that each part
+# is compared in a few numpy operations instead of per-example Python loops.
+#   get_cnt_sw(...): 0/1 arrays of sc, sa, wn, wc, wo, wvi. get_cnt_sw_list in utils_wikisql.py wraps it.
+# The gold where-conditions are compared in column order with mode='test' (pr_wc is sorted, see pred_wc), and in
+# their given order with mode='train' (teacher forcing).
+import numpy as np
+
+
+# Pad of the column indices: sorts after any column.
+WC_PAD = np.iinfo(np.int64).max
+
+
+def get_width(*ls_list):
+    return max([len(l) for ls in ls_list for l in ls] + [0])
+
+
+def pad(ls, width, pad_value=-1, tail=()):
+    """ [B, width, *tail] array of the lists ls, padded with pad_value. """
+    a = np.full((len(ls), width) + tail, pad_value, dtype=np.int64)
+    for b, l in enumerate(ls):
+        if len(l):
+            a[b, :len(l)] = l
+    return a
+
+
+def get_lens(ls):
+    return np.array([len(l) for l in ls], dtype=np.int64)
+
+
+def get_cnt_wc(g_wc, pr_wc, width):
+    """ pr_wc is sorted; g_wc is compared as a set. """
+    g_wc_a = np.sort(pad(g_wc, width, WC_PAD), axis=1)
+    pr_wc_a = pad(pr_wc, width, WC_PAD)
+    return (get_lens(g_wc) == get_lens(pr_wc)) & (g_wc_a == pr_wc_a).all(axis=1)
+
+
+def get_order(g_wn, g_wc, width, mode):
+    """ [B, width] indices putting the gold conditions in the order of the predictions. """
+    if mode == 'test':
+        return np.argsort(pad(g_wc, width, WC_PAD), axis=1, kind='stable')
+    elif mode == 'train':
+        # due to teacher forcing, no need to sort.
+        return np.tile(np.arange(width), (len(g_wn), 1))
+    else:
+        raise ValueError
+
+
+def get_cnt_wo(g_wn, g_wo, pr_wo, order, width):
+    g_wo_a = np.take_along_axis(pad(g_wo, width), order, axis=1)
+    return (g_wn == get_lens(pr_wo)) & (g_wo_a == pad(pr_wo, width)).all(axis=1)
+
+
+def get_cnt_wvi(g_wn, g_wvi, pr_wvi, order, width):
+    g_wvi_a = np.take_along_axis(pad(g_wvi, width, tail=(2,)), order[:, :, None], axis=1)
+    return (g_wn == get_lens(pr_wvi)) & (g_wvi_a == pad(pr_wvi, width, tail=(2,))).all(axis=(1, 2))
+
+
+def get_cnt_sw(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi, pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi, mode):
+    """
+    :param pr_wvi: None or [] when the where-value indices are not predicted; cnt_wvi is then all 0.
+    :return: cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi: [B] bool arrays.
+    """
+    g_wn = np.asarray(g_wn, dtype=np.int64)
+    width = get_width(g_wc, pr_wc, g_wo, pr_wo, g_wvi, pr_wvi or [])
+    order = get_order(g_wn, g_wc, width, mode)
+
+    cnt_sc = np.asarray(g_sc) == np.asarray(pr_sc)
+    cnt_sa = np.asarray(g_sa) == np.asarray(pr_sa)
+    cnt_wn = g_wn == np.asarray(pr_wn)
+    cnt_wc = get_cnt_wc(g_wc, pr_wc, width)
+    cnt_wo = get_cnt_wo(g_wn, g_wo, pr_wo, order, width)
+    if pr_wvi:
+        cnt_wvi = get_cnt_wvi(g_wn, g_wvi, pr_wvi, order, width)
+    else:
+        cnt_wvi = np.zeros(len(g_sc), dtype=bool)
+    return cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi
+
+
+def get_cnt_lx(*cnts):
+    """ Logical form accuracy: all the parts are right. """
+    return np.logical_and.reduce([np.asarray(cnt, dtype=bool) for cnt in cnts])
+
+
+def to_list(cnt):
+    return cnt.astype(np.int64).tolist()
@@ -0,0 +1,61 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Mixed-precision training (used by train.py).
+from contextlib import contextmanager
+
+import torch
+
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+@contextmanager
+def autocast(precision, device):
+    """ Autocast to bf16 / fp16 on the device of the models. fp32 runs as-is. """
+    if precision == 'fp32':
+        yield
+    else:
+        with torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[precision]):
+            yield
+
+
+def to_float(*scores):
+    """
+    Scores of the heads in fp32. Under autocast they are bf16 / fp16: the loss needs fp32, and the decoding
+    (pred_sw_se, ...) goes through numpy, which has no bfloat16.
+    """
+    return [s.float() for s in scores]
+
+
+def get_grad_scaler(precision, device):
+    """
+    fp16 gradients underflow without loss scaling. bf16 has the exponent range of fp32 and needs none.
+    """
+    if precision != 'fp16':
+        return None
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type)
+    return torch.cuda.amp.GradScaler()
+
+
+def backward(loss, scaler=None):
+    if scaler is None:
+        loss.backward()
+    else:
+        scaler.scale(loss).backward()
+
+
+def step(opts, scaler=None):
+    """ Step every optimizer in opts (None entries are skipped). """
+    for opt in opts:
+        if opt is None:
+            continue
+        if scaler is None:
+            opt.step()
+        else:
+            # Skipped when the scaled gradients hold inf / nan.
+            scaler.step(opt)
+    if scaler is not None:
+        scaler.update()
@@ -0,0 +1,180 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Per-stage timers of the train / test / predict loops.
+#
+#   profiler = StageProfiler(enabled=True)
+#   for batch in profiler.iter(data_loader):      # time spent waiting for the batch: stage 'data'
+#       with profiler.stage('bert'):
+#           ...
+#       profiler.add_batch(len(t), l_n, l_hpu, l_hs, max_seq_length)
+#   print(profiler.report(epoch, 'train'))         # right after the loop
+#
+# Disabled (the default), stage() returns a shared no-op context and iter() the loader itself.
+# With torch_steps > 0, the stages of the first torch_steps batches of every loop are also recorded with
+# torch.profiler (record_function) and written as a Chrome trace (chrome://tracing, Perfetto).
+import json
+import os
+import time
+from contextlib import nullcontext
+
+import torch
+
+
+NULL_CONTEXT = nullcontext()
+
+
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.torch_prof is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.t_wall = time.perf_counter()
+        self.t_cpu = time.process_time()
+
+    def __exit__(self, *exc):
+        if self.profiler.sync:
+            # CUDA kernels run asynchronously: without it, their time goes to the next stage that waits on them.
+            torch.cuda.synchronize()
+        self.profiler.add_time(self.name, time.perf_counter() - self.t_wall, time.process_time() - self.t_cpu)
+        if self.profiler.torch_prof is not None:
+            self.record.__exit__(*exc)
+        return False
+
+
+class StageProfiler:
+    """
+    :param path: directory of the reports (profile.jsonl, one JSON object per report) and Chrome traces.
+    :param torch_steps: # of batches per loop traced with torch.profiler. 0: off.
+    """
+    def __init__(self, enabled=False, path=None, torch_steps=0):
+        self.enabled = enabled
+        self.path = path
+        self.torch_steps = torch_steps if enabled else 0
+        self.sync = enabled and torch.cuda.is_available()
+        self.torch_prof = None
+        self.trace = None  # torch.profiler result of the last loop
+        self.reset()
+
+    def reset(self):
+        self.t_st = time.perf_counter()
+        self.wall = {}
+        self.cpu = {}
+        self.n_batches = 0
+        self.n_examples = 0
+        self.n_tokens = 0
+        self.n_padded_tokens = 0
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_CONTEXT
+        return Stage(self, name)
+
+    def add_time(self, name, t_wall, t_cpu):
+        self.wall[name] = self.wall.get(name, 0.0) + t_wall
+        self.cpu[name] = self.cpu.get(name, 0.0) + t_cpu
+
+    def iter(self, data_loader):
+        if not self.enabled:
+            return data_loader
+        return self.iter_timed(data_loader)
+
+    def iter_timed(self, data_loader):
+        self.reset()
+        self.start_torch_profiler()
+        it = iter(data_loader)
+        while True:
+            with self.stage('data'):
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    break
+            yield batch
+            self.step_torch_profiler()
+        self.stop_torch_profiler()
+
+    def add_batch(self, n_examples, l_n, l_hpu, l_hs, max_seq_length, n_rows=None):
+        """
+        BERT input of the batch: [CLS] question [SEP] header-1 [SEP] ... header-n [SEP], padded to max_seq_length.
+        :param n_rows: # of BERT input rows when examples are packed (get_bert_input(..., pack=True)).
+        """
+        if not self.enabled:
+            return
+        self.n_batches += 1
+        self.n_examples += n_examples
+        self.n_tokens += sum(l_n) + sum(l_hpu) + sum(l_hs) + 2 * n_examples
+        self.n_padded_tokens += (n_rows or n_examples) * max_seq_length
+
+    def start_torch_profiler(self):
+        if self.torch_steps <= 0:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.torch_prof = torch.profiler.profile(activities=activities)
+        self.torch_prof.__enter__()
+        self.torch_step = 0
+
+    def step_torch_profiler(self):
+        if self.torch_prof is None:
+            return
+        self.torch_step += 1
+        if self.torch_step >= self.torch_steps:
+            self.stop_torch_profiler()
+
+    def stop_torch_profiler(self):
+        if self.torch_prof is None:
+            return
+        torch_prof, self.torch_prof = self.torch_prof, None
+        torch_prof.__exit__(None, None, None)
+        self.trace = torch_prof
+
+    def get_report(self):
+        t_total = time.perf_counter() - self.t_st
+        t_stages = sum(self.wall.values())
+        return {'n_batches': self.n_batches,
+                'n_examples': self.n_examples,
+                'time_s': t_total,
+                'examples_per_s': self.n_examples / t_total if t_total > 0 else float('nan'),
+                'tokens_per_s': self.n_tokens / t_total if t_total > 0 else float('nan'),
+                'padded_token_ratio': 1 - self.n_tokens / self.n_padded_tokens if self.n_padded_tokens > 0
+                else float('nan'),
+                'stages': {name: {'wall_s': t_wall,
+                                  'cpu_s': self.cpu[name],
+                                  'pct': 100 * t_wall / t_total if t_total > 0 else float('nan')}
+                           for name, t_wall in sorted(self.wall.items(), key=lambda x: -x[1])},
+                # Time outside of the stages, e.g. logging.
+                'other_pct': 100 * (t_total - t_stages) / t_total if t_total > 0 else float('nan')}
+
+    def report(self, epoch, dname):
+        """
+        Report of the last loop, saved to <path>/profile.jsonl. Call it right after the loop.
+        :return: the report formatted for the log. '' when disabled.
+        """
+        if not self.enabled:
+            return ''
+        r = self.get_report()
+        r['epoch'] = epoch
+        r['dname'] = dname
+        if self.path is not None:
+            with open(os.path.join(self.path, 'profile.jsonl'), 'a') as f:
+                f.write(json.dumps(r) + '\n')
+            if self.trace is not None:
+                self.trace.export_chrome_trace(os.path.join(self.path, f'trace_{dname}_{epoch}.json'))
+        self.trace = None
+        self.reset()
+
+        lines = [f"{dname} profile, epoch {epoch}: {r['examples_per_s']:.1f} examples/s, "
+                 f"{r['tokens_per_s']:.0f} tokens/s, padded tokens {100 * r['padded_token_ratio']:.1f}%"]
+        for name, s in r['stages'].items():
+            lines.append(f"  {name:>10}: {s['pct']:5.1f}%  wall {s['wall_s']:8.2f} s  cpu {s['cpu_s']:8.2f} s")
+        lines.append(f"  {'other':>10}: {r['other_pct']:5.1f}%")
+        return '\n'.join(lines)
+
+
+# Default of the loops: disabled.
+NULL_PROFILER = StageProfiler()
@@ -0,0 +1,88 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Post-training quantization for CPU inference (used by predict.py).
+import io
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+QUANTIZE_MODES = ['none', 'int8', 'bf16']
+
+
+def is_bf16_supported():
+    """ True when the CPU has native bf16 kernels (e.g. AVX512-BF16 or AMX).
+    Without them autocast still runs, but emulated bf16 is slower than fp32.
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def quantize_dynamic_int8(model):
+    """
+    Dynamic int8 quantization of every nn.Linear in the model.
+    Weights are stored as int8, activations are quantized on the fly.
+    Returns a new module; the fp32 input model is left untouched.
+    """
+    model_q = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=False)
+    model_q.eval()
+    return model_q
+
+
+def quantize_models(model, model_bert, mode):
+    """
+    :param model: Seq2SQL model (e.g. Seq2SQL_v1)
+    :param model_bert: BertModel
+    :param mode: one of QUANTIZE_MODES
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantize mode: {mode}")
+    if mode == 'int8':
+        model = quantize_dynamic_int8(model)
+        model_bert = quantize_dynamic_int8(model_bert)
+    return model, model_bert
+
+
+@contextmanager
+def inference_context(mode):
+    """ Autocast for bf16. int8 and none run as-is. """
+    if mode == 'bf16':
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            yield
+    else:
+        yield
+
+
+def save_quantized(path, model, model_bert, mode):
+    """
+    Dynamically quantized modules cannot be rebuilt from a plain state_dict without
+    quantizing an fp32 model first, so the whole modules are pickled.
+    """
+    state = {'quantize': mode, 'model': model, 'model_bert': model_bert}
+    torch.save(state, path)
+
+
+def load_quantized(path, mode):
+    try:
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only argument.
+        state = torch.load(path, map_location='cpu')
+    if state['quantize'] != mode:
+        raise ValueError(f"{path} holds a '{state['quantize']}' model, but '{mode}' was requested.")
+    model = state['model']
+    model_bert = state['model_bert']
+    model.eval()
+    model_bert.eval()
+    return model, model_bert
+
+
+def get_size_mb(model):
+    """ Size of the serialized state_dict in MB. Packed int8 weights are not plain tensors, so serialize. """
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 1024 / 1024
@@ -0,0 +1,123 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Resumable training: full training-state checkpoints and a sampler that can start mid-epoch.
+#
+# The training state holds the models, both optimizers, the grad scaler, the RNG states of every rank,
+# the epoch, the position in the epoch and the best dev metrics. On resume, ResumableSampler regenerates
+# the order of the interrupted epoch and starts right after the last finished batch, so the skipped
+# batches are neither loaded nor collated.
+import random
+
+import numpy as np
+import torch
+
+from .distributed import get_rank, get_world_size, all_gather_object
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    The order of an epoch only depends on (seed, epoch) and iteration can start at any position.
+    Distributed: each rank takes a strided 1/world_size share, padded to equal length like DistributedSampler.
+    """
+    def __init__(self, data, shuffle=True, seed=0):
+        self.n = len(data)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.n_per_rank = -(-self.n // self.world_size)
+        # Examples of this rank that are not padding. The padding repeats examples at the end of the shard.
+        self.n_real = len(range(self.rank, self.n, self.world_size))
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        """ Position (number of examples of this rank already done) where the next epoch starts. """
+        self.start = start
+
+    def get_indices(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.n, generator=g).tolist()
+        else:
+            indices = list(range(self.n))
+        indices += indices[:self.n_per_rank * self.world_size - self.n]
+        return indices[self.rank::self.world_size]
+
+    def __iter__(self):
+        indices = self.get_indices()[self.start:]
+        # Only the epoch being resumed is partial.
+        self.start = 0
+        return iter(indices)
+
+    def __len__(self):
+        return self.n_per_rank - self.start
+
+
+def get_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state(state['cuda'])
+
+
+def get_train_state(epoch, pos, models, opts, scaler=None, best=None):
+    """
+    Called on every rank (the RNG states are gathered); only rank 0 needs to write the result, e.g. with
+    CheckpointWriter.save(path, None, state, 'torch').
+    :param pos: number of examples of each rank done in this epoch.
+    :param models: {name: module}, e.g. {'model': model, 'model_bert': model_bert}. Unwrapped (not DDP).
+    :param opts: {name: optimizer or None}
+    :param best: best dev metrics, e.g. {'acc_lx_t_best': .., 'epoch_best': ..}
+    """
+    state = {'epoch': epoch,
+             'pos': pos,
+             'rng': all_gather_object(get_rng_state()),
+             'best': best or {}}
+    for name, module in models.items():
+        state[name] = module.state_dict()
+    for name, opt in opts.items():
+        state[name] = opt.state_dict() if opt is not None else None
+    state['scaler'] = scaler.state_dict() if scaler is not None else None
+    return state
+
+
+def load_train_state(path):
+    try:
+        # RNG states hold numpy objects.
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+def restore_train_state(state, models, opts, scaler=None):
+    """
+    Load the state into the models, optimizers, scaler and RNGs of this rank.
+    :return: epoch, pos, best
+    """
+    for name, module in models.items():
+        module.load_state_dict(state[name])
+    for name, opt in opts.items():
+        if opt is not None and state.get(name) is not None:
+            opt.load_state_dict(state[name])
+    if scaler is not None and state.get('scaler') is not None:
+        scaler.load_state_dict(state['scaler'])
+
+    rng = state['rng']
+    set_rng_state(rng[get_rank()] if get_rank() < len(rng) else rng[0])
+    return state['epoch'], state['pos'], state['best']
@@ -0,0 +1,74 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Training-set metrics policy (used by train.py).
+#   none   : loss only.
+#   logical: + accuracies of the SQL parts and logical form accuracy (acc_lx).
+#   full   : + execution accuracy (acc_x) on a random subsample of the examples, executed against the DB
+#            in a background thread, so that training steps do not wait for SQLite.
+import logging
+import queue
+import random
+import threading
+
+from .utils_wikisql import get_cnt_x_list
+
+
+TRAIN_METRICS = ['none', 'logical', 'full']
+
+
+class ExecAccWorker:
+    """
+    :param get_engine: callable returning a DBEngine. Called in the worker thread, which owns the connection.
+    :param rate: fraction of the examples whose execution accuracy is computed.
+    """
+    def __init__(self, get_engine, rate=1.0, seed=0):
+        self.get_engine = get_engine
+        self.rate = rate
+        self.rng = random.Random(seed)  # keeps the global RNGs (and so training) untouched
+        self.queue = queue.Queue()
+        self.cnt_x = 0
+        self.cnt = 0  # the # of examples executed
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            engine = self.get_engine()
+        except Exception as e:
+            engine = None
+            self.error = e
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if engine is None:
+                continue  # drain the queue
+            try:
+                cnt_x1_list, g_ans, pr_ans = get_cnt_x_list(engine, *item)
+                self.cnt_x += sum(cnt_x1_list)
+                self.cnt += len(cnt_x1_list)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def submit(self, tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i):
+        """ Arguments of get_cnt_x_list without the engine. Returns immediately. """
+        bs = [b for b in range(len(g_sc)) if self.rate >= 1.0 or self.rng.random() < self.rate]
+        if not bs:
+            return
+        self.queue.put(tuple([x[b] for b in bs] for x in (tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i)))
+
+    def close(self):
+        """
+        Wait for the submitted batches.
+        :return: cnt_x, cnt: the # of correct executions and of executed examples. Both nan when an execution
+                 failed (logged), so that acc_x is nan: the metric is diagnostic only and must not stop training.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            logging.warning("Execution accuracy worker failed, acc_x is not reported", exc_info=self.error)
+            return float('nan'), float('nan')
+        return self.cnt_x, self.cnt
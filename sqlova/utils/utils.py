@@ -3,7 +3,7 @@
 
 # Wonseok Hwang
 import os
-from matplotlib.pylab import *
+from numpy import int32, int64, unravel_index, zeros
 
 
 def generate_perm_inv(perm):
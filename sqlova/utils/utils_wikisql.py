@@ -6,19 +6,24 @@
 import os, json
 import random as rd
 from copy import deepcopy
+from functools import partial
 
-from matplotlib.pylab import *
+import numpy as np
+from numpy import arange, argsort, array, array_equal, ceil, load, sqrt, zeros
 
 import torch
-import torchvision.datasets as dsets
 import torch.nn as nn
 import torch.nn.functional as F
 
 
 from .utils import generate_perm_inv
 from .utils import json_default_type_checker
+from . import metrics
+from .glove import build_w2i_wemb, count_words, save_w2i_wemb
 
 from .wikisql_formatter import get_squad_style_ans
+from .distributed import get_eval_sampler
+from .resume import ResumableSampler
 
 
 
@@ -77,38 +82,113 @@ def load_wikisql_data(path_wikisql, mode='train', toy_model=False, toy_size=10,
 
 def load_w2i_wemb(path_wikisql, bert=False):
     """ Load pre-made subset of TAPI.
+    wemb is memory-mapped (read-only): rows are paged in from the file when used.
     """
     if bert:
         with open(os.path.join(path_wikisql, 'w2i_bert.json'), 'r') as f_w2i:
             w2i = json.load(f_w2i)
-        wemb = load(os.path.join(path_wikisql, 'wemb_bert.npy'), )
+        wemb = load(os.path.join(path_wikisql, 'wemb_bert.npy'), mmap_mode='r')
     else:
         with open(os.path.join(path_wikisql, 'w2i.json'), 'r') as f_w2i:
             w2i = json.load(f_w2i)
 
-        wemb = load(os.path.join(path_wikisql, 'wemb.npy'), )
+        wemb = load(os.path.join(path_wikisql, 'wemb.npy'), mmap_mode='r')
     return w2i, wemb
 
-def get_loader_wikisql(data_train, data_dev, bS, shuffle_train=True, shuffle_dev=False):
+def get_loader_options(collate_fn=None, num_workers=4, prefetch_factor=2):
+    """
+    DataLoader options.
+    :param collate_fn: None: batches are lists of examples (dictionary values are not merged).
+                       collate_wikisql: batches are preprocessed in the workers.
+    :param prefetch_factor: number of batches each worker prepares ahead.
+    """
+    options = {'collate_fn': collate_fn if collate_fn is not None else (lambda x: x),
+               'num_workers': num_workers,
+               # pinned host memory makes the host-to-GPU copies of the input tensors asynchronous.
+               'pin_memory': collate_fn is not None and torch.cuda.is_available()}
+    if num_workers > 0:
+        options['prefetch_factor'] = prefetch_factor
+        options['persistent_workers'] = True
+    return options
+
+
+def get_loader_wikisql(data_train, data_dev, bS, shuffle_train=True, shuffle_dev=False, seed=0,
+                       tokenizer=None, table_train=None, table_dev=None, max_seq_length=222,
+                       num_workers=4, prefetch_factor=2, pack=False):
+    """
+    When running distributed (sqlova.utils.distributed), each rank loads its own shard of train and dev.
+    :param seed: seed of the train shuffling, combined with the epoch.
+    :param tokenizer: if given, batches are preprocessed in the workers by collate_wikisql (needs the tables).
+                      Otherwise, batches are lists of examples.
+    :param pack: pack several examples per BERT row in collate_wikisql (see pack_bert_input).
+    """
+    collate_fn_train = get_collate_fn(table_train, tokenizer, max_seq_length, pack) if tokenizer is not None else None
+    collate_fn_dev = get_collate_fn(table_dev, tokenizer, max_seq_length, pack) if tokenizer is not None else None
+
+    # Shuffled per epoch (set_epoch) and resumable mid-epoch (set_start). Sharded across ranks when distributed.
     train_loader = torch.utils.data.DataLoader(
         batch_size=bS,
         dataset=data_train,
-        shuffle=shuffle_train,
-        num_workers=4,
-        collate_fn=lambda x: x  # now dictionary values are not merged!
+        sampler=ResumableSampler(data_train, shuffle=shuffle_train, seed=seed),
+        **get_loader_options(collate_fn_train, num_workers, prefetch_factor)
     )
 
+    sampler_dev = get_eval_sampler(data_dev)
     dev_loader = torch.utils.data.DataLoader(
         batch_size=bS,
         dataset=data_dev,
-        shuffle=shuffle_dev,
-        num_workers=4,
-        collate_fn=lambda x: x  # now dictionary values are not merged!
+        shuffle=shuffle_dev and sampler_dev is None,
+        sampler=sampler_dev,
+        **get_loader_options(collate_fn_dev, num_workers, prefetch_factor)
     )
 
     return train_loader, dev_loader
 
 
+def get_collate_fn(tables, tokenizer, max_seq_length, pack=False):
+    return partial(collate_wikisql, tables=tables, tokenizer=tokenizer, max_seq_length=max_seq_length, pack=pack)
+
+
+def collate_wikisql(t, tables, tokenizer, max_seq_length, pack=False):
+    """
+    collate_fn that runs the CPU side of a batch in the DataLoader workers: fields, ground truth, WordPiece
+    tokenization and BERT input tensors. The training loop then only runs the models.
+    Use through get_collate_fn / get_loader_wikisql(..., tokenizer=...).
+
+    :return: dict of
+        t: the examples
+        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds: see get_fields
+        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv: see get_g
+        g_wvi_corenlp: where-value indices on CoreNLP tokens
+        g_wvi: where-value indices on WordPiece tokens. None when the where-value is not found in the question.
+               Taken from the examples when load_g_wvi has set them.
+        bert_input: see get_bert_input. Pass it to get_wemb_bert.
+    """
+    nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, tables, no_hs_t=True, no_sql_t=True)
+    g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
+    g_wvi_corenlp = get_g_wvi_corenlp(t)
+
+    bert_input = get_bert_input(tokenizer, nlu_t, hds, max_seq_length, pack)
+    if all('g_wvi' in t1 for t1 in t):
+        # precomputed by load_g_wvi
+        g_wvi = [t1['g_wvi'] for t1 in t]
+        if any(g_wvi1 is None for g_wvi1 in g_wvi):
+            g_wvi = None
+    else:
+        t_to_tt_idx = bert_input[-2]
+        try:
+            g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
+        except Exception:
+            g_wvi = None
+
+    return {'t': t,
+            'nlu': nlu, 'nlu_t': nlu_t, 'sql_i': sql_i, 'sql_q': sql_q, 'sql_t': sql_t, 'tb': tb, 'hs_t': hs_t,
+            'hds': hds,
+            'g_sc': g_sc, 'g_sa': g_sa, 'g_wn': g_wn, 'g_wc': g_wc, 'g_wo': g_wo, 'g_wv': g_wv,
+            'g_wvi_corenlp': g_wvi_corenlp, 'g_wvi': g_wvi,
+            'bert_input': bert_input}
+
+
 def get_fields_1(t1, tables, no_hs_t=False, no_sql_t=False):
     nlu1 = t1['question']
     nlu_t1 = t1['question_tok']
@@ -376,30 +456,12 @@ def update_w2i_wemb(word, wv, idx_w2i, n_total, w2i, wemb):
     return idx_w2i, n_total
 
 def make_w2i_wemb(args, path_save_w2i_wemb, wv, data_train, data_dev, data_test, table_train, table_dev, table_test):
-
-    w2i = {'<UNK>': 0, '<BEG>': 1, '<END>': 2}  # to use it when embeds NL query.
-    idx_w2i = 2
-    n_total = 3
-
-    wemb = [np.zeros(300, dtype=np.float32) for _ in range(3)]  # 128 is of TAPI vector.
-    idx_w2i, n_total = generate_w2i_wemb(data_train, wv, idx_w2i, n_total, w2i, wemb)
-    idx_w2i, n_total = generate_w2i_wemb_table(table_train, wv, idx_w2i, n_total, w2i, wemb)
-
-    idx_w2i, n_total = generate_w2i_wemb(data_dev, wv, idx_w2i, n_total, w2i, wemb)
-    idx_w2i, n_total = generate_w2i_wemb_table(table_dev, wv, idx_w2i, n_total, w2i, wemb)
-
-    idx_w2i, n_total = generate_w2i_wemb(data_test, wv, idx_w2i, n_total, w2i, wemb)
-    idx_w2i, n_total = generate_w2i_wemb_table(table_test, wv, idx_w2i, n_total, w2i, wemb)
-
-    path_w2i = os.path.join(path_save_w2i_wemb, 'w2i.json')
-    path_wemb = os.path.join(path_save_w2i_wemb, 'wemb.npy')
-
-    wemb = np.stack(wemb, axis=0)
-
-    with open(path_w2i, 'w') as f_w2i:
-        json.dump(w2i, f_w2i)
-
-    np.save(path_wemb, wemb)
+    """ Same w2i and wemb as update_w2i_wemb over the splits, with one lookup of the unique words.
+        wv: dict of vectors, or glove.WordVectors (memory-mapped).
+    """
+    counts = count_words([(data_train, table_train), (data_dev, table_dev), (data_test, table_test)])
+    w2i, wemb = build_w2i_wemb(counts, wv)
+    save_w2i_wemb(path_save_w2i_wemb, w2i, wemb)
 
     return w2i, wemb
 
@@ -652,25 +714,25 @@ def get_bert_output_s2s(model_bert, tokenizer, nlu_t, hds, sql_vocab, max_seq_le
            nlu_tt, t_to_tt_idx, tt_to_t_idx
 
 
-def get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length):
+def get_bert_input(tokenizer, nlu_t, hds, max_seq_length, pack=False):
     """
-    Here, input is toknized further by WordPiece (WP) tokenizer and fed into BERT.
+    WordPiece tokenization and BERT input tensors (on the CPU) of a batch. No model involved,
+    so that it can run in DataLoader workers (see collate_wikisql).
 
     INPUT
-    :param model_bert:
     :param tokenizer: WordPiece toknizer
-    :param nlu: Question
     :param nlu_t: CoreNLP tokenized nlu.
     :param hds: Headers
-    :param hs_t: None or 1st-level tokenized headers
     :param max_seq_length: max input token length
+    :param pack: put several examples per row, see pack_bert_input.
 
     OUTPUT
+    all_input_ids, all_input_mask, all_segment_ids: [B, max_seq_length] BERT inputs
+                                                    ([R, max_seq_length], R <= B, with pack)
     tokens: BERT input tokens
     nlu_tt: WP-tokenized input natural language questions
-    orig_to_tok_index: map the index of 1st-level-token to the index of 2nd-level-token
-    tok_to_orig_index: inverse map.
-
+    t_to_tt_idx: map the index of 1st-level-token to the index of 2nd-level-token
+    tt_to_t_idx: inverse map.
     """
 
     l_n = []
@@ -725,15 +787,15 @@ def get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length):
         # tokens are attended to.
         input_mask1 = [1] * len(input_ids1)
 
-        # 3. Zero-pad up to the sequence length.
-        while len(input_ids1) < max_seq_length:
+        # 3. Zero-pad up to the sequence length (pack_bert_input pads the packed rows).
+        while not pack and len(input_ids1) < max_seq_length:
             input_ids1.append(0)
             input_mask1.append(0)
             segment_ids1.append(0)
 
-        assert len(input_ids1) == max_seq_length
-        assert len(input_mask1) == max_seq_length
-        assert len(segment_ids1) == max_seq_length
+        assert len(input_ids1) <= max_seq_length
+        assert len(input_mask1) == len(input_ids1)
+        assert len(segment_ids1) == len(input_ids1)
 
         input_ids.append(input_ids1)
         tokens.append(tokens1)
@@ -743,17 +805,127 @@ def get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length):
         i_nlu.append(i_nlu1)
         i_hds.append(i_hds1)
 
-    # Convert to tensor
-    all_input_ids = torch.tensor(input_ids, dtype=torch.long).to(device)
-    all_input_mask = torch.tensor(input_mask, dtype=torch.long).to(device)
-    all_segment_ids = torch.tensor(segment_ids, dtype=torch.long).to(device)
-
-    # 4. Generate BERT output.
-    all_encoder_layer, pooled_output = model_bert(all_input_ids, all_segment_ids, all_input_mask)
+    if pack:
+        all_input_ids, all_input_mask, all_segment_ids = pack_bert_input(input_ids, segment_ids, max_seq_length)
+    else:
+        # Convert to tensor
+        all_input_ids = torch.tensor(input_ids, dtype=torch.long)
+        all_input_mask = torch.tensor(input_mask, dtype=torch.long)
+        all_segment_ids = torch.tensor(segment_ids, dtype=torch.long)
 
-    # 5. generate l_hpu from i_hds
+    # generate l_hpu from i_hds
     l_hpu = gen_l_hpu(i_hds)
 
+    return all_input_ids, all_input_mask, all_segment_ids, tokens, i_nlu, i_hds, \
+           l_n, l_hpu, l_hs, \
+           nlu_tt, t_to_tt_idx, tt_to_t_idx
+
+
+def pack_bert_input(input_ids, segment_ids, max_seq_length):
+    """
+    Put the [CLS] question [SEP] headers [SEP] sequences of a batch back to back in rows of max_seq_length
+    (first fit, in the order of the examples), so that short examples share a row instead of being padded.
+    BertModel(..., packed=True) keeps the examples apart with a block-diagonal attention mask and restarts
+    the position ids at each example, and get_bert_output unpacks its output to one row per example.
+
+    :param input_ids, segment_ids: [B, len of the example] unpadded.
+    :return: all_input_ids, all_input_mask, all_segment_ids: [R, max_seq_length]. The mask holds b + 1 on the
+             tokens of the example b, 0 on padding. When no two examples fit in a row (R == B), the inputs are
+             those of the unpacked batch (0/1 mask).
+    """
+    rows = []  # [[b, ...] of each row]
+    l_rows = []
+    for b, input_ids1 in enumerate(input_ids):
+        for r, l_row in enumerate(l_rows):
+            if l_row + len(input_ids1) <= max_seq_length:
+                rows[r].append(b)
+                l_rows[r] += len(input_ids1)
+                break
+        else:
+            rows.append([b])
+            l_rows.append(len(input_ids1))
+
+    packed = len(rows) < len(input_ids)
+    all_input_ids = torch.zeros([len(rows), max_seq_length], dtype=torch.long)
+    all_input_mask = torch.zeros([len(rows), max_seq_length], dtype=torch.long)
+    all_segment_ids = torch.zeros([len(rows), max_seq_length], dtype=torch.long)
+    for r, row in enumerate(rows):
+        st = 0
+        for b in row:
+            ed = st + len(input_ids[b])
+            all_input_ids[r, st:ed] = torch.tensor(input_ids[b], dtype=torch.long)
+            all_input_mask[r, st:ed] = b + 1 if packed else 1
+            all_segment_ids[r, st:ed] = torch.tensor(segment_ids[b], dtype=torch.long)
+            st = ed
+
+    return all_input_ids, all_input_mask, all_segment_ids
+
+
+def unpack_bert_output(all_encoder_layer, all_input_mask, bS):
+    """
+    Inverse of pack_bert_input on the output of BertModel: [R, max_seq_length, H] -> [bS, max_seq_length, H],
+    each example from position 0 of its row, so that i_nlu and i_hds index it as in an unpacked batch.
+    Positions past the end of an example are not meaningful (get_wemb_n and get_wemb_h do not read them).
+    """
+    R, L = all_input_mask.size()
+    seq_ids = all_input_mask.view(-1)
+    flat = seq_ids.nonzero().squeeze(1)  # positions of the tokens in [R * L]
+    b = seq_ids[flat] - 1
+    # The tokens of an example are contiguous in its row: sorting by example keeps them in order.
+    flat = flat[torch.argsort(b * R * L + flat)]
+    b = seq_ids[flat] - 1
+    l_b = torch.bincount(b, minlength=bS)
+    st_b = torch.cumsum(l_b, 0) - l_b
+    i = torch.arange(flat.size(0), device=flat.device) - st_b[b]
+
+    idx = torch.zeros([bS, L], dtype=torch.long, device=flat.device)
+    idx[b, i] = flat
+    idx = idx.view(-1)
+    return [layer.reshape(R * L, -1)[idx].view(bS, L, -1) for layer in all_encoder_layer]
+
+
+def get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length, bert_input=None):
+    """
+    Here, input is toknized further by WordPiece (WP) tokenizer and fed into BERT.
+
+    INPUT
+    :param model_bert:
+    :param tokenizer: WordPiece toknizer
+    :param nlu: Question
+    :param nlu_t: CoreNLP tokenized nlu.
+    :param hds: Headers
+    :param hs_t: None or 1st-level tokenized headers
+    :param max_seq_length: max input token length
+    :param bert_input: output of get_bert_input when already computed (e.g. by collate_wikisql).
+                       With pack=True, all_encoder_layer is unpacked to one row per example, and
+                       pooled_output is per packed row.
+
+    OUTPUT
+    tokens: BERT input tokens
+    nlu_tt: WP-tokenized input natural language questions
+    orig_to_tok_index: map the index of 1st-level-token to the index of 2nd-level-token
+    tok_to_orig_index: inverse map.
+
+    """
+    if bert_input is None:
+        bert_input = get_bert_input(tokenizer, nlu_t, hds, max_seq_length)
+    all_input_ids, all_input_mask, all_segment_ids, tokens, i_nlu, i_hds, \
+    l_n, l_hpu, l_hs, \
+    nlu_tt, t_to_tt_idx, tt_to_t_idx = bert_input
+
+    # non_blocking: copies from pinned memory overlap with compute.
+    all_input_ids = all_input_ids.to(device, non_blocking=True)
+    all_input_mask = all_input_mask.to(device, non_blocking=True)
+    all_segment_ids = all_segment_ids.to(device, non_blocking=True)
+
+    # Generate BERT output.
+    if all_input_ids.size(0) < len(l_n):
+        # packed by get_bert_input(..., pack=True)
+        all_encoder_layer, pooled_output = model_bert(all_input_ids, all_segment_ids, all_input_mask, packed=True)
+        all_encoder_layer = unpack_bert_output(all_encoder_layer, all_input_mask, len(l_n))
+    else:
+        all_encoder_layer, pooled_output = model_bert(all_input_ids, all_segment_ids, all_input_mask)
+
     return all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, \
            l_n, l_hpu, l_hs, \
            nlu_tt, t_to_tt_idx, tt_to_t_idx
@@ -810,12 +982,14 @@ def get_wemb_h(i_hds, l_hpu, l_hs, hS, num_hidden_layers, all_encoder_layer, num
 
 
 
-def get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length, num_out_layers_n=1, num_out_layers_h=1):
+def get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length, num_out_layers_n=1, num_out_layers_h=1,
+                  bert_input=None):
 
     # get contextual output of all tokens from bert
     all_encoder_layer, pooled_output, tokens, i_nlu, i_hds,\
     l_n, l_hpu, l_hs, \
-    nlu_tt, t_to_tt_idx, tt_to_t_idx = get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length)
+    nlu_tt, t_to_tt_idx, tt_to_t_idx = get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length,
+                                                       bert_input=bert_input)
     # all_encoder_layer: BERT outputs from all layers.
     # pooled_output: output of [CLS] vec.
     # tokens: BERT intput tokens
@@ -882,12 +1056,7 @@ def pred_sc(s_sc):
     """
     return: [ pr_wc1_i, pr_wc2_i, ...]
     """
-    # get g_num
-    pr_sc = []
-    for s_sc1 in s_sc:
-        pr_sc.append(s_sc1.argmax().item())
-
-    return pr_sc
+    return s_sc.argmax(dim=1).tolist()
 
 def pred_sc_beam(s_sc, beam_size):
     """
@@ -907,27 +1076,14 @@ def pred_sa(s_sa):
     """
     return: [ pr_wc1_i, pr_wc2_i, ...]
     """
-    # get g_num
-    pr_sa = []
-    for s_sa1 in s_sa:
-        pr_sa.append(s_sa1.argmax().item())
-
-    return pr_sa
+    return s_sa.argmax(dim=1).tolist()
 
 
 def pred_wn(s_wn):
     """
     return: [ pr_wc1_i, pr_wc2_i, ...]
     """
-    # get g_num
-    pr_wn = []
-    for s_wn1 in s_wn:
-        pr_wn.append(s_wn1.argmax().item())
-        # print(pr_wn, s_wn1)
-        # if s_wn1.argmax().item() == 3:
-        #     input('')
-
-    return pr_wn
+    return s_wn.argmax(dim=1).tolist()
 
 def pred_wc_old(sql_i, s_wc):
     """
@@ -939,7 +1095,7 @@ def pred_wc_old(sql_i, s_wc):
         wn = len(sql_i1['conds'])
         s_wc1 = s_wc[b]
 
-        pr_wc1 = argsort(-s_wc1.data.cpu().numpy())[:wn]
+        pr_wc1 = argsort(-s_wc1.data.float().cpu().numpy())[:wn]
         pr_wc1.sort()
 
         pr_wc.append(list(pr_wc1))
@@ -952,16 +1108,10 @@ def pred_wc(wn, s_wc):
     return: [ pr_wc1_i, pr_wc2_i, ...]
     ! Returned index is sorted!
     """
-    # get g_num
-    pr_wc = []
-    for b, wn1 in enumerate(wn):
-        s_wc1 = s_wc[b]  # score for headers in each instance
-
-        pr_wc1 = argsort(-s_wc1.data.cpu().numpy())[:wn1]    # indices of top_k
-        pr_wc1.sort()   # ranked top_k indices
-
-        pr_wc.append(list(pr_wc1))
-    return pr_wc
+    # indices of top_k, for the whole batch at once
+    max_wn = max(wn, default=0)
+    idx = argsort(-s_wc.data.float().cpu().numpy(), axis=1)[:, :max_wn].tolist()
+    return [sorted(idx1[:wn1]) for idx1, wn1 in zip(idx, wn)]   # ranked top_k indices
 
 def pred_wc_sorted_by_prob(s_wc):
     """
@@ -975,7 +1125,7 @@ def pred_wc_sorted_by_prob(s_wc):
 
     for b in range(bS):
         s_wc1 = s_wc[b]
-        pr_wc1 = argsort(-s_wc1.data.cpu().numpy())
+        pr_wc1 = argsort(-s_wc1.data.float().cpu().numpy())
         pr_wc.append(list(pr_wc1))
     return pr_wc
 
@@ -985,14 +1135,8 @@ def pred_wo(wn, s_wo):
     return: [ pr_wc1_i, pr_wc2_i, ...]
     """
     # s_wo = [B, 4, n_op]
-    pr_wo_a = s_wo.argmax(dim=2)  # [B, 4]
-    # get g_num
-    pr_wo = []
-    for b, pr_wo_a1 in enumerate(pr_wo_a):
-        wn1 = wn[b]
-        pr_wo.append(list(pr_wo_a1.data.cpu().numpy()[:wn1]))
-
-    return pr_wo
+    pr_wo_a = s_wo.argmax(dim=2).tolist()  # [B, 4]
+    return [pr_wo_a1[:wn1] for pr_wo_a1, wn1 in zip(pr_wo_a, wn)]
 
 
 def pred_wvi_se(wn, s_wv):
@@ -1009,14 +1153,11 @@ def pred_wvi_se(wn, s_wv):
     pr_wvi_st_idx = s_wv_st.argmax(dim=2) # [B, 4, mL] -> [B, 4, 1]
     pr_wvi_ed_idx = s_wv_ed.argmax(dim=2)
 
+    pr_wvi_st_idx = pr_wvi_st_idx.tolist()
+    pr_wvi_ed_idx = pr_wvi_ed_idx.tolist()
     pr_wvi = []
     for b, wn1 in enumerate(wn):
-        pr_wvi1 = []
-        for i_wn in range(wn1):
-            pr_wvi_st_idx11 = pr_wvi_st_idx[b][i_wn]
-            pr_wvi_ed_idx11 = pr_wvi_ed_idx[b][i_wn]
-            pr_wvi1.append([pr_wvi_st_idx11.item(), pr_wvi_ed_idx11.item()])
-        pr_wvi.append(pr_wvi1)
+        pr_wvi.append([[pr_wvi_st_idx[b][i_wn], pr_wvi_ed_idx[b][i_wn]] for i_wn in range(wn1)])
 
     return pr_wvi
 
@@ -1037,8 +1178,8 @@ def pred_wvi_se_beam(max_wn, s_wv, beam_size):
     s_wv_st = s_wv_st.squeeze(3) # [B, 4, mL, 1] -> [B, 4, mL]
     s_wv_ed = s_wv_ed.squeeze(3)
 
-    prob_wv_st = F.softmax(s_wv_st, dim=-1).detach().to('cpu').numpy()
-    prob_wv_ed = F.softmax(s_wv_ed, dim=-1).detach().to('cpu').numpy()
+    prob_wv_st = F.softmax(s_wv_st, dim=-1).detach().float().to('cpu').numpy()
+    prob_wv_ed = F.softmax(s_wv_ed, dim=-1).detach().float().to('cpu').numpy()
 
     k_logit = int(ceil(sqrt(beam_size)))
     n_pairs = k_logit**2
@@ -1285,6 +1426,62 @@ def get_g_wvi_bert_from_g_wvi_corenlp(wh_to_wp_index, g_wvi_corenlp):
     return g_wvi
 
 
+def get_t_to_tt_idx1(tokenizer, nlu_t1):
+    """ t_to_tt_idx of one question, as get_bert_input computes it. """
+    t_to_tt_idx1 = []
+    n_tt = 0
+    for token in nlu_t1:
+        t_to_tt_idx1.append(n_tt)
+        n_tt += len(tokenizer.tokenize(token))
+    return t_to_tt_idx1
+
+
+def get_g_wvi1(tokenizer, t1):
+    """ g_wvi of one example. None when the where-value was not found in the question (wvi_corenlp). """
+    try:
+        t_to_tt_idx1 = get_t_to_tt_idx1(tokenizer, t1['question_tok'])
+        return get_g_wvi_bert_from_g_wvi_corenlp([t_to_tt_idx1], [t1['wvi_corenlp']])[0]
+    except Exception:
+        return None
+
+
+def load_g_wvi(path_wikisql, mode, data, tokenizer, bert_type, save=True):
+    """
+    Set t1['g_wvi'] (WordPiece-level where-value indices, None for the unusable examples) on the examples of a split.
+    They are computed once per split and BERT vocabulary, and stored next to the data in
+    <mode>_tok.g_wvi_<bert_type>.jsonl: a header line with the size and mtime of <mode>_tok.jsonl, then one line
+    per example. A stale file (the data changed) is recomputed.
+    :param save: write the file. Off for partial data (toy_model).
+    :return: # of unusable examples
+    """
+    path_data = os.path.join(path_wikisql, mode + '_tok.jsonl')
+    path = os.path.join(path_wikisql, f'{mode}_tok.g_wvi_{bert_type}.jsonl')
+    st = os.stat(path_data)
+    meta = {'size': st.st_size, 'mtime': st.st_mtime}
+
+    g_wvi = None
+    if os.path.exists(path):
+        with open(path) as f:
+            if json.loads(f.readline()) == meta:
+                g_wvi = [json.loads(line) for line in f]
+        if g_wvi is not None and len(g_wvi) < len(data):
+            g_wvi = None
+    if g_wvi is None:
+        g_wvi = [get_g_wvi1(tokenizer, t1) for t1 in data]
+        if save:
+            try:
+                with open(path, 'w') as f:
+                    f.write(json.dumps(meta) + '\n')
+                    for g_wvi1 in g_wvi:
+                        f.write(json.dumps(g_wvi1) + '\n')
+            except OSError:
+                pass  # e.g. read-only data directory: computed again next time.
+
+    for t1, g_wvi1 in zip(data, g_wvi):
+        t1['g_wvi'] = g_wvi1
+    return sum(t1['g_wvi'] is None for t1 in data)
+
+
 def get_g_wvi_bert_from_sql_i(nlu, nlu_t, wh_to_wp_index, sql_i, sql_t, tokenizer, nlu_wp_t):
     """
     Generate SQuAD style start and end index of wv in nlu. Index is for of after WordPiece tokenization.
@@ -1334,15 +1531,7 @@ def get_cnt_sc(g_sc, pr_sc):
     return cnt
 
 def get_cnt_sc_list(g_sc, pr_sc):
-    cnt_list = []
-    for b, g_sc1 in enumerate(g_sc):
-        pr_sc1 = pr_sc[b]
-        if pr_sc1 == g_sc1:
-            cnt_list.append(1)
-        else:
-            cnt_list.append(0)
-
-    return cnt_list
+    return metrics.to_list(np.asarray(g_sc) == np.asarray(pr_sc))
 
 def get_cnt_sa(g_sa, pr_sa):
     cnt = 0
@@ -1383,26 +1572,7 @@ def get_cnt_wc(g_wc, pr_wc):
     return cnt
 
 def get_cnt_wc_list(g_wc, pr_wc):
-    cnt_list= []
-    for b, g_wc1 in enumerate(g_wc):
-
-        pr_wc1 = pr_wc[b]
-        pr_wn1 = len(pr_wc1)
-        g_wn1 = len(g_wc1)
-
-        if pr_wn1 != g_wn1:
-            cnt_list.append(0)
-            continue
-        else:
-            wc1 = array(g_wc1)
-            wc1.sort()
-
-            if array_equal(pr_wc1, wc1):
-                cnt_list.append(1)
-            else:
-                cnt_list.append(0)
-
-    return cnt_list
+    return metrics.to_list(metrics.get_cnt_wc(g_wc, pr_wc, metrics.get_width(g_wc, pr_wc)))
 
 
 def get_cnt_wo(g_wn, g_wc, g_wo, pr_wc, pr_wo, mode):
@@ -1446,37 +1616,10 @@ def get_cnt_wo_list(g_wn, g_wc, g_wo, pr_wc, pr_wo, mode):
 
         Sort g's in increasing order (in column idx)
     """
-    cnt_list=[]
-    for b, g_wo1 in enumerate(g_wo):
-        g_wc1 = g_wc[b]
-        pr_wc1 = pr_wc[b]
-        pr_wo1 = pr_wo[b]
-        pr_wn1 = len(pr_wo1)
-        g_wn1 = g_wn[b]
-
-        if g_wn1 != pr_wn1:
-            cnt_list.append(0)
-            continue
-        else:
-            # Sort based wc sequence.
-            if mode == 'test':
-                idx = argsort(array(g_wc1))
-
-                g_wo1_s = array(g_wo1)[idx]
-                g_wo1_s = list(g_wo1_s)
-            elif mode == 'train':
-                # due to tearch forcing, no need to sort.
-                g_wo1_s = g_wo1
-            else:
-                raise ValueError
-
-            if type(pr_wo1) != list:
-                raise TypeError
-            if g_wo1_s == pr_wo1:
-                cnt_list.append(1)
-            else:
-                cnt_list.append(0)
-    return cnt_list
+    g_wn = np.asarray(g_wn, dtype=np.int64)
+    width = metrics.get_width(g_wc, g_wo, pr_wo)
+    order = metrics.get_order(g_wn, g_wc, width, mode)
+    return metrics.to_list(metrics.get_cnt_wo(g_wn, g_wo, pr_wo, order, width))
 
 
 def get_cnt_wv(g_wn, g_wc, g_wvi, pr_wvi, mode):
@@ -1522,42 +1665,10 @@ def get_cnt_wv(g_wn, g_wc, g_wvi, pr_wvi, mode):
 def get_cnt_wvi_list(g_wn, g_wc, g_wvi, pr_wvi, mode):
     """ usalbe only when g_wc was used to find pr_wv
     """
-    cnt_list =[]
-    for b, g_wvi1 in enumerate(g_wvi):
-        g_wc1 = g_wc[b]
-        pr_wvi1 = pr_wvi[b]
-        pr_wn1 = len(pr_wvi1)
-        g_wn1 = g_wn[b]
-
-        # Now sorting.
-        # Sort based wc sequence.
-        if mode == 'test':
-            idx1 = argsort(array(g_wc1))
-        elif mode == 'train':
-            idx1 = list( range( g_wn1) )
-        else:
-            raise ValueError
-
-        if g_wn1 != pr_wn1:
-            cnt_list.append(0)
-            continue
-        else:
-            flag = True
-            for i_wn, idx11 in enumerate(idx1):
-                g_wvi11 = g_wvi1[idx11]
-                pr_wvi11 = pr_wvi1[i_wn]
-                if g_wvi11 != pr_wvi11:
-                    flag = False
-                    # print(g_wv1, g_wv11)
-                    # print(pr_wv1, pr_wv11)
-                    # input('')
-                    break
-            if flag:
-                cnt_list.append(1)
-            else:
-                cnt_list.append(0)
-
-    return cnt_list
+    g_wn = np.asarray(g_wn, dtype=np.int64)
+    width = metrics.get_width(g_wc, g_wvi, pr_wvi)
+    order = metrics.get_order(g_wn, g_wc, width, mode)
+    return metrics.to_list(metrics.get_cnt_wvi(g_wn, g_wvi, pr_wvi, order, width))
 
 
 def get_cnt_wv_list(g_wn, g_wc, g_sql_i, pr_sql_i, mode):
@@ -1619,15 +1730,9 @@ def get_cnt_sw_list(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi,
                     mode):
     """ usalbe only when g_wc was used to find pr_wv
     """
-    cnt_sc = get_cnt_sc_list(g_sc, pr_sc)
-    cnt_sa = get_cnt_sc_list(g_sa, pr_sa)
-    cnt_wn = get_cnt_sc_list(g_wn, pr_wn)
-    cnt_wc = get_cnt_wc_list(g_wc, pr_wc)
-    cnt_wo = get_cnt_wo_list(g_wn, g_wc, g_wo, pr_wc, pr_wo, mode)
-    if pr_wvi:
-        cnt_wvi = get_cnt_wvi_list(g_wn, g_wc, g_wvi, pr_wvi, mode)
-    else:
-        cnt_wvi = [0]*len(cnt_sc)
+    # All parts but the where-value strings in a few array operations. See metrics.py.
+    cnts = metrics.get_cnt_sw(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi, pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi, mode)
+    cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi = [metrics.to_list(cnt) for cnt in cnts]
     cnt_wv = get_cnt_wv_list(g_wn, g_wc, g_sql_i, pr_sql_i, mode) # compare using wv-str which presented in original data.
 
 
@@ -1636,15 +1741,7 @@ def get_cnt_sw_list(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi,
 
 def get_cnt_lx_list(cnt_sc1, cnt_sa1, cnt_wn1, cnt_wc1, cnt_wo1, cnt_wv1):
     # all cnt are list here.
-    cnt_list = []
-    cnt_lx = 0
-    for csc, csa, cwn, cwc, cwo, cwv in zip(cnt_sc1, cnt_sa1, cnt_wn1, cnt_wc1, cnt_wo1, cnt_wv1):
-        if csc and csa and cwn and cwc and cwo and cwv:
-            cnt_list.append(1)
-        else:
-            cnt_list.append(0)
-
-    return cnt_list
+    return metrics.to_list(metrics.get_cnt_lx(cnt_sc1, cnt_sa1, cnt_wn1, cnt_wc1, cnt_wo1, cnt_wv1))
 
 
 def get_cnt_x_list(engine, tb, g_sc, g_sa, g_sql_i, pr_sc, pr_sa, pr_sql_i):
@@ -2388,7 +2485,7 @@ def cal_prob_wo(s_wo, pr_wo):
 
 
 def cal_prob_wvi_se(s_wv, pr_wvi):
-    prob_wv = F.softmax(s_wv, dim=-2).detach().to('cpu').numpy()
+    prob_wv = F.softmax(s_wv, dim=-2).detach().float().to('cpu').numpy()
     p_wv = []
     for b, pr_wvi1 in enumerate(pr_wvi):
         p_wv1 = []
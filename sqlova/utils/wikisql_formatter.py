@@ -5,7 +5,6 @@
 # Wonseok Hwang
 # Convert the wikisql format to the suitable format for the BERT.
 import os, sys, json
-from matplotlib.pylab import *
 
 
 def get_squad_style_ans(nlu, sql):
@@ -23,31 +22,35 @@ def get_squad_style_ans(nlu, sql):
     return answers
 
 
-def get_qas(path_q, tid):
-    qas = []
-    with open(path_q, 'r') as f_q:
-        qnum = -1
-        for j, q1 in enumerate(f_q):
-            q1 = json.loads(q1)
-            tid_q = q1['table_id']
+def get_qas1(q1, qnum):
+    qas1 = {}
+    nlu = q1['question']
+    sql = q1['sql']
+
+    qas1['question'] = nlu
+    qas1['id'] = f"{q1['table_id']}-{qnum}"
+    qas1['answers'] = get_squad_style_ans(nlu, sql)
+    qas1['c_answers'] = sql
+    return qas1
 
-            if tid_q != tid:
-                continue
-            else:
-                qnum += 1
-                #                 print(tid_q, tid)
-                qas1 = {}
-                nlu = q1['question']
-                sql = q1['sql']
 
-                qas1['question'] = nlu
-                qas1['id'] = f'{tid_q}-{qnum}'
-                qas1['answers'] = get_squad_style_ans(nlu, sql)
-                qas1['c_answers'] = sql
+def index_qas(path_q):
+    """
+    One pass over the questions.
+    :return: {table_id: qas of the table, in file order}
+    """
+    qas_by_tid = {}
+    with open(path_q, 'r') as f_q:
+        for q1 in f_q:
+            q1 = json.loads(q1)
+            qas = qas_by_tid.setdefault(q1['table_id'], [])
+            qas.append(get_qas1(q1, len(qas)))
+    return qas_by_tid
 
-                qas.append(qas1)
 
-    return qas
+def get_qas(path_q, tid):
+    """ qas of a single table. Reads all questions: use index_qas for more than one table. """
+    return index_qas(path_q).get(tid, [])
 
 
 def get_tbl_context(t1):
@@ -61,23 +64,26 @@ def get_tbl_context(t1):
     return context
 
 def generate_wikisql_bert(path_wikisql, dset_type):
+    """
+    Write <dset_type>_bert.json: a single paragraph list, one paragraph per table with the questions on it.
+    Tables are streamed to the file, the questions are indexed by table first.
+    """
     path_q = os.path.join(path_wikisql, f'{dset_type}.jsonl')
     path_tbl = os.path.join(path_wikisql, f'{dset_type}.tables.jsonl')
 
-    # Generate new json file
-    with open(path_tbl, 'r') as f_tbl:
-        wikisql = {'version': "v1.1"}
-        data = []
-        data1 = {}
-        paragraphs = []  # new tbls
+    qas_by_tid = index_qas(path_q)
+
+    # Same as json.dumps({'version': "v1.1", 'data': [{'paragraphs': paragraphs, 'title': 'wikisql'}]}).
+    with open(path_tbl, 'r') as f_tbl, \
+            open(os.path.join(path_wikisql, f'{dset_type}_bert.json'), 'w', encoding='utf-8') as fnew:
+        fnew.write('{"version": "v1.1", "data": [{"paragraphs": [')
         for i, t1 in enumerate(f_tbl):
             paragraphs1 = {}
 
             t1 = json.loads(t1)
             tid = t1['id']
-            qas = get_qas(path_q, tid)
 
-            paragraphs1['qas'] = qas
+            paragraphs1['qas'] = qas_by_tid.get(tid, [])
             paragraphs1['tid'] = tid
             paragraphs1['context'] = get_tbl_context(t1)
             #         paragraphs1['context_page_title'] = t1['page_title'] # not always present
@@ -85,17 +91,10 @@ def generate_wikisql_bert(path_wikisql, dset_type):
             paragraphs1['context_headers_type'] = t1['types']
             paragraphs1['context_contents'] = t1['rows']
 
-            paragraphs.append(paragraphs1)
-        data1['paragraphs'] = paragraphs
-        data1['title'] = 'wikisql'
-        data.append(data1)
-        wikisql['data'] = data
-
-    # Save
-    with open(os.path.join(path_wikisql, f'{dset_type}_bert.json'), 'w', encoding='utf-8') as fnew:
-        json_str = json.dumps(wikisql, ensure_ascii=False)
-        json_str += '\n'
-        fnew.writelines(json_str)
+            if i > 0:
+                fnew.write(', ')
+            fnew.write(json.dumps(paragraphs1, ensure_ascii=False))
+        fnew.write('], "title": "wikisql"}]}\n')
 
 
 if __name__=='__main__':
@@ -0,0 +1,60 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Parity of the local annotator with CoreNLP, without a CoreNLP server: fixtures/corenlp_annotations.jsonl holds
+# the CoreNLP gloss / words / after of WikiSQL-like questions and where-values (commas, quotes, contractions,
+# abbreviations, brackets).
+import json
+import os
+
+from sqlova.utils.annotator import LocalAnnotator, compare_annotators
+
+path_fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class FixtureAnnotator:
+    """ Replays the stored CoreNLP outputs. """
+    def __init__(self, records):
+        self.records = {r['sentence']: r for r in records}
+
+    def annotate(self, sentence, lower=True):
+        r = self.records[sentence]
+        words = [w.lower() for w in r['words']] if lower else r['words']
+        return {'gloss': r['gloss'], 'words': words, 'after': r['after']}
+
+
+def load_records():
+    with open(os.path.join(path_fixtures, 'corenlp_annotations.jsonl')) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_local_matches_corenlp():
+    records = load_records()
+    annotator = LocalAnnotator()
+    for r in records:
+        a = annotator.annotate(r['sentence'], lower=False)
+        assert a == {'gloss': r['gloss'], 'words': r['words'], 'after': r['after']}, r['sentence']
+
+
+def test_compare_annotators():
+    records = load_records()
+    stats = compare_annotators([r['sentence'] for r in records], FixtureAnnotator(records), LocalAnnotator())
+    assert stats['n'] == len(records)
+    assert stats['mismatch_any'] == 0, stats['examples']
+
+
+def test_compare_annotators_reports_mismatches():
+    records = load_records()
+    ref = FixtureAnnotator(records)
+    sentence = records[0]['sentence']
+    ref.records[sentence] = dict(ref.records[sentence], gloss=['x'])
+    stats = compare_annotators([sentence], ref, LocalAnnotator())
+    assert stats['mismatch'] == {'gloss': 1, 'words': 0, 'after': 0}
+    assert stats['examples'][0]['sentence'] == sentence
+
+
+def test_split_commas():
+    annotator = LocalAnnotator()
+    assert annotator.annotate('Jones,Smith,Brown')['gloss'] == ['Jones', ',', 'Smith', ',', 'Brown']
+    assert annotator.annotate('a,b,c')['gloss'] == ['a', ',', 'b', ',', 'c']
+    assert annotator.annotate('1,000,000 people')['gloss'] == ['1,000,000', 'people']
@@ -0,0 +1,20 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# load_exported_models on an export without the ONNX models (export_model.py --no_onnx).
+import json
+
+import pytest
+
+pytest.importorskip('torch')
+
+from sqlova.model.nl2sql import export
+
+
+def test_onnx_backend_without_onnx_models(tmp_path, monkeypatch):
+    with open(tmp_path / 'export_config.json', 'w') as f:
+        json.dump({'num_hidden_layers': 2, 'num_target_layers': 2, 'onnx': False}, f)
+    # onnxruntime available: the onnx backend is not replaced by TorchScript.
+    monkeypatch.setattr(export, 'ort', object())
+    with pytest.raises(ValueError, match='--backend torchscript'):
+        export.load_exported_models(str(tmp_path), 'onnx')
@@ -0,0 +1,28 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# Decoding of the scores the heads return under bf16 autocast (train.py --precision bf16).
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from sqlova.utils.precision import to_float
+from sqlova.utils.utils_wikisql import pred_sw_se, pred_wc_sorted_by_prob
+
+
+def get_scores(bS=3, n_h=5, mL=7, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return [torch.randn(shape, generator=g) for shape in
+            [(bS, n_h), (bS, 6), (bS, 5), (bS, n_h), (bS, 4, 4), (bS, 4, mL, 2)]]
+
+
+def test_pred_sw_se_bf16():
+    scores = [s.bfloat16() for s in get_scores()]
+    # Same predictions as on the fp32 copies of the bf16 values.
+    assert pred_sw_se(*scores) == pred_sw_se(*[s.float() for s in scores])
+    assert pred_wc_sorted_by_prob(scores[3]) == pred_wc_sorted_by_prob(scores[3].float())
+
+
+def test_to_float():
+    scores = to_float(*[s.bfloat16() for s in get_scores()])
+    assert all(s.dtype == torch.float32 for s in scores)
@@ -0,0 +1,32 @@
+# Copyright 2019-present NAVER Corp.
+# Apache License v2.0
+
+# predict.py --quantize bf16: the Seq2SQL heads run under bf16 autocast and their scores are decoded.
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from sqlova.model.nl2sql.wikisql_models import Seq2SQL_v1
+from sqlova.utils.precision import to_float
+from sqlova.utils.quantize import inference_context
+from sqlova.utils.utils_wikisql import pred_sw_se
+
+
+@pytest.mark.parametrize('mode', ['none', 'bf16'])
+def test_heads_decode(mode):
+    torch.manual_seed(0)
+    iS, bS, n_h = 16, 2, 4
+    model = Seq2SQL_v1(iS, 8, 1, 0.0, n_cond_ops=4, n_agg_ops=6)
+    model.eval()
+    l_n = [5, 3]
+    l_hpu = [2, 1, 3, 2, 1, 2, 2, 1]
+    l_hs = [n_h, n_h]
+    wemb_n = torch.randn(bS, max(l_n), iS)
+    wemb_h = torch.randn(sum(l_hs), max(l_hpu), iS)
+    with torch.no_grad(), inference_context(mode):
+        scores = model(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=False)
+        scores = to_float(*scores)
+        pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(*scores)
+    assert all(s.dtype == torch.float32 for s in scores)
+    assert len(pr_sc) == len(pr_wc) == len(pr_wvi) == bS
+    assert all(len(pr_wc1) == wn1 for pr_wc1, wn1 in zip(pr_wc, pr_wn))
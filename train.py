@@ -4,8 +4,9 @@
 # Wonseok Hwang
 # Sep30, 2018
 import os, sys, argparse, re, json
+from contextlib import nullcontext
 
-from matplotlib.pylab import *
+import numpy as np
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
@@ -19,6 +20,15 @@ from bert.modeling import BertConfig, BertModel
 from sqlova.utils.utils_wikisql import *
 from sqlova.model.nl2sql.wikisql_models import *
 from sqlnet.dbengine import DBEngine
+from sqlova.utils.checkpoint import SAVE_FORMATS, is_fast_load_supported, init_empty, load_checkpoint, \
+    load_model_state, CheckpointWriter
+from sqlova.utils.precision import PRECISIONS, autocast, to_float, get_grad_scaler, backward, step
+from sqlova.utils.distributed import init_distributed, is_distributed, is_main_process, wrap_ddp, unwrap, \
+    no_sync, get_eval_sampler, set_epoch, all_reduce_sum, gather_results
+from sqlova.utils.resume import get_train_state, load_train_state, restore_train_state
+from sqlova.utils.train_metrics import TRAIN_METRICS, ExecAccWorker
+from sqlova.utils.bert_features import BertFeatures
+from sqlova.utils.profiling import StageProfiler, NULL_PROFILER
 
 import logging
 myprint = print
@@ -91,6 +101,55 @@ def construct_hyper_param(parser):
                         default=False,
                         action='store_true',
                         help="If present, Execution guided decoding is used in test.")
+    parser.add_argument('--fast_load',
+                        default=False,
+                        action='store_true',
+                        help="Build models on the meta device and memory-map checkpoints when loading them (torch >= 2.1).")
+    parser.add_argument('--save_format',
+                        default='torch', choices=SAVE_FORMATS,
+                        help="torch: torch.save (*.pt), flat: flat tensor archive (*.safetensors) suited to memory mapping.")
+    parser.add_argument('--precision',
+                        default='fp32', choices=PRECISIONS,
+                        help="Autocast BERT and the Seq-to-SQL module to bf16 / fp16 during training. The loss stays in fp32.")
+    parser.add_argument('--grad_checkpoint_segment',
+                        default=0, type=int,
+                        help="Activation checkpointing of BERT during fine-tuning, N BERT layers per checkpoint. 0: off.")
+    parser.add_argument('--pack',
+                        action='store_true',
+                        help="Pack several examples per BERT input row (block-diagonal attention) instead of padding "
+                             "each example to --max_seq_length.")
+    parser.add_argument('--num_workers',
+                        default=4, type=int,
+                        help="DataLoader workers. They tokenize the batches and build the BERT inputs. 0: in the main process.")
+    parser.add_argument('--prefetch_factor',
+                        default=2, type=int,
+                        help="Number of batches prepared ahead by each DataLoader worker.")
+    parser.add_argument('--save_every',
+                        default=0, type=int,
+                        help="Write the full training state (train_state.pt in --save_dir) every N batches, rounded up "
+                             "to a multiple of --accumulate_gradients, and at the end of every epoch. 0: off.")
+    parser.add_argument('--train_metrics',
+                        default='full', choices=TRAIN_METRICS,
+                        help="Accuracies reported on the train set. none: loss only, logical: + acc_lx, "
+                             "full: + acc_x, executed on a subsample (--train_exec_rate) in a background thread.")
+    parser.add_argument('--train_exec_rate',
+                        default=1.0, type=float,
+                        help="Fraction of the train examples whose execution accuracy is computed (--train_metrics full).")
+    parser.add_argument('--keep_last',
+                        default=1, type=int,
+                        help="Keep the N last versions of each saved checkpoint (model_best.pt, model_best.1.pt, ...).")
+    parser.add_argument('--resume',
+                        type=str, default=None,
+                        help="Resume training from a training state written with --save_every.")
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help="Time the stages of the train / dev / test loops and report throughput after each "
+                             "epoch. Reports are appended to <save_dir>/profile.jsonl.")
+    parser.add_argument('--profile_torch_steps', default=0, type=int,
+                        help="With --profile, also trace the first N batches of each loop with torch.profiler "
+                             "(Chrome traces <save_dir>/trace_<split>_<epoch>.json).")
+    parser.add_argument('--bert_features', default=None, type=str,
+                        help="Directory of BERT features written by extract_bert_features.py. Read instead of "
+                             "running BERT (without --fine_tune).")
 
     args = parser.parse_args()
 
@@ -109,7 +168,6 @@ def construct_hyper_param(parser):
         args.do_lower_case = True
 
     # Seeds for random number generation
-    seed(args.seed)
     python_random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -123,27 +181,37 @@ def construct_hyper_param(parser):
     return args
 
 
-def get_bert(BERT_PT_PATH, bert_type, do_lower_case, no_pretraining):
-
-
+def get_bert_config_tokenizer(BERT_PT_PATH, bert_type, do_lower_case):
     bert_config_file = os.path.join(BERT_PT_PATH, f'bert_config_{bert_type}.json')
     vocab_file = os.path.join(BERT_PT_PATH, f'vocab_{bert_type}.txt')
-    init_checkpoint = os.path.join(BERT_PT_PATH, f'pytorch_model_{bert_type}.bin')
-
-
 
     bert_config = BertConfig.from_json_file(bert_config_file)
     tokenizer = tokenization.FullTokenizer(
         vocab_file=vocab_file, do_lower_case=do_lower_case)
     bert_config.print_status()
 
-    model_bert = BertModel(bert_config)
+    return bert_config, tokenizer
+
+
+def get_bert(BERT_PT_PATH, bert_type, do_lower_case, no_pretraining, fast_load=False):
+    """
+    fast_load: build BertModel on the meta device. Its parameters must then be loaded with
+               load_model_state(..., assign=True), here from the pre-trained checkpoint or later by the caller.
+    """
+
+    init_checkpoint = os.path.join(BERT_PT_PATH, f'pytorch_model_{bert_type}.bin')
+
+    bert_config, tokenizer = get_bert_config_tokenizer(BERT_PT_PATH, bert_type, do_lower_case)
+
+    with init_empty(fast_load):
+        model_bert = BertModel(bert_config)
     if no_pretraining:
         pass
     else:
-        model_bert.load_state_dict(torch.load(init_checkpoint, map_location='cpu'))
+        load_model_state(model_bert, load_checkpoint(init_checkpoint, use_mmap=fast_load), assign=fast_load)
         print("Load pre-trained parameters.")
-    model_bert.to(device)
+    if not next(model_bert.parameters()).is_meta:
+        model_bert.to(device)
 
     return model_bert, tokenizer, bert_config
 
@@ -175,9 +243,15 @@ def get_models(args, BERT_PT_PATH, trained=False, path_model_bert=None, path_mod
     print(f"Execution guided decoding:: {args.EG}")
 
 
+    # Fast load: skip the random init of weights that are loaded right after.
+    fast_load = args.fast_load and (trained or not args.no_pretraining)
+    if fast_load and not is_fast_load_supported():
+        print("--fast_load needs torch >= 2.1. Loading checkpoints the usual way.")
+        fast_load = False
+
     # Get BERT
     model_bert, tokenizer, bert_config = get_bert(BERT_PT_PATH, args.bert_type, args.do_lower_case,
-                                                  args.no_pretraining)
+                                                  args.no_pretraining, fast_load=fast_load)
     args.iS = bert_config.hidden_size * args.num_target_layers  # Seq-to-SQL input vector dimenstion
 
     # Get Seq-to-SQL
@@ -189,40 +263,58 @@ def get_models(args, BERT_PT_PATH, trained=False, path_model_bert=None, path_mod
     print(f"Seq-to-SQL: LSTM encoding layer size = {args.lS}")
     print(f"Seq-to-SQL: dropout rate = {args.dr}")
     print(f"Seq-to-SQL: learning rate = {args.lr}")
-    model = Seq2SQL_v1(args.iS, args.hS, args.lS, args.dr, n_cond_ops, n_agg_ops)
-    model = model.to(device)
+    with init_empty(fast_load and trained):
+        model = Seq2SQL_v1(args.iS, args.hS, args.lS, args.dr, n_cond_ops, n_agg_ops)
+    if not (fast_load and trained):
+        model = model.to(device)
 
     if trained:
         assert path_model_bert != None
         assert path_model != None
 
-        if torch.cuda.is_available():
-            res = torch.load(path_model_bert)
-        else:
-            res = torch.load(path_model_bert, map_location='cpu')
-        model_bert.load_state_dict(res['model_bert'])
+        # *.pt (torch.save) or *.safetensors (flat archive, see --save_format)
+        res = load_checkpoint(path_model_bert, 'model_bert', use_mmap=fast_load)
+        load_model_state(model_bert, res, assign=fast_load)
         model_bert.to(device)
 
-        if torch.cuda.is_available():
-            res = torch.load(path_model)
-        else:
-            res = torch.load(path_model, map_location='cpu')
-
-        model.load_state_dict(res['model'])
+        res = load_checkpoint(path_model, 'model', use_mmap=fast_load)
+        load_model_state(model, res, assign=fast_load)
+        model.to(device)
 
     return model, model_bert, tokenizer, bert_config
 
-def get_data(path_wikisql, args):
+def get_data(path_wikisql, args, tokenizer):
+    """ Batches are tokenized and turned into BERT input tensors in the DataLoader workers (collate_wikisql). """
     train_data, train_table, dev_data, dev_table, _, _ = load_wikisql(path_wikisql, args.toy_model, args.toy_size, no_w2i=True, no_hs_tok=True)
-    train_loader, dev_loader = get_loader_wikisql(train_data, dev_data, args.bS, shuffle_train=True)
+    # WordPiece-level g_wvi, computed once and stored with the data.
+    n_unusable = load_g_wvi(path_wikisql, 'train', train_data, tokenizer, args.bert_type, save=not args.toy_model)
+    load_g_wvi(path_wikisql, 'dev', dev_data, tokenizer, args.bert_type, save=not args.toy_model)
+    # Train examples whose where-values are not found in the question cannot be used. Dropped up front, so that
+    # batches stay full and train() does not skip the batches holding them (on all ranks when distributed).
+    train_data = [t1 for t1 in train_data if t1['g_wvi'] is not None]
+    print(f"{n_unusable} train examples without where-value indices are dropped")
+    train_loader, dev_loader = get_loader_wikisql(train_data, dev_data, args.bS, shuffle_train=True, seed=args.seed,
+                                                  tokenizer=tokenizer, table_train=train_table, table_dev=dev_table,
+                                                  max_seq_length=args.max_seq_length, pack=args.pack,
+                                                  num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
     return train_data, train_table, dev_data, dev_table, train_loader, dev_loader
 
 
 def train(train_loader, train_table, model, model_bert, opt, bert_config, tokenizer,
           max_seq_length, num_target_layers, accumulate_gradients=1, check_grad=True,
-          st_pos=0, opt_bert=None, path_db=None, dset_name='train', constraint=True,
-          mask_dropout=0.0):
+          st_iB=0, opt_bert=None, path_db=None, dset_name='train', constraint=True,
+          mask_dropout=0.0, precision='fp32', scaler=None, save_every=0, save_state=None,
+          train_metrics='full', exec_rate=1.0, seed=0, features=None, profiler=NULL_PROFILER):
+    """
+    st_iB: index of the first batch, when resuming mid-epoch. The sampler of train_loader must already start
+           there (ResumableSampler.set_start). The accuracies then cover the batches from st_iB on.
+    save_state: called as save_state(iB) every save_every batches, before batch iB.
+    train_metrics: none / logical / full (see sqlova.utils.train_metrics). Accuracies not computed are nan.
+    exec_rate: fraction of the examples whose execution accuracy is computed, off the training thread.
+    features: BertFeatures of the split, read instead of running model_bert (not fine-tuned).
+    profiler: StageProfiler timing the stages of the loop.
+    """
     model.train()
     model_bert.train()
 
@@ -237,136 +329,187 @@ def train(train_loader, train_table, model, model_bert, opt, bert_config, tokeni
     cnt_wvi = 0 # of where-value index (on question tokens)
     cnt_lx = 0  # of logical form acc
     cnt_x = 0   # of execution acc
+    cnt_pr = 0  # of examples predicted (not skipped)
 
-    # Engine for SQL querying.
-    engine = DBEngine(os.path.join(path_db, f"{dset_name}.db"))
+    # Execution accuracy is computed in a background thread with its own engine for SQL querying.
+    if train_metrics == 'full':
+        fdb = os.path.join(path_db, f"{dset_name}.db")
+        exec_worker = ExecAccWorker(lambda: DBEngine(fdb), rate=exec_rate, seed=seed + st_iB)
 
-    for iB, t in enumerate(train_loader):
-        cnt += len(t)
+    # Distributed: the shards of the ranks are padded to equal length with repeated examples (ResumableSampler).
+    # Only the first n_real examples of the shard are counted.
+    n_real = getattr(train_loader.sampler, 'n_real', None)
+
+    for iB, batch in enumerate(profiler.iter(train_loader), st_iB):
+        if save_state is not None and save_every > 0 and iB > st_iB and iB % save_every == 0:
+            save_state(iB)
+
+        # batch is preprocessed by collate_wikisql in the DataLoader workers.
+        t = batch['t']
+        n1 = len(t) if n_real is None else max(0, min(len(t), n_real - iB * train_loader.batch_size))
+        cnt += n1
 
-        if cnt < st_pos:
-            continue
         # Get fields
-        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, train_table, no_hs_t=True, no_sql_t=True)
+        nlu, nlu_t, sql_i, tb, hds = batch['nlu'], batch['nlu_t'], batch['sql_i'], batch['tb'], batch['hds']
         # nlu  : natural language utterance
         # nlu_t: tokenized nlu
         # sql_i: canonical form of SQL query
-        # sql_q: full SQL query text. Not used.
-        # sql_t: tokenized SQL query
         # tb   : table
-        # hs_t : tokenized headers. Not used.
-
-        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
-        # get ground truth where-value index under CoreNLP tokenization scheme. It's done already on trainset.
-        g_wvi_corenlp = get_g_wvi_corenlp(t)
-
-        wemb_n, wemb_h, l_n, l_hpu, l_hs, \
-        nlu_tt, t_to_tt_idx, tt_to_t_idx \
-            = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
-                            num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers)
-
-        # wemb_n: natural language embedding
-        # wemb_h: header embedding
-        # l_n: token lengths of each question
-        # l_hpu: header token lengths
-        # l_hs: the number of columns (headers) of the tables.
-        try:
-            #
-            g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
-        except:
-            # Exception happens when where-condition is not found in nlu_tt.
-            # In this case, that train example is not used.
-            # During test, that example considered as wrongly answered.
-            # e.g. train: 32.
-            continue
 
-        if constraint:
-            s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs,
-                                                       g_sc=g_sc, g_sa=g_sa, g_wn=g_wn, g_wc=g_wc, g_wvi=g_wvi,
-                                                       constraint=constraint, tb=tb, mask_dropout=mask_dropout)
-        else:
-            s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs,
-                                                       g_sc=g_sc, g_sa=g_sa, g_wn=g_wn, g_wc=g_wc, g_wvi=g_wvi,
-                                                       constraint=False)
-
-        # Calculate loss & step
-        loss = Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi)
-
-        # Calculate gradient
-        if iB % accumulate_gradients == 0: # mode
-            # at start, perform zero_grad
-            opt.zero_grad()
-            if opt_bert:
-                opt_bert.zero_grad()
-            loss.backward()
-            if accumulate_gradients == 1:
-                opt.step()
-                if opt_bert:
-                    opt_bert.step()
-        elif iB % accumulate_gradients == (accumulate_gradients-1):
-            # at the final, take step with accumulated graident
-            loss.backward()
-            opt.step()
-            if opt_bert:
-                opt_bert.step()
-        else:
-            # at intermediate stage, just accumulates the gradients
-            loss.backward()
+        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = batch['g_sc'], batch['g_sa'], batch['g_wn'], batch['g_wc'], \
+                                             batch['g_wo'], batch['g_wv']
+        # ground truth where-value index under WordPiece tokenization scheme.
+        g_wvi = batch['g_wvi']
+
+        # g_wvi is None when where-condition is not found in nlu_tt.
+        # In this case, that train example is not used.
+        # During test, that example considered as wrongly answered.
+        # e.g. train: 32.
+        # get_data drops those train examples up front: no collective call is needed to skip the batch on all ranks.
+        if g_wvi is None:
+            if is_distributed():
+                raise ValueError("Train examples without where-value indices: drop them before training (get_data)")
+            continue
 
-        # Prediction
-        pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, )
-        pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
+        # Distributed: the gradients of the micro-batches before the last one of an accumulation are only summed
+        # locally, the last backward all-reduces them.
+        sync = iB % accumulate_gradients == (accumulate_gradients-1)
+        with no_sync(model, model_bert) if not sync else nullcontext():
+            with profiler.stage('bert'):
+                if features is not None:
+                    wemb_n, wemb_h, l_n, l_hpu, l_hs, t_to_tt_idx \
+                        = features.get_wemb(t, num_target_layers, num_target_layers)
+                    nlu_tt, tt_to_t_idx = batch['bert_input'][-3], batch['bert_input'][-1]
+                else:
+                    with autocast(precision, device):
+                        wemb_n, wemb_h, l_n, l_hpu, l_hs, \
+                        nlu_tt, t_to_tt_idx, tt_to_t_idx \
+                            = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
+                                            num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers,
+                                            bert_input=batch['bert_input'])
+            profiler.add_batch(len(t), l_n, l_hpu, l_hs, max_seq_length, n_rows=batch['bert_input'][0].size(0))
+
+            # wemb_n: natural language embedding
+            # wemb_h: header embedding
+            # l_n: token lengths of each question
+            # l_hpu: header token lengths
+            # l_hs: the number of columns (headers) of the tables.
+
+            with profiler.stage('heads'):
+                with autocast(precision, device):
+                    if constraint:
+                        s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs,
+                                                                   g_sc=g_sc, g_sa=g_sa, g_wn=g_wn, g_wc=g_wc,
+                                                                   g_wvi=g_wvi, constraint=constraint, tb=tb,
+                                                                   mask_dropout=mask_dropout)
+                    else:
+                        s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs,
+                                                                   g_sc=g_sc, g_sa=g_sa, g_wn=g_wn, g_wc=g_wc,
+                                                                   g_wvi=g_wvi, constraint=False)
+                # fp32 for the loss and for the decoding below.
+                s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = to_float(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv)
+
+                # Calculate loss & step. Loss_sw_se runs in fp32.
+                loss = Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi)
+
+            # Calculate gradient
+            with profiler.stage('backward'):
+                if iB % accumulate_gradients == 0: # mode
+                    # at start, perform zero_grad
+                    opt.zero_grad()
+                    if opt_bert:
+                        opt_bert.zero_grad()
+                    backward(loss, scaler)
+                    if accumulate_gradients == 1:
+                        step([opt, opt_bert], scaler)
+                elif iB % accumulate_gradients == (accumulate_gradients-1):
+                    # at the final, take step with accumulated graident
+                    backward(loss, scaler)
+                    step([opt, opt_bert], scaler)
+                else:
+                    # at intermediate stage, just accumulates the gradients
+                    backward(loss, scaler)
 
-        # Sort pr_wc:
-        #   Sort pr_wc when training the model as pr_wo and pr_wvi are predicted using ground-truth where-column (g_wc)
-        #   In case of 'dev' or 'test', it is not necessary as the ground-truth is not used during inference.
-        pr_wc_sorted = sort_pr_wc(pr_wc, g_wc)
-        pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc_sorted, pr_wo, pr_wv_str, nlu)
+        # statistics
+        ave_loss += loss.item()
 
+        if is_main_process():
+            myprint('Current epoch: processed %d batches' % iB, end='\r',flush=True)
 
-        # Cacluate accuracy
-        cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, \
-        cnt_wc1_list, cnt_wo1_list, \
-        cnt_wvi1_list, cnt_wv1_list = get_cnt_sw_list(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi,
-                                                                   pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi,
-                                                                   sql_i, pr_sql_i,
-                                                                   mode='train')
-
-        cnt_lx1_list = get_cnt_lx_list(cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list,
-                                       cnt_wo1_list, cnt_wv1_list)
-        # lx stands for logical form accuracy
-
-        # Execution accuracy test.
-        cnt_x1_list, g_ans, pr_ans = get_cnt_x_list(engine, tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i)
+        if train_metrics == 'none':
+            continue
 
-        # statistics
-        ave_loss += loss.item()
+        # Prediction
+        with profiler.stage('decode'):
+            pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, )
+            pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
 
-        # count
-        cnt_sc += sum(cnt_sc1_list)
-        cnt_sa += sum(cnt_sa1_list)
-        cnt_wn += sum(cnt_wn1_list)
-        cnt_wc += sum(cnt_wc1_list)
-        cnt_wo += sum(cnt_wo1_list)
-        cnt_wvi += sum(cnt_wvi1_list)
-        cnt_wv += sum(cnt_wv1_list)
-        cnt_lx += sum(cnt_lx1_list)
-        cnt_x += sum(cnt_x1_list)
+            # Sort pr_wc:
+            #   Sort pr_wc when training the model as pr_wo and pr_wvi are predicted using ground-truth where-column (g_wc)
+            #   In case of 'dev' or 'test', it is not necessary as the ground-truth is not used during inference.
+            pr_wc_sorted = sort_pr_wc(pr_wc, g_wc)
+            pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc_sorted, pr_wo, pr_wv_str, nlu)
 
-        myprint('Current epoch: processed %d batches' % iB, end='\r',flush=True)
 
-    myprint('')
+        # Cacluate accuracy
+        with profiler.stage('metrics'):
+            cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, \
+            cnt_wc1_list, cnt_wo1_list, \
+            cnt_wvi1_list, cnt_wv1_list = get_cnt_sw_list(g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi,
+                                                                       pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi,
+                                                                       sql_i, pr_sql_i,
+                                                                       mode='train')
+
+            cnt_lx1_list = get_cnt_lx_list(cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list,
+                                           cnt_wo1_list, cnt_wv1_list)
+            # lx stands for logical form accuracy
+
+            # Execution accuracy test. Deferred to the worker. The padding examples (from n1 on) are left out.
+            if train_metrics == 'full':
+                exec_worker.submit(tb[:n1], g_sc[:n1], g_sa[:n1], sql_i[:n1], pr_sc[:n1], pr_sa[:n1], pr_sql_i[:n1])
+
+            # count
+            cnt_pr += n1
+            cnt_sc += sum(cnt_sc1_list[:n1])
+            cnt_sa += sum(cnt_sa1_list[:n1])
+            cnt_wn += sum(cnt_wn1_list[:n1])
+            cnt_wc += sum(cnt_wc1_list[:n1])
+            cnt_wo += sum(cnt_wo1_list[:n1])
+            cnt_wvi += sum(cnt_wvi1_list[:n1])
+            cnt_wv += sum(cnt_wv1_list[:n1])
+            cnt_lx += sum(cnt_lx1_list[:n1])
+
+    if is_main_process():
+        myprint('')
+
+    cnt_x_exec = 0  # of examples executed
+    if train_metrics == 'full':
+        with profiler.stage('execute'):
+            # Waits for the batches not executed yet.
+            cnt_x, cnt_x_exec = exec_worker.close()
+
+    # Distributed: totals over all ranks.
+    ave_loss, cnt, cnt_pr, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x, cnt_x_exec \
+        = all_reduce_sum([ave_loss, cnt, cnt_pr, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx,
+                          cnt_x, cnt_x_exec])
 
     ave_loss /= cnt
-    acc_sc = cnt_sc / cnt
-    acc_sa = cnt_sa / cnt
-    acc_wn = cnt_wn / cnt
-    acc_wc = cnt_wc / cnt
-    acc_wo = cnt_wo / cnt
-    acc_wvi = cnt_wvi / cnt
-    acc_wv = cnt_wv / cnt
-    acc_lx = cnt_lx / cnt
-    acc_x = cnt_x / cnt
+    if train_metrics == 'none':
+        acc_sc = acc_sa = acc_wn = acc_wc = acc_wo = acc_wvi = acc_wv = acc_lx = float('nan')
+    else:
+        acc_sc = cnt_sc / cnt
+        acc_sa = cnt_sa / cnt
+        acc_wn = cnt_wn / cnt
+        acc_wc = cnt_wc / cnt
+        acc_wo = cnt_wo / cnt
+        acc_wvi = cnt_wvi / cnt
+        acc_wv = cnt_wv / cnt
+        acc_lx = cnt_lx / cnt
+    if cnt_x_exec > 0:
+        # Skipped examples count as wrong, like in the other accuracies. Equals cnt_x / cnt when all are executed.
+        acc_x = cnt_x / cnt_x_exec * cnt_pr / cnt
+    else:
+        acc_x = float('nan')
 
     acc = [ave_loss, acc_sc, acc_sa, acc_wn, acc_wc, acc_wo, acc_wvi, acc_wv, acc_lx, acc_x]
 
@@ -422,7 +565,7 @@ def report_detail(hds, nlu,
 def test(data_loader, data_table, model, model_bert, bert_config, tokenizer,
          max_seq_length,
          num_target_layers, detail=False, st_pos=0, cnt_tot=1, EG=False, beam_size=4,
-         path_db=None, dset_name='test', constraint=True):
+         path_db=None, dset_name='test', constraint=True, features=None, profiler=NULL_PROFILER):
     model.eval()
     model_bert.eval()
 
@@ -442,59 +585,73 @@ def test(data_loader, data_table, model, model_bert, bert_config, tokenizer,
 
     engine = DBEngine(os.path.join(path_db, f"{dset_name}.db"))
     results = []
-    for iB, t in enumerate(data_loader):
+    for iB, batch in enumerate(profiler.iter(data_loader)):
+        # batch is preprocessed by collate_wikisql in the DataLoader workers.
+        t = batch['t']
 
         cnt += len(t)
         if cnt < st_pos:
             continue
         # Get fields
-        nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, data_table, no_hs_t=True, no_sql_t=True)
-
-        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
-        g_wvi_corenlp = get_g_wvi_corenlp(t)
-
-        wemb_n, wemb_h, l_n, l_hpu, l_hs, \
-        nlu_tt, t_to_tt_idx, tt_to_t_idx \
-            = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
-                            num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers)
-        try:
-            g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
-            g_wv_str, g_wv_str_wp = convert_pr_wvi_to_string(g_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
-
-        except:
-            # Exception happens when where-condition is not found in nlu_tt.
-            # In this case, that train example is not used.
-            # During test, that example considered as wrongly answered.
-            for b in range(len(nlu)):
-                results1 = {}
-                results1["error"] = "Skip happened"
-                results1["nlu"] = nlu[b]
-                results1["table_id"] = tb[b]["id"]
-                results.append(results1)
-            continue
+        nlu, nlu_t, sql_i, tb, hds = batch['nlu'], batch['nlu_t'], batch['sql_i'], batch['tb'], batch['hds']
+
+        g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = batch['g_sc'], batch['g_sa'], batch['g_wn'], batch['g_wc'], \
+                                             batch['g_wo'], batch['g_wv']
+        g_wvi = batch['g_wvi']
+        nlu_tt, t_to_tt_idx, tt_to_t_idx = batch['bert_input'][-3:]
+        with profiler.stage('decode'):
+            try:
+                g_wv_str, g_wv_str_wp = convert_pr_wvi_to_string(g_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
+
+            except:
+                # Exception happens when where-condition is not found in nlu_tt (g_wvi is None).
+                # In this case, that train example is not used.
+                # During test, that example considered as wrongly answered.
+                for b in range(len(nlu)):
+                    results1 = {}
+                    results1["error"] = "Skip happened"
+                    results1["nlu"] = nlu[b]
+                    results1["table_id"] = tb[b]["id"]
+                    results.append(results1)
+                continue
+
+        with profiler.stage('bert'):
+            if features is not None:
+                wemb_n, wemb_h, l_n, l_hpu, l_hs, t_to_tt_idx \
+                    = features.get_wemb(t, num_target_layers, num_target_layers)
+            else:
+                wemb_n, wemb_h, l_n, l_hpu, l_hs, \
+                nlu_tt, t_to_tt_idx, tt_to_t_idx \
+                    = get_wemb_bert(bert_config, model_bert, tokenizer, nlu_t, hds, max_seq_length,
+                                    num_out_layers_n=num_target_layers, num_out_layers_h=num_target_layers,
+                                    bert_input=batch['bert_input'])
+        profiler.add_batch(len(t), l_n, l_hpu, l_hs, max_seq_length, n_rows=batch['bert_input'][0].size(0))
 
         # model specific part
         # score
         if not EG:
             # No Execution guided decoding
-            s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=constraint, tb=tb)
-
-            # get loss & step
-            loss = Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi)
-
-            # prediction
-            pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, )
-            pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
-            # g_sql_i = generate_sql_i(g_sc, g_sa, g_wn, g_wc, g_wo, g_wv_str, nlu)
-            pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wv_str, nlu)
+            with profiler.stage('heads'):
+                s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hpu, l_hs, constraint=constraint, tb=tb)
+
+                # get loss & step
+                loss = Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi)
+
+                # prediction
+                pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi = pred_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, )
+            with profiler.stage('decode'):
+                pr_wv_str, pr_wv_str_wp = convert_pr_wvi_to_string(pr_wvi, nlu_t, nlu_tt, tt_to_t_idx, nlu)
+                # g_sql_i = generate_sql_i(g_sc, g_sa, g_wn, g_wc, g_wo, g_wv_str, nlu)
+                pr_sql_i = generate_sql_i(pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wv_str, nlu)
         else:
             # Execution guided decoding
-            prob_sca, prob_w, prob_wn_w, pr_sc, pr_sa, pr_wn, pr_sql_i = model.beam_forward(wemb_n, l_n, wemb_h, l_hpu,
-                                                                                            l_hs, engine, tb,
-                                                                                            nlu_t, nlu_tt,
-                                                                                            tt_to_t_idx, nlu,
-                                                                                            constraint=constraint,
-                                                                                            beam_size=beam_size)
+            with profiler.stage('heads'):
+                prob_sca, prob_w, prob_wn_w, pr_sc, pr_sa, pr_wn, pr_sql_i = model.beam_forward(wemb_n, l_n, wemb_h, l_hpu,
+                                                                                                l_hs, engine, tb,
+                                                                                                nlu_t, nlu_tt,
+                                                                                                tt_to_t_idx, nlu,
+                                                                                                constraint=constraint,
+                                                                                                beam_size=beam_size)
             # sort and generate
             pr_wc, pr_wo, pr_wv, pr_sql_i = sort_and_generate_pr_w(pr_sql_i)
 
@@ -504,55 +661,56 @@ def test(data_loader, data_table, model, model_bert, bert_config, tokenizer,
             pr_wv_str_wp=None
             loss = torch.tensor([0])
 
+        with profiler.stage('decode'):
+            g_sql_q = generate_sql_q(sql_i, tb)
+            pr_sql_q = generate_sql_q(pr_sql_i, tb)
 
+        with profiler.stage('metrics'):
+            # Saving for the official evaluation later.
+            for b, pr_sql_i1 in enumerate(pr_sql_i):
+                results1 = {}
+                results1["query"] = pr_sql_i1
+                results1["table_id"] = tb[b]["id"]
+                results1["nlu"] = nlu[b]
+                results.append(results1)
 
-        g_sql_q = generate_sql_q(sql_i, tb)
-        pr_sql_q = generate_sql_q(pr_sql_i, tb)
-
-
-        # Saving for the official evaluation later.
-        for b, pr_sql_i1 in enumerate(pr_sql_i):
-            results1 = {}
-            results1["query"] = pr_sql_i1
-            results1["table_id"] = tb[b]["id"]
-            results1["nlu"] = nlu[b]
-            results.append(results1)
-
-        cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, \
-        cnt_wc1_list, cnt_wo1_list, \
-        cnt_wvi1_list, cnt_wv1_list = get_cnt_sw_list(g_sc, g_sa,g_wn, g_wc,g_wo, g_wvi,
-                                                                   pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi,
-                                                                   sql_i, pr_sql_i,
-                                                                   mode='test')
+            cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, \
+            cnt_wc1_list, cnt_wo1_list, \
+            cnt_wvi1_list, cnt_wv1_list = get_cnt_sw_list(g_sc, g_sa,g_wn, g_wc,g_wo, g_wvi,
+                                                                       pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wvi,
+                                                                       sql_i, pr_sql_i,
+                                                                       mode='test')
 
-        cnt_lx1_list = get_cnt_lx_list(cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list,
-                                       cnt_wo1_list, cnt_wv1_list)
+            cnt_lx1_list = get_cnt_lx_list(cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list,
+                                           cnt_wo1_list, cnt_wv1_list)
 
         # Execution accura y test
         cnt_x1_list = []
         # lx stands for logical form accuracy
 
-        # Execution accuracy test.
-        cnt_x1_list, g_ans, pr_ans = get_cnt_x_list(engine, tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i)
-
-        # stat
-        ave_loss += loss.item()
-
-        # count
-        cnt_sc += sum(cnt_sc1_list)
-        cnt_sa += sum(cnt_sa1_list)
-        cnt_wn += sum(cnt_wn1_list)
-        cnt_wc += sum(cnt_wc1_list)
-        cnt_wo += sum(cnt_wo1_list)
-        cnt_wv += sum(cnt_wv1_list)
-        cnt_wvi += sum(cnt_wvi1_list)
-        cnt_lx += sum(cnt_lx1_list)
-        cnt_x += sum(cnt_x1_list)
-
-        current_cnt = [cnt_tot, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wv, cnt_wvi, cnt_lx, cnt_x]
-        cnt_list1 = [cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list, cnt_wo1_list, cnt_wv1_list, cnt_lx1_list,
-                     cnt_x1_list]
-        cnt_list.append(cnt_list1)
+        with profiler.stage('execute'):
+            # Execution accuracy test.
+            cnt_x1_list, g_ans, pr_ans = get_cnt_x_list(engine, tb, g_sc, g_sa, sql_i, pr_sc, pr_sa, pr_sql_i)
+
+        with profiler.stage('metrics'):
+            # stat
+            ave_loss += loss.item()
+
+            # count
+            cnt_sc += sum(cnt_sc1_list)
+            cnt_sa += sum(cnt_sa1_list)
+            cnt_wn += sum(cnt_wn1_list)
+            cnt_wc += sum(cnt_wc1_list)
+            cnt_wo += sum(cnt_wo1_list)
+            cnt_wv += sum(cnt_wv1_list)
+            cnt_wvi += sum(cnt_wvi1_list)
+            cnt_lx += sum(cnt_lx1_list)
+            cnt_x += sum(cnt_x1_list)
+
+            current_cnt = [cnt_tot, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wv, cnt_wvi, cnt_lx, cnt_x]
+            cnt_list1 = [cnt_sc1_list, cnt_sa1_list, cnt_wn1_list, cnt_wc1_list, cnt_wo1_list, cnt_wv1_list, cnt_lx1_list,
+                         cnt_x1_list]
+            cnt_list.append(cnt_list1)
         # report
         if detail:
             report_detail(hds, nlu,
@@ -560,6 +718,11 @@ def test(data_loader, data_table, model, model_bert, bert_config, tokenizer,
                           pr_sc, pr_sa, pr_wn, pr_wc, pr_wo, pr_wv_str, pr_sql_q, pr_ans,
                           cnt_list1, current_cnt)
 
+    # Distributed: totals over all ranks and the results of the whole data set.
+    ave_loss, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x \
+        = all_reduce_sum([ave_loss, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x])
+    results = gather_results(results)
+
     ave_loss /= cnt
     acc_sc = cnt_sc / cnt
     acc_sa = cnt_sa / cnt
@@ -589,10 +752,12 @@ if __name__ == '__main__':
     ## 1. Hyper parameters
     parser = argparse.ArgumentParser()
     args = construct_hyper_param(parser)
+    init_distributed()
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    # Distributed: only rank 0 logs.
+    logger.setLevel(logging.INFO if is_main_process() else logging.WARNING)
     formatter = logging.Formatter("%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s")
-    if args.log_file is not None:
+    if args.log_file is not None and is_main_process():
         handler = logging.FileHandler("%s/%s.txt" % (args.save_dir, args.log_file), mode='w')
         handler.setLevel(logging.INFO)
         handler.setFormatter(formatter)
@@ -609,32 +774,84 @@ if __name__ == '__main__':
 
     path_save_for_evaluation = args.save_dir
 
-    ## 3. Load data
-    train_data, train_table, dev_data, dev_table, train_loader, dev_loader = get_data(path_wikisql, args)
+    ## 3. Build & Load models
+    model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH)
+
+    ## 3.1.
+    # To start from the pre-trained models, un-comment following lines.
+    # path_model_bert =
+    # path_model =
+    # model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH, trained=True, path_model_bert=path_model_bert, path_model=path_model)
+
+    ## 4. Load data
+    train_data, train_table, dev_data, dev_table, train_loader, dev_loader = get_data(path_wikisql, args, tokenizer)
     test_data, test_table = load_wikisql_data(path_wikisql, mode='test', toy_model=args.toy_model, toy_size=args.toy_size, no_hs_tok=True)
+    load_g_wvi(path_wikisql, 'test', test_data, tokenizer, args.bert_type, save=not args.toy_model)
     test_loader = torch.utils.data.DataLoader(
         batch_size=args.bS,
         dataset=test_data,
         shuffle=False,
-        num_workers=4,
-        collate_fn=lambda x: x  # now dictionary values are not merged!
+        sampler=get_eval_sampler(test_data),
+        **get_loader_options(get_collate_fn(test_table, tokenizer, args.max_seq_length, args.pack),
+                             args.num_workers, args.prefetch_factor)
     )
-    ## 4. Build & Load models
-    model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH)
 
-    ## 4.1.
-    # To start from the pre-trained models, un-comment following lines.
-    # path_model_bert =
-    # path_model =
-    # model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH, trained=True, path_model_bert=path_model_bert, path_model=path_model)
+    # Frozen BERT: features computed once by extract_bert_features.py.
+    features = {'train': None, 'dev': None, 'test': None}
+    if args.bert_features:
+        if args.fine_tune:
+            raise ValueError("--bert_features holds the features of a frozen BERT, it cannot be used with --fine_tune")
+        for split in (['train', 'dev', 'test'] if args.eval_test else ['train', 'dev']):
+            features[split] = BertFeatures(os.path.join(args.bert_features, split))
+            features[split].check(args.bert_type, args.max_seq_length, args.num_target_layers)
+
+    if args.grad_checkpoint_segment > 0:
+        model_bert.set_gradient_checkpointing(args.grad_checkpoint_segment)
+
+    # Distributed: gradients of both opt and opt_bert are averaged across ranks.
+    # Unused parameters: the where-operator / where-value heads of batches without conditions, the BERT pooler.
+    model = wrap_ddp(model, find_unused_parameters=True)
+    if args.fine_tune:
+        model_bert = wrap_ddp(model_bert, find_unused_parameters=True)
 
     ## 5. Get optimizers
     opt, opt_bert = get_opt(model, model_bert, args.fine_tune)
 
     ## 6. Train
+    scaler = get_grad_scaler(args.precision, device)
+    # Timers of the loop stages. Each rank times its own loops, rank 0 writes the reports.
+    profiler = StageProfiler(args.profile, path=args.save_dir if is_main_process() else None,
+                             torch_steps=args.profile_torch_steps)
     acc_lx_t_best = -1
     epoch_best = -1
-    for epoch in range(args.tepoch):
+
+    # Checkpoints are written in a background thread. Distributed: the ranks hold the same parameters, rank 0 writes them.
+    writer = CheckpointWriter(args.save_format, keep_last=args.keep_last) if is_main_process() else None
+
+    # Full training state, for resuming.
+    path_train_state = os.path.join(args.save_dir, 'train_state.pt')
+    save_every = -(-args.save_every // args.accumulate_gradients) * args.accumulate_gradients  # at optimizer steps
+    models_state = {'model': unwrap(model), 'model_bert': unwrap(model_bert)}
+    opts_state = {'opt': opt, 'opt_bert': opt_bert}
+
+    def save_state(iB, epoch_state=None):
+        state = get_train_state(epoch if epoch_state is None else epoch_state, iB * args.bS, models_state, opts_state,
+                                scaler, best={'acc_lx_t_best': acc_lx_t_best, 'epoch_best': epoch_best})
+        if is_main_process():
+            writer.save(path_train_state, None, state, 'torch')
+            print(f"Saving the training state at epoch {state['epoch']}, batch {iB} to {path_train_state}")
+
+    st_epoch, st_iB = 0, 0
+    if args.resume:
+        st_epoch, st_pos, best = restore_train_state(load_train_state(args.resume), models_state, opts_state, scaler)
+        acc_lx_t_best, epoch_best = best['acc_lx_t_best'], best['epoch_best']
+        # Jump straight to the first batch not done: the skipped ones are neither loaded nor collated.
+        st_iB = st_pos // args.bS
+        train_loader.sampler.set_start(st_iB * args.bS)
+        print(f"Resuming from {args.resume} at epoch {st_epoch}, batch {st_iB}")
+
+    for epoch in range(st_epoch, args.tepoch):
+        set_epoch(train_loader, epoch)
         # train
         acc_train, aux_out_train = train(train_loader,
                                          train_table,
@@ -647,18 +864,28 @@ if __name__ == '__main__':
                                          args.num_target_layers,
                                          args.accumulate_gradients,
                                          opt_bert=opt_bert,
-                                         st_pos=0,
+                                         st_iB=st_iB if epoch == st_epoch else 0,
                                          path_db=path_wikisql,
                                          dset_name='train',
                                          constraint=args.constraint,
-                                         mask_dropout=args.mask_dr)
+                                         mask_dropout=args.mask_dr,
+                                         precision=args.precision,
+                                         scaler=scaler,
+                                         save_every=save_every,
+                                         save_state=save_state,
+                                         train_metrics=args.train_metrics,
+                                         exec_rate=args.train_exec_rate,
+                                         seed=args.seed + epoch,
+                                         features=features['train'],
+                                         profiler=profiler)
+        profiles = [profiler.report(epoch, 'train')]
 
         # check DEV
         with torch.no_grad():
             acc_dev, results_dev, cnt_list = test(dev_loader,
                                                 dev_table,
-                                                model,
-                                                model_bert,
+                                                unwrap(model),
+                                                unwrap(model_bert),
                                                 bert_config,
                                                 tokenizer,
                                                 args.max_seq_length,
@@ -667,12 +894,15 @@ if __name__ == '__main__':
                                                 path_db=path_wikisql,
                                                 st_pos=0,
                                                 dset_name='dev', EG=args.EG,
-                                                constraint=args.constraint)
+                                                constraint=args.constraint,
+                                                features=features['dev'],
+                                                profiler=profiler)
+            profiles.append(profiler.report(epoch, 'dev'))
             if args.eval_test:
                 acc_test, results_test, cnt_list_test = test(test_loader,
                                                       test_table,
-                                                      model,
-                                                      model_bert,
+                                                      unwrap(model),
+                                                      unwrap(model_bert),
                                                       bert_config,
                                                       tokenizer,
                                                       args.max_seq_length,
@@ -681,16 +911,22 @@ if __name__ == '__main__':
                                                       path_db=path_wikisql,
                                                       st_pos=0,
                                                       dset_name='test', EG=args.EG,
-                                                      constraint=args.constraint)
+                                                      constraint=args.constraint,
+                                                      features=features['test'],
+                                                      profiler=profiler)
+                profiles.append(profiler.report(epoch, 'test'))
 
 
         print_result(epoch, acc_train, 'train')
         print_result(epoch, acc_dev, 'dev')
         if args.eval_test:
             print_result(epoch, acc_test, 'test')
+        if args.profile:
+            print('\n'.join(profiles))
 
         # save results for the official evaluation
-        save_for_evaluation(path_save_for_evaluation, results_dev, 'dev')
+        if is_main_process():
+            save_for_evaluation(path_save_for_evaluation, results_dev, 'dev')
 
 
 
@@ -701,10 +937,18 @@ if __name__ == '__main__':
             acc_lx_t_best = acc_lx_t
             epoch_best = epoch
             # save best model
-            state = {'model': model.state_dict()}
-            torch.save(state, os.path.join(args.save_dir, 'model_best.pt') )
-
-            state = {'model_bert': model_bert.state_dict()}
-            torch.save(state, os.path.join(args.save_dir, 'model_bert_best.pt'))
+            if is_main_process():
+                writer.save(os.path.join(args.save_dir, 'model_best.pt'), 'model', unwrap(model).state_dict())
+                writer.save(os.path.join(args.save_dir, 'model_bert_best.pt'), 'model_bert',
+                            unwrap(model_bert).state_dict())
 
         print(f" Best Dev lx acc: {acc_lx_t_best} at epoch: {epoch_best}")
+
+        if save_every > 0:
+            save_state(0, epoch_state=epoch + 1)
+        if is_main_process():
+            print(writer.summary())
+
+    if is_main_process():
+        writer.close()
+        print(writer.summary())
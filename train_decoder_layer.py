@@ -1,9 +1,11 @@
 # Wonseok Hwang
 # Sep30, 2018
 import os, sys, argparse, re, json
+from contextlib import nullcontext
 import random as python_random
 
-from matplotlib.pylab import *
+import numpy as np
+from numpy import mean, std
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
@@ -16,6 +18,9 @@ from bert.modeling import BertConfig, BertModel
 from sqlova.utils.utils_wikisql import *
 from sqlova.model.nl2sql.wikisql_models import *
 from sqlnet.dbengine import DBEngine
+from sqlova.utils.checkpoint import CheckpointWriter
+from sqlova.utils.distributed import init_distributed, is_main_process, wrap_ddp, unwrap, \
+    no_sync, set_epoch, all_reduce_sum, gather_results
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -98,6 +103,12 @@ def construct_hyper_param(parser):
 
     parser.add_argument("--tag", default='', type=str,
                         help="Tag of saved files. e.g.) '', 'FT1', 'FT1_aug', 'no_pretraining', 'no_tuning',..")
+    parser.add_argument('--grad_checkpoint_segment',
+                        default=0, type=int,
+                        help="Activation checkpointing of BERT during fine-tuning, N BERT layers per checkpoint. 0: off.")
+    parser.add_argument('--keep_last',
+                        default=1, type=int,
+                        help="Keep the N last versions of each saved checkpoint (model_best.pt, model_best.1.pt, ...).")
 
     args = parser.parse_args()
     assert args.sql_vocab_type == 0  # type 0 is better than type 1 slightly.. although there seems to be some statistical fluctuation.
@@ -144,7 +155,6 @@ def construct_hyper_param(parser):
         assert args.fine_tune == True
 
     # Seeds for random number generation.
-    seed(args.seed)
     python_random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -252,11 +262,19 @@ def get_models(args, BERT_PT_PATH, trained=False, path_model_bert=None, path_mod
 
     return model, model_bert, tokenizer, bert_config
 
-def get_data(path_wikisql, args):
+def get_data(path_wikisql, args, tokenizer):
     train_data, train_table, dev_data, dev_table, _, _ = load_wikisql(path_wikisql, args.toy_model, args.toy_size,
                                                                       no_w2i=True, no_hs_tok=True,
                                                                       aug=args.aug)
-    train_loader, dev_loader = get_loader_wikisql(train_data, dev_data, args.bS, shuffle_train=True)
+    # WordPiece-level g_wvi, computed once and stored with the data.
+    n_unusable = load_g_wvi(path_wikisql, 'aug.train' if args.aug else 'train', train_data, tokenizer, args.bert_type,
+                            save=not args.toy_model)
+    load_g_wvi(path_wikisql, 'dev', dev_data, tokenizer, args.bert_type, save=not args.toy_model)
+    # Train examples whose where-values are not found in the question cannot be used. Dropped up front, so that
+    # batches stay full and train() does not skip the batches holding them (on all ranks when distributed).
+    train_data = [t1 for t1 in train_data if t1['g_wvi'] is not None]
+    print(f"{n_unusable} train examples without where-value indices are dropped")
+    train_loader, dev_loader = get_loader_wikisql(train_data, dev_data, args.bS, shuffle_train=True, seed=args.seed)
 
     return train_data, train_table, dev_data, dev_table, train_loader, dev_loader
 
@@ -283,61 +301,56 @@ def train(train_loader, train_table, model, model_bert, opt, tokenizer,sql_vocab
         # Get fields
         nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, train_table, no_hs_t=True, no_sql_t=True)
         g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
-        # get ground truth where-value index under CoreNLP tokenization scheme. It's done already on trainset.
-        g_wvi_corenlp = get_g_wvi_corenlp(t)
 
 
-        # g_wvi_corenlp = get_g_wvi_corenlp(t)
-        all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, i_sql_vocab, \
-        l_n, l_hpu, l_hs, l_input, \
-        nlu_tt, t_to_tt_idx, tt_to_t_idx \
-            = get_bert_output_s2s(model_bert, tokenizer, nlu_t, hds, sql_vocab, max_seq_length)
+        # Distributed: the gradients of the micro-batches before the last one of an accumulation are only summed
+        # locally, the last backward all-reduces them.
+        sync = iB % accumulate_gradients == (accumulate_gradients-1)
+        with no_sync(model, model_bert) if not sync else nullcontext():
+            # g_wvi_corenlp = get_g_wvi_corenlp(t)
+            all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, i_sql_vocab, \
+            l_n, l_hpu, l_hs, l_input, \
+            nlu_tt, t_to_tt_idx, tt_to_t_idx \
+                = get_bert_output_s2s(model_bert, tokenizer, nlu_t, hds, sql_vocab, max_seq_length)
 
-        try:
-            #
-            g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
-        except:
-            # Exception happens when where-condition is not found in nlu_tt.
-            # In this case, that train example is not used.
-            # During test, that example considered as wrongly answered.
-            # e.g. train: 32.
-            continue
+            # WordPiece-level g_wvi, precomputed by load_g_wvi. The train examples without them are dropped in get_data.
+            g_wvi = [t1['g_wvi'] for t1 in t]
 
 
-        # Generate g_pnt_idx
-        g_pnt_idxs = gen_g_pnt_idx(g_wvi, sql_i, i_hds, i_sql_vocab, col_pool_type=col_pool_type)
-        pnt_start_tok = i_sql_vocab[0][-2][0]
-        pnt_end_tok = i_sql_vocab[0][-1][0]
-        # check
-        # print(array(tokens[0])[g_pnt_idxs[0]])
-        wenc_s2s = all_encoder_layer[-1]
+            # Generate g_pnt_idx
+            g_pnt_idxs = gen_g_pnt_idx(g_wvi, sql_i, i_hds, i_sql_vocab, col_pool_type=col_pool_type)
+            pnt_start_tok = i_sql_vocab[0][-2][0]
+            pnt_end_tok = i_sql_vocab[0][-1][0]
+            # check
+            # print(array(tokens[0])[g_pnt_idxs[0]])
+            wenc_s2s = all_encoder_layer[-1]
 
-        # wemb_h = [B, max_header_number, hS]
-        cls_vec = pooled_output
+            # wemb_h = [B, max_header_number, hS]
+            cls_vec = pooled_output
 
-        score = model(wenc_s2s, l_input, cls_vec, pnt_start_tok, g_pnt_idxs=g_pnt_idxs)
+            score = model(wenc_s2s, l_input, cls_vec, pnt_start_tok, g_pnt_idxs=g_pnt_idxs)
 
 
-        # Calculate loss & step
-        loss = Loss_s2s(score, g_pnt_idxs)
+            # Calculate loss & step
+            loss = Loss_s2s(score, g_pnt_idxs)
 
-        # Calculate gradient
-        if iB % accumulate_gradients == 0: # mode
-            # at start, perform zero_grad
-            opt.zero_grad()
-            opt_bert.zero_grad()
-            loss.backward()
-            if accumulate_gradients == 1:
+            # Calculate gradient
+            if iB % accumulate_gradients == 0: # mode
+                # at start, perform zero_grad
+                opt.zero_grad()
+                opt_bert.zero_grad()
+                loss.backward()
+                if accumulate_gradients == 1:
+                    opt.step()
+                    opt_bert.step()
+            elif iB % accumulate_gradients == (accumulate_gradients-1):
+                # at the final, take step with accumulated graident
+                loss.backward()
                 opt.step()
                 opt_bert.step()
-        elif iB % accumulate_gradients == (accumulate_gradients-1):
-            # at the final, take step with accumulated graident
-            loss.backward()
-            opt.step()
-            opt_bert.step()
-        else:
-            # at intermediate stage, just accumulates the gradients
-            loss.backward()
+            else:
+                # at intermediate stage, just accumulates the gradients
+                loss.backward()
 
         if check_grad:
             named_parameters = model.named_parameters()
@@ -403,6 +416,9 @@ def train(train_loader, train_table, model, model_bert, opt, tokenizer,sql_vocab
         cnt_lx += sum(cnt_lx1_list)
         cnt_x += sum(cnt_x1_list)
 
+    # Distributed: totals over all ranks.
+    ave_loss, cnt, cnt_lx, cnt_x = all_reduce_sum([ave_loss, cnt, cnt_lx, cnt_x])
+
     ave_loss /= cnt
     acc_lx = cnt_lx / cnt
     acc_x = cnt_x / cnt
@@ -590,6 +606,9 @@ def test(data_loader, data_table, model, model_bert, tokenizer, sql_vocab,
             print(f"Ground T  :   {g_sql_q}")
             print(f"Prediction:   {pr_sql_q}")
 
+    # Distributed: totals over all ranks and the results of the whole data set.
+    ave_loss, cnt, cnt_lx, cnt_x = all_reduce_sum([ave_loss, cnt, cnt_lx, cnt_x])
+    results = gather_results(results)
 
     ave_loss /= cnt
 
@@ -613,6 +632,7 @@ if __name__ == '__main__':
     ## 1. Hyper parameters
     parser = argparse.ArgumentParser()
     args = construct_hyper_param(parser)
+    init_distributed()
 
     ## 2. Paths
     path_h = '/home/wonseok'
@@ -621,20 +641,31 @@ if __name__ == '__main__':
 
     path_save_for_evaluation = './'
 
-    ## 3. Load data
-    train_data, train_table, dev_data, dev_table, train_loader, dev_loader = get_data(path_wikisql, args)
-
-    ## 4. Build & Load models
+    ## 3. Build & Load models
     model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH)
 
+    ## 4. Load data
+    train_data, train_table, dev_data, dev_table, train_loader, dev_loader = get_data(path_wikisql, args, tokenizer)
+
+    if args.grad_checkpoint_segment > 0:
+        model_bert.set_gradient_checkpointing(args.grad_checkpoint_segment)
+
+    # Distributed: gradients of both opt and opt_bert are averaged across ranks.
+    # Unused parameters: the encoder LSTMs of Decoder_s2s. BERT is used whole (the pooler gives the decoder state).
+    model = wrap_ddp(model, find_unused_parameters=True)
+    if args.fine_tune:
+        model_bert = wrap_ddp(model_bert)
 
     ## 5. Get optimizers
     opt, opt_bert = get_opt(model, model_bert, args.model_type)
 
     ## 6. Train
+    # Checkpoints are written in a background thread.
+    writer = CheckpointWriter(keep_last=args.keep_last) if is_main_process() else None
     acc_lx_t_best = -1
     epoch_best = -1
     for epoch in range(args.tepoch):
+        set_epoch(train_loader, epoch)
         # train
         acc_train, aux_out_train = train(train_loader,
                                          train_table,
@@ -656,8 +687,8 @@ if __name__ == '__main__':
         with torch.no_grad():
             acc_dev, results_dev = test(dev_loader,
                         dev_table,
-                        model,
-                        model_bert,
+                        unwrap(model),
+                        unwrap(model_bert),
                         tokenizer,
                         args.sql_vocab,
                         args.max_seq_length,
@@ -669,11 +700,12 @@ if __name__ == '__main__':
                         aug=args.aug)
 
 
-        print_result(epoch, acc_train, 'train')
-        print_result(epoch, acc_dev, 'dev')
+        if is_main_process():
+            print_result(epoch, acc_train, 'train')
+            print_result(epoch, acc_dev, 'dev')
 
-        # save results for the offical evaluation
-        save_for_evaluation(path_save_for_evaluation, results_dev, 'dev')
+            # save results for the offical evaluation
+            save_for_evaluation(path_save_for_evaluation, results_dev, 'dev')
 
         # save best model
         # Based on Dev Set logical accuracy lx
@@ -681,11 +713,14 @@ if __name__ == '__main__':
         if acc_lx_t > acc_lx_t_best:
             acc_lx_t_best = acc_lx_t
             epoch_best = epoch
-            # save best model
-            state = {'model': model.state_dict()}
-            torch.save(state, os.path.join('.', 'model_best.pt'))
+            # save best model. Distributed: the ranks hold the same parameters, rank 0 writes them.
+            if is_main_process():
+                writer.save(os.path.join('.', 'model_best.pt'), 'model', unwrap(model).state_dict())
+                writer.save(os.path.join('.', 'model_bert_best.pt'), 'model_bert', unwrap(model_bert).state_dict())
 
-            state = {'model_bert': model_bert.state_dict()}
-            torch.save(state, os.path.join('.', 'model_bert_best.pt'))
+        if is_main_process():
+            print(f" Best Dev lx acc: {acc_lx_t_best} at epoch: {epoch_best}")
+            print(writer.summary())
 
-        print(f" Best Dev lx acc: {acc_lx_t_best} at epoch: {epoch_best}")
+    if is_main_process():
+        writer.close()
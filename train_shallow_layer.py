@@ -1,9 +1,11 @@
 # Wonseok Hwang
 # Sep30, 2018
 import os, sys, argparse, re, json
+from contextlib import nullcontext
 import random as python_random
 
-from matplotlib.pylab import *
+import numpy as np
+from numpy import mean, std
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
@@ -16,6 +18,9 @@ from bert.modeling import BertConfig, BertModel
 from sqlova.utils.utils_wikisql import *
 from sqlova.model.nl2sql.wikisql_models import *
 from sqlnet.dbengine import DBEngine
+from sqlova.utils.checkpoint import CheckpointWriter
+from sqlova.utils.distributed import init_distributed, is_main_process, wrap_ddp, unwrap, \
+    no_sync, set_epoch, all_reduce_sum, gather_results
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -86,6 +91,12 @@ def construct_hyper_param(parser):
 
     parser.add_argument("--tag", default='', type=str,
                         help="Tag of saved files. e.g.) '', 'FT1', 'FT1_aug', 'no_pretraining', 'no_tuning',..")
+    parser.add_argument('--grad_checkpoint_segment',
+                        default=0, type=int,
+                        help="Activation checkpointing of BERT during fine-tuning, N BERT layers per checkpoint. 0: off.")
+    parser.add_argument('--keep_last',
+                        default=1, type=int,
+                        help="Keep the N last versions of each saved checkpoint (model_best.pt, model_best.1.pt, ...).")
 
     args = parser.parse_args()
 
@@ -113,7 +124,6 @@ def construct_hyper_param(parser):
 
 
     # Seeds for random number generation.
-    seed(args.seed)
     python_random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -212,11 +222,19 @@ def get_models(args, BERT_PT_PATH, trained=False, path_model_bert=None, path_mod
 
     return model, model_bert, tokenizer, bert_config
 
-def get_data(path_wikisql, args):
+def get_data(path_wikisql, args, tokenizer):
     train_data, train_table, dev_data, dev_table, _, _ = load_wikisql(path_wikisql, args.toy_model, args.toy_size,
                                                                       no_w2i=True, no_hs_tok=True,
                                                                       aug=args.aug)
-    train_loader, dev_loader = get_loader_wikisql(train_data, dev_data, args.bS, shuffle_train=True)
+    # WordPiece-level g_wvi, computed once and stored with the data.
+    n_unusable = load_g_wvi(path_wikisql, 'aug.train' if args.aug else 'train', train_data, tokenizer, args.bert_type,
+                            save=not args.toy_model)
+    load_g_wvi(path_wikisql, 'dev', dev_data, tokenizer, args.bert_type, save=not args.toy_model)
+    # Train examples whose where-values are not found in the question cannot be used. Dropped up front, so that
+    # batches stay full and train() does not skip the batches holding them (on all ranks when distributed).
+    train_data = [t1 for t1 in train_data if t1['g_wvi'] is not None]
+    print(f"{n_unusable} train examples without where-value indices are dropped")
+    train_loader, dev_loader = get_loader_wikisql(train_data, dev_data, args.bS, shuffle_train=True, seed=args.seed)
 
     return train_data, train_table, dev_data, dev_table, train_loader, dev_loader
 
@@ -250,61 +268,57 @@ def train(train_loader, train_table, model, model_bert, opt, bert_config, tokeni
         # Get fields
         nlu, nlu_t, sql_i, sql_q, sql_t, tb, hs_t, hds = get_fields(t, train_table, no_hs_t=True, no_sql_t=True)
         g_sc, g_sa, g_wn, g_wc, g_wo, g_wv = get_g(sql_i)
-        # get ground truth where-value index under CoreNLP tokenization scheme. It's done already on trainset.
-        g_wvi_corenlp = get_g_wvi_corenlp(t)
-
-
-        all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, \
-        l_n, l_hpu, l_hs, \
-        nlu_tt, t_to_tt_idx, tt_to_t_idx \
-            = get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length)
 
-        try:
-            #
-            g_wvi = get_g_wvi_bert_from_g_wvi_corenlp(t_to_tt_idx, g_wvi_corenlp)
-        except:
-            # Exception happens when where-condition is not found in nlu_tt.
-            # In this case, that train example is not used.
-            # During test, that example considered as wrongly answered.
-            # e.g. train: 32.
-            continue
 
-        wemb_n = get_wemb_n(i_nlu, l_n, bert_config.hidden_size,
-                            bert_config.num_hidden_layers, all_encoder_layer, 1)
-        wemb_h = get_wemb_h_FT_Scalar_1(i_hds, l_hs, bert_config.hidden_size, all_encoder_layer,
-                                        col_pool_type=col_pool_type)
-        # wemb_h = [B, max_header_number, hS]
-        cls_vec = pooled_output
+        # Distributed: the gradients of the micro-batches before the last one of an accumulation are only summed
+        # locally, the last backward all-reduces them.
+        sync = iB % accumulate_gradients == (accumulate_gradients-1)
+        with no_sync(model, model_bert) if not sync else nullcontext():
+            all_encoder_layer, pooled_output, tokens, i_nlu, i_hds, \
+            l_n, l_hpu, l_hs, \
+            nlu_tt, t_to_tt_idx, tt_to_t_idx \
+                = get_bert_output(model_bert, tokenizer, nlu_t, hds, max_seq_length)
+
+            # WordPiece-level g_wvi, precomputed by load_g_wvi. The train examples without them are dropped in get_data.
+            g_wvi = [t1['g_wvi'] for t1 in t]
+
+            wemb_n = get_wemb_n(i_nlu, l_n, bert_config.hidden_size,
+                                bert_config.num_hidden_layers, all_encoder_layer, 1)
+            wemb_h = get_wemb_h_FT_Scalar_1(i_hds, l_hs, bert_config.hidden_size, all_encoder_layer,
+                                            col_pool_type=col_pool_type)
+            # wemb_h = [B, max_header_number, hS]
+            cls_vec = pooled_output
+
+            # model specific part
+            # get g_wvi (it is idex for word-piece tok)
+            # score
+            s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hs, cls_vec,
+                                                       g_sc=g_sc, g_sa=g_sa, g_wn=g_wn, g_wc=g_wc, g_wo=g_wo,
+                                                       g_wvi=g_wvi)
+
+            # Calculate loss & step
+            loss = Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi)
 
-        # model specific part
-        # get g_wvi (it is idex for word-piece tok)
-        # score
-        s_sc, s_sa, s_wn, s_wc, s_wo, s_wv = model(wemb_n, l_n, wemb_h, l_hs, cls_vec,
-                                                   g_sc=g_sc, g_sa=g_sa, g_wn=g_wn, g_wc=g_wc, g_wo=g_wo, g_wvi=g_wvi)
-
-        # Calculate loss & step
-        loss = Loss_sw_se(s_sc, s_sa, s_wn, s_wc, s_wo, s_wv, g_sc, g_sa, g_wn, g_wc, g_wo, g_wvi)
-
-        # Calculate gradient
-        if iB % accumulate_gradients == 0: # mode
-            # at start, perform zero_grad
-            opt.zero_grad()
-            if opt_bert:
-                opt_bert.zero_grad()
-            loss.backward()
-            if accumulate_gradients == 1:
+            # Calculate gradient
+            if iB % accumulate_gradients == 0: # mode
+                # at start, perform zero_grad
+                opt.zero_grad()
+                if opt_bert:
+                    opt_bert.zero_grad()
+                loss.backward()
+                if accumulate_gradients == 1:
+                    opt.step()
+                    if opt_bert:
+                        opt_bert.step()
+            elif iB % accumulate_gradients == (accumulate_gradients-1):
+                # at the final, take step with accumulated graident
+                loss.backward()
                 opt.step()
                 if opt_bert:
                     opt_bert.step()
-        elif iB % accumulate_gradients == (accumulate_gradients-1):
-            # at the final, take step with accumulated graident
-            loss.backward()
-            opt.step()
-            if opt_bert:
-                opt_bert.step()
-        else:
-            # at intermediate stage, just accumulates the gradients
-            loss.backward()
+            else:
+                # at intermediate stage, just accumulates the gradients
+                loss.backward()
 
         if check_grad:
             named_parameters = model.named_parameters()
@@ -358,6 +372,10 @@ def train(train_loader, train_table, model, model_bert, opt, bert_config, tokeni
         cnt_lx += sum(cnt_lx1_list)
         cnt_x += sum(cnt_x1_list)
 
+    # Distributed: totals over all ranks.
+    ave_loss, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x \
+        = all_reduce_sum([ave_loss, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x])
+
     ave_loss /= cnt
     acc_sc = cnt_sc / cnt
     acc_sa = cnt_sa / cnt
@@ -596,6 +614,11 @@ def test(data_loader, data_table, model, model_bert, bert_config, tokenizer,
 
         data_list.append(data_batch)
 
+    # Distributed: totals over all ranks and the results of the whole data set.
+    ave_loss, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x \
+        = all_reduce_sum([ave_loss, cnt, cnt_sc, cnt_sa, cnt_wn, cnt_wc, cnt_wo, cnt_wvi, cnt_wv, cnt_lx, cnt_x])
+    results = gather_results(results)
+
     ave_loss /= cnt
     acc_sc = cnt_sc / cnt
     acc_sa = cnt_sa / cnt
@@ -625,6 +648,7 @@ if __name__ == '__main__':
     ## 1. Hyper parameters
     parser = argparse.ArgumentParser()
     args = construct_hyper_param(parser)
+    init_distributed()
 
     ## 2. Paths
     path_h = '/home/wonseok'
@@ -633,21 +657,33 @@ if __name__ == '__main__':
 
     path_save_for_evaluation = './'
 
-    ## 3. Load data
-    train_data, train_table, dev_data, dev_table, train_loader, dev_loader = get_data(path_wikisql, args)
-
-    ## 4. Build & Load models
+    ## 3. Build & Load models
     model, model_bert, tokenizer, bert_config = get_models(args, BERT_PT_PATH)
 
+    ## 4. Load data
+    train_data, train_table, dev_data, dev_table, train_loader, dev_loader = get_data(path_wikisql, args, tokenizer)
+
+    if args.grad_checkpoint_segment > 0:
+        model_bert.set_gradient_checkpointing(args.grad_checkpoint_segment)
+
+    # Distributed: gradients of opt_bert are averaged across ranks. FT_Scalar_1 has no parameters, and BERT is used
+    # whole (the pooler gives s_wn).
+    model = wrap_ddp(model)
+    if args.fine_tune:
+        model_bert = wrap_ddp(model_bert)
+
     # nsml binding
 
     ## 5. Get optimizers
     opt, opt_bert = get_opt(model, model_bert, args.model_type)
 
     ## 6. Train
+    # Checkpoints are written in a background thread.
+    writer = CheckpointWriter(keep_last=args.keep_last) if is_main_process() else None
     acc_lx_t_best = -1
     epoch_best = -1
     for epoch in range(args.tepoch):
+        set_epoch(train_loader, epoch)
         # train
         acc_train, aux_out_train = train(train_loader,
                                          train_table,
@@ -670,8 +706,8 @@ if __name__ == '__main__':
         with torch.no_grad():
             acc_dev, results_dev, cnt_list_dev, p_list_dev, data_list_dev = test(dev_loader,
                                                 dev_table,
-                                                model,
-                                                model_bert,
+                                                unwrap(model),
+                                                unwrap(model_bert),
                                                 bert_config,
                                                 tokenizer,
                                                 args.max_seq_length,
@@ -685,11 +721,12 @@ if __name__ == '__main__':
                                                 aug=args.aug)
 
 
-        print_result(epoch, acc_train, 'train')
-        print_result(epoch, acc_dev, 'dev')
+        if is_main_process():
+            print_result(epoch, acc_train, 'train')
+            print_result(epoch, acc_dev, 'dev')
 
-        # save results for the offical evaluation
-        save_for_evaluation(path_save_for_evaluation, results_dev, 'dev')
+            # save results for the offical evaluation
+            save_for_evaluation(path_save_for_evaluation, results_dev, 'dev')
 
         # save best model
         # Based on Dev Set logical accuracy lx
@@ -697,11 +734,14 @@ if __name__ == '__main__':
         if acc_lx_t > acc_lx_t_best:
             acc_lx_t_best = acc_lx_t
             epoch_best = epoch
-            # save best model
-            state = {'model': model.state_dict()}
-            torch.save(state, os.path.join('.', 'model_best.pt'))
+            # save best model. Distributed: the ranks hold the same parameters, rank 0 writes them.
+            if is_main_process():
+                writer.save(os.path.join('.', 'model_best.pt'), 'model', unwrap(model).state_dict())
+                writer.save(os.path.join('.', 'model_bert_best.pt'), 'model_bert', unwrap(model_bert).state_dict())
 
-            state = {'model_bert': model_bert.state_dict()}
-            torch.save(state, os.path.join('.', 'model_bert_best.pt'))
+        if is_main_process():
+            print(f" Best Dev lx acc: {acc_lx_t_best} at epoch: {epoch_best}")
+            print(writer.summary())
 
-        print(f" Best Dev lx acc: {acc_lx_t_best} at epoch: {epoch_best}")
+    if is_main_process():
+        writer.close()